@@ -0,0 +1,106 @@
+import argparse
+import json
+import random
+import time
+
+from veedrive.presentation import archive
+
+parser = argparse.ArgumentParser(
+    description="Measure the storage and reconstruction latency of archived "
+    "presentation versions stored as snapshots and deltas"
+)
+parser.add_argument(
+    "--versions", type=int, help="Number of versions in the history", default=500
+)
+parser.add_argument(
+    "--windows", type=int, help="Number of windows of the presentation", default=100
+)
+parser.add_argument(
+    "--edits", type=int, help="Number of windows edited per version", default=3
+)
+parser.add_argument(
+    "--snapshot-intervals",
+    dest="snapshot_intervals",
+    type=int,
+    nargs="+",
+    help="Numbers of versions between two snapshots",
+    default=[1, 5, 10, 20, 50],
+)
+
+args = parser.parse_args()
+
+
+def generate_history():
+    """Versions of a presentation where a few windows are moved, resized,
+    added or removed at each save
+    """
+    random.seed(0)
+    windows = [
+        {
+            "id": f"window{i}",
+            "uri": f"folder/image{i}.png",
+            "x": random.random(),
+            "y": random.random(),
+            "width": 0.1,
+            "height": 0.1,
+            "z": i,
+            "mode": "standard",
+        }
+        for i in range(args.windows)
+    ]
+    history = {}
+    for version in range(1, args.versions + 1):
+        windows = list(windows)
+        for _ in range(args.edits):
+            i = random.randrange(len(windows))
+            windows[i] = {**windows[i], "x": random.random(), "y": random.random()}
+        if version % 10 == 0:
+            windows.append({**windows[0], "id": f"window{args.windows + version}"})
+        if version % 15 == 0:
+            windows.pop(random.randrange(len(windows)))
+        history[version] = {
+            "id": "1509d5ec-163f-4a79-8942-4a8b74dbd438",
+            "name": "My presentation",
+            "savedAt": f"2022-09-01T00:00:{version:06d}",
+            "windows": windows,
+        }
+    return history
+
+
+def size(value):
+    return len(json.dumps(value)) if value is not None else 0
+
+
+def main():
+    history = generate_history()
+    full_size = sum(size(document) for document in history.values())
+    print(f"{args.versions} versions, {full_size / 1024:.0f} KiB stored in full")
+    print(
+        f"{'interval':>8} {'stored KiB':>12} {'ratio':>8} {'encode ms':>12} "
+        f"{'avg rebuild ms':>16} {'max rebuild ms':>16}"
+    )
+    for interval in args.snapshot_intervals:
+        t_start = time.perf_counter()
+        encoded = archive.encode(history, interval)
+        encode_time = time.perf_counter() - t_start
+
+        stored_size = sum(
+            size(data) + size(delta) for data, delta, _ in encoded.values()
+        )
+        rebuild_times = []
+        for archive_id, (data, delta, base_id) in encoded.items():
+            base_data = base_id and encoded[base_id][0]
+            t_start = time.perf_counter()
+            document = archive.reconstruct(data, delta, base_data)
+            rebuild_times.append(time.perf_counter() - t_start)
+            assert document == history[archive_id]
+        print(
+            f"{interval:8} {stored_size / 1024:12.0f} "
+            f"{full_size / stored_size:8.1f} {encode_time * 1000:12.0f} "
+            f"{sum(rebuild_times) / len(rebuild_times) * 1000:16.3f} "
+            f"{max(rebuild_times) * 1000:16.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
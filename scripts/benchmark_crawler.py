@@ -0,0 +1,104 @@
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from veedrive import config
+from veedrive.content import fs_manager
+from veedrive.content.search_query import SearchQuery
+
+parser = argparse.ArgumentParser(
+    description="Measure the speedup of the search crawler against its number of "
+    "threads, on a synthetic deep tree or an existing folder (e.g. an NFS mount)"
+)
+parser.add_argument("--path", help="Crawled folder instead of a synthetic tree")
+parser.add_argument("--depth", type=int, help="Depth of the synthetic tree", default=6)
+parser.add_argument(
+    "--fanout", type=int, help="Sub-folders per folder of the synthetic tree", default=4
+)
+parser.add_argument(
+    "--files", type=int, help="Files per folder of the synthetic tree", default=10
+)
+parser.add_argument(
+    "--latency",
+    type=float,
+    help="Latency added to every folder listing, in ms, to simulate a network "
+    "file system on a local tree",
+    default=0,
+)
+parser.add_argument(
+    "--threads",
+    type=int,
+    nargs="+",
+    help="Numbers of threads of the crawler",
+    default=[1, 2, 4, 8, 16, 32],
+)
+parser.add_argument("--query", help="Searched name", default="5")
+parser.add_argument(
+    "-n", "--repeat", type=int, help="Number of runs per measurement", default=3
+)
+
+args = parser.parse_args()
+
+
+def generate_tree(root, depth):
+    for i in range(args.files):
+        with open(os.path.join(root, f"file{i}.jpg"), "wb") as f:
+            f.write(b"0" * i)
+    if depth:
+        for i in range(args.fanout):
+            folder = os.path.join(root, f"folder{i}")
+            os.mkdir(folder)
+            generate_tree(folder, depth - 1)
+
+
+def simulate_latency():
+    scandir = os.scandir
+
+    def delayed_scandir(path):
+        time.sleep(args.latency / 1000)
+        return scandir(path)
+
+    os.scandir = delayed_scandir
+
+
+def measure(root, threads):
+    query = SearchQuery(args.query)
+    t_start = time.perf_counter()
+    for _ in range(args.repeat):
+        found_dirs, found_files = [], []
+        fs_manager.crawl(
+            [root], query, found_dirs, found_files, threads, threading.Event()
+        )
+    duration = (time.perf_counter() - t_start) / args.repeat
+    return duration, len(found_dirs) + len(found_files)
+
+
+def main():
+    root = args.path
+    if root is None:
+        root = tempfile.mkdtemp()
+        generate_tree(root, args.depth)
+    config.SANDBOX_PATH = root
+    if args.latency:
+        simulate_latency()
+
+    try:
+        print(f"{'threads':>8} {'time s':>10} {'speedup':>10} {'matches':>10}")
+        reference = None
+        for threads in args.threads:
+            duration, matches = measure(root, threads)
+            reference = reference or duration
+            print(
+                f"{threads:8} {duration:10.3f} {reference / duration:10.2f} "
+                f"{matches:10}"
+            )
+    finally:
+        if args.path is None:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import asyncpg
+
+import veedrive.config
+from veedrive.presentation.pg_connector import init_connection
+
+parser = argparse.ArgumentParser(
+    description="Compare interpolated and parameterised presentation queries "
+    "against a local PostgreSQL (configured with VEEDRIVE_DB_* variables)"
+)
+parser.add_argument(
+    "--rows", type=int, help="Number of presentations in the table", default=5000
+)
+parser.add_argument(
+    "-n", "--repeat", type=int, help="Number of calls per measurement", default=1000
+)
+
+args = parser.parse_args()
+
+TABLE = "benchmark_presentations"
+
+
+async def measure(func, ids):
+    t_start = time.perf_counter()
+    for i in range(args.repeat):
+        await func(ids[i % len(ids)])
+    return (time.perf_counter() - t_start) / args.repeat
+
+
+async def connect():
+    return await asyncpg.connect(
+        database=veedrive.config.DB_NAME,
+        user=veedrive.config.DB_USERNAME,
+        host=veedrive.config.DB_HOST,
+        password=veedrive.config.DB_PASSWORD,
+    )
+
+
+async def main():
+    # previous behaviour: jsonb as text, statement text differs on every call
+    text_conn = await connect()
+    conn = await connect()
+    await init_connection(conn)
+    await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    await conn.execute(
+        f"CREATE TABLE {TABLE} (id SERIAL PRIMARY KEY, data jsonb NOT NULL)"
+    )
+    presentations = [
+        {
+            "id": str(uuid.uuid4()),
+            "name": f"presentation {i}",
+            "folder": f"folder{i % 10}",
+            "savedAt": i,
+        }
+        for i in range(args.rows)
+    ]
+    await conn.executemany(
+        f"INSERT INTO {TABLE} (data) VALUES ($1)", [(p,) for p in presentations]
+    )
+    ids = [p["id"] for p in presentations]
+    folders = [f"folder{i}" for i in range(10)]
+
+    async def get_interpolated(presentation_id):
+        row = await text_conn.fetchrow(
+            f"SELECT data ::jsonb FROM {TABLE} "
+            f"WHERE data ::jsonb ->> 'id' = '{presentation_id}';"
+        )
+        return json.loads(row[0])
+
+    async def get_parameterised(presentation_id):
+        row = await conn.fetchrow(
+            f"SELECT data FROM {TABLE} WHERE data ->> 'id' = $1;", presentation_id
+        )
+        return row[0]
+
+    async def list_interpolated(folder):
+        rows = await text_conn.fetch(
+            f"SELECT data ::jsonb FROM {TABLE} WHERE data::jsonb ->> 'folder' = "
+            f"'{folder}' ORDER BY data ::jsonb ->> 'savedAt' DESC LIMIT 1000;"
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    async def list_parameterised(folder):
+        return await conn.fetch(
+            f"SELECT data FROM {TABLE} WHERE data ->> 'folder' = $1 "
+            "ORDER BY data ->> 'savedAt' DESC LIMIT 1000;",
+            folder,
+        )
+
+    async def save_interpolated(presentation_id):
+        presentation = {"id": presentation_id, "name": "saved"}
+        await text_conn.execute(
+            f"INSERT INTO {TABLE} (data) VALUES ('{json.dumps(presentation)}');"
+        )
+
+    async def save_parameterised(presentation_id):
+        presentation = {"id": presentation_id, "name": "saved"}
+        await conn.execute(f"INSERT INTO {TABLE} (data) VALUES ($1);", presentation)
+
+    print(
+        f"{'query':20} {'interpolated ms':>16} {'parameterised ms':>17} {'speedup':>8}"
+    )
+    for name, interpolated, parameterised, keys in [
+        ("get_presentation", get_interpolated, get_parameterised, ids),
+        ("list_presentations", list_interpolated, list_parameterised, folders),
+        ("save_presentation", save_interpolated, save_parameterised, ids),
+    ]:
+        interpolated_time = await measure(interpolated, keys)
+        parameterised_time = await measure(parameterised, keys)
+        print(
+            f"{name:20} {interpolated_time * 1000:16.3f} "
+            f"{parameterised_time * 1000:17.3f} "
+            f"{interpolated_time / parameterised_time:8.2f}"
+        )
+    await conn.execute(f"DROP TABLE {TABLE}")
+    await conn.close()
+    await text_conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
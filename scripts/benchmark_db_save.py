@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import uuid
+
+from veedrive.presentation.pg_connector import (GET_PRESENTATION_BY_ID,
+                                                GET_PRESENTATION_BY_NAME,
+                                                create_pg_connector)
+
+parser = argparse.ArgumentParser(
+    description="Compare latency and archived versions of concurrent presentation "
+    "saves, sequential queries (previous behaviour) against the single statement "
+    "upsert, on the PostgreSQL configured with VEEDRIVE_DB_* variables"
+)
+parser.add_argument("--clients", type=int, help="Concurrent clients", default=10)
+parser.add_argument("--saves", type=int, help="Saves per client", default=50)
+parser.add_argument(
+    "--presentations", type=int, help="Number of saved presentations", default=5
+)
+
+args = parser.parse_args()
+
+FOLDER = "benchmark-save"
+
+
+async def sequential_save(connector, presentation):
+    # uncached lookups, as before
+    existing = await connector.fetchval(GET_PRESENTATION_BY_ID, presentation["id"])
+    if existing:
+        await connector.execute(
+            "INSERT INTO archived_presentations (data) VALUES ($1) RETURNING id;",
+            existing,
+        )
+        await connector.delete_presentation(presentation["id"])
+    else:
+        await connector.fetchval(GET_PRESENTATION_BY_NAME, presentation["name"], FOLDER)
+    await connector.execute(
+        "INSERT INTO presentations (data) VALUES ($1) RETURNING id;", presentation
+    )
+
+
+async def upsert_save(connector, presentation):
+    await connector.save_presentation_to_storage(presentation)
+
+
+async def run_client(connector, save, ids, latencies, errors):
+    for i in range(args.saves):
+        presentation_id = random.choice(ids)
+        presentation = {
+            "id": presentation_id,
+            "name": f"benchmark {presentation_id}",
+            "folder": FOLDER,
+            "savedAt": time.time(),
+        }
+        t_start = time.perf_counter()
+        try:
+            await save(connector, presentation)
+        except Exception:
+            errors.append(presentation_id)
+        latencies.append(time.perf_counter() - t_start)
+
+
+async def clean_up(connector):
+    for table in ("presentations", "archived_presentations"):
+        await connector.execute(f"DELETE FROM {table} WHERE folder = $1", FOLDER)
+
+
+async def main():
+    connector = await create_pg_connector()
+    print(
+        f"{'save':12} {'mean ms':>9} {'p95 ms':>9} {'saves/s':>9} {'errors':>7} "
+        f"{'lost versions':>14}"
+    )
+    for name, save in [("sequential", sequential_save), ("upsert", upsert_save)]:
+        await clean_up(connector)
+        ids = [str(uuid.uuid4()) for _ in range(args.presentations)]
+        latencies, errors = [], []
+        t_start = time.perf_counter()
+        await asyncio.gather(
+            *[
+                run_client(connector, save, ids, latencies, errors)
+                for _ in range(args.clients)
+            ]
+        )
+        elapsed = time.perf_counter() - t_start
+
+        # every successful save but the first one of each presentation archives a version
+        saved = len(latencies) - len(errors)
+        archived = await connector.fetchval(
+            "SELECT count(*) FROM archived_presentations WHERE folder = $1", FOLDER
+        )
+        current = await connector.fetchval(
+            "SELECT count(*) FROM presentations WHERE folder = $1", FOLDER
+        )
+        lost = saved - current - archived
+        print(
+            f"{name:12} {statistics.mean(latencies) * 1000:9.2f} "
+            f"{statistics.quantiles(latencies, n=20)[-1] * 1000:9.2f} "
+            f"{len(latencies) / elapsed:9.1f} {len(errors):7} {lost:14}"
+        )
+    await clean_up(connector)
+    await connector.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import argparse
+import json
+import time
+
+from veedrive.utils import jsonrpc
+from veedrive.utils.json_encoders import RawJSON, VeeDriveJSONEncoder, loads
+
+parser = argparse.ArgumentParser(
+    description="Compare the build time of GetPresentation responses from the JSON "
+    "text read in the database: decoded and encoded again with json (previous "
+    "behaviour) or orjson, or spliced as is"
+)
+parser.add_argument(
+    "--windows",
+    type=int,
+    nargs="+",
+    help="Numbers of windows of the presentations",
+    default=[10, 100, 1000, 10000, 50000],
+)
+parser.add_argument(
+    "-n", "--repeat", type=int, help="Number of runs per measurement", default=10
+)
+
+args = parser.parse_args()
+
+REQUEST = {"id": "1", "method": "GetPresentation"}
+
+
+def generate_presentation_text(windows):
+    presentation = {
+        "id": "1509d5ec-163f-4a79-8942-4a8b74dbd438",
+        "name": "My presentation",
+        "savedAt": "2022-09-01T00:00:00",
+        "windows": [
+            {
+                "id": f"window{i}",
+                "uri": f"folder/image{i}.png",
+                "x": i * 0.001,
+                "y": i * 0.002,
+                "width": 0.1,
+                "height": 0.1,
+                "z": i,
+                "mode": "standard",
+                "tags": ["a", "b"],
+            }
+            for i in range(windows)
+        ],
+    }
+    # as output by PostgreSQL for jsonb::text
+    return json.dumps(presentation)
+
+
+def json_response(text):
+    obj = {"id": REQUEST["id"], "result": json.loads(text)}
+    return json.dumps(obj, cls=VeeDriveJSONEncoder)
+
+
+def orjson_response(text):
+    return jsonrpc.prepare_response(REQUEST, loads(text))
+
+
+def raw_response(text):
+    return jsonrpc.prepare_response(REQUEST, RawJSON(text))
+
+
+def measure(func, text):
+    t_start = time.perf_counter()
+    for _ in range(args.repeat):
+        func(text)
+    return (time.perf_counter() - t_start) / args.repeat * 1000
+
+
+def main():
+    print(
+        f"{'windows':>8} {'size KiB':>10} {'json ms':>10} {'orjson ms':>10} "
+        f"{'raw ms':>10}"
+    )
+    for windows in args.windows:
+        text = generate_presentation_text(windows)
+        assert json.loads(raw_response(text)) == json.loads(json_response(text))
+        print(
+            f"{windows:8} {len(text) / 1024:10.0f} "
+            f"{measure(json_response, text):10.3f} "
+            f"{measure(orjson_response, text):10.3f} "
+            f"{measure(raw_response, text):10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import os
+import time
+
+import scandir
+
+import veedrive.config
+from veedrive.content import image
+
+parser = argparse.ArgumentParser(
+    description="Compare PDF thumbnail generation with ImageMagick and PyMuPDF"
+)
+parser.add_argument(
+    "-s",
+    "--source",
+    type=str,
+    help="Path to media content",
+    default=veedrive.config.SANDBOX_PATH,
+)
+parser.add_argument(
+    "--sizes",
+    type=int,
+    nargs="+",
+    help="Sizes of the requested (square) boxes",
+    default=[256, 1024],
+)
+parser.add_argument(
+    "-n", "--repeat", type=int, help="Number of runs per measurement", default=5
+)
+
+args = parser.parse_args()
+
+
+def measure(func, *func_args):
+    try:
+        t_start = time.perf_counter()
+        for _ in range(args.repeat):
+            func(*func_args)
+        return f"{(time.perf_counter() - t_start) / args.repeat * 1000:.1f}"
+    except Exception as e:
+        return f"n/a ({type(e).__name__})"
+
+
+def main():
+    documents = [
+        os.path.join(path, f)
+        for path, _, files in scandir.walk(args.source)
+        for f in files
+        if os.path.splitext(f)[1].lower() in veedrive.config.SUPPORTED_DOC_EXTENSIONS
+    ]
+    print(f"{'document':40} {'size':>6} {'imagemagick ms':>20} {'pymupdf ms':>20}")
+    for document in sorted(documents):
+        for size in args.sizes:
+            imagemagick = measure(
+                image.generate_pdf_with_imagemagick, document, size, size, "fit"
+            )
+            pymupdf = measure(image.generate_pdf, document, size, size, "fit")
+            print(
+                f"{os.path.relpath(document, args.source):40} {size:6} "
+                f"{imagemagick:>20} {pymupdf:>20}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import argparse
+import os
+import time
+
+import cv2
+import numpy
+import scandir
+
+import veedrive.config
+from veedrive.content.image import (read_jpeg_header, resize_image,
+                                    transform_image)
+
+parser = argparse.ArgumentParser(
+    description="Compare full and reduced resolution JPEG decoding of resize_image"
+)
+parser.add_argument(
+    "-s",
+    "--source",
+    type=str,
+    help="Path to media content",
+    default=veedrive.config.SANDBOX_PATH,
+)
+parser.add_argument(
+    "--sizes",
+    type=int,
+    nargs="+",
+    help="Sizes of the requested (square) boxes",
+    default=[256, 512, 1024],
+)
+parser.add_argument(
+    "--mode",
+    type=str,
+    choices=veedrive.config.SCALING_MODES,
+    default=veedrive.config.FIT_TRANSFORM_IMAGE,
+)
+parser.add_argument(
+    "-n", "--repeat", type=int, help="Number of runs per measurement", default=5
+)
+
+args = parser.parse_args()
+
+
+def measure(func, *func_args):
+    result = None
+    t_start = time.perf_counter()
+    for _ in range(args.repeat):
+        result = func(*func_args)
+    return result, (time.perf_counter() - t_start) / args.repeat
+
+
+def full_resolution_resize(path, box_width, box_height, scaling_mode, ext):
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    return transform_image(img, box_width, box_height, scaling_mode, ext)
+
+
+def decode(encoded):
+    return cv2.imdecode(numpy.frombuffer(encoded[0], numpy.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def main():
+    images = [
+        os.path.join(path, f)
+        for path, _, files in scandir.walk(args.source)
+        for f in files
+        if read_jpeg_header(os.path.join(path, f))
+    ]
+    print(
+        f"{'image':40} {'size':>6} {'full ms':>9} {'reduced ms':>11} {'speedup':>8} {'PSNR dB':>8}"
+    )
+    for image in sorted(images):
+        for size in args.sizes:
+            full, full_time = measure(
+                full_resolution_resize, image, size, size, args.mode, ".jpg"
+            )
+            reduced, reduced_time = measure(
+                resize_image, image, size, size, args.mode, ".jpg"
+            )
+            full, reduced = decode(full), decode(reduced)
+            if full.shape != reduced.shape:
+                psnr = f"{full.shape} != {reduced.shape}"
+            else:
+                psnr = f"{cv2.PSNR(full, reduced):8.2f}"
+            print(
+                f"{os.path.relpath(image, args.source):40} {size:6} "
+                f"{full_time * 1000:9.1f} {reduced_time * 1000:11.1f} "
+                f"{full_time / reduced_time:8.2f} {psnr}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import os
+import time
+
+import scandir
+
+import veedrive.config
+from veedrive.content import video
+
+parser = argparse.ArgumentParser(
+    description="Compare size and encoding time of video thumbnail formats"
+)
+parser.add_argument(
+    "-s",
+    "--source",
+    type=str,
+    help="Path to media content",
+    default=veedrive.config.SANDBOX_PATH,
+)
+parser.add_argument(
+    "--sizes",
+    type=int,
+    nargs="+",
+    help="Sizes of the requested (square) boxes",
+    default=[256, 512],
+)
+parser.add_argument(
+    "--formats",
+    type=str,
+    nargs="+",
+    choices=list(veedrive.config.VIDEO_THUMBNAIL_CONTENT_TYPES),
+    default=list(veedrive.config.VIDEO_THUMBNAIL_CONTENT_TYPES),
+)
+parser.add_argument(
+    "-n", "--repeat", type=int, help="Number of runs per measurement", default=3
+)
+
+args = parser.parse_args()
+
+
+def measure(path, size, thumbnail_format):
+    thumbnail = b""
+    t_start = time.perf_counter()
+    for _ in range(args.repeat):
+        thumbnail = video.get_video_thumbnail(
+            path, size, size, veedrive.config.FIT_TRANSFORM_IMAGE, thumbnail_format
+        )
+    return len(thumbnail), (time.perf_counter() - t_start) / args.repeat
+
+
+def main():
+    videos = [
+        os.path.join(path, f)
+        for path, _, files in scandir.walk(args.source)
+        for f in files
+        if os.path.splitext(f)[1].lower() in veedrive.config.SUPPORTED_VIDEO_EXTENSIONS
+    ]
+    print(
+        f"{'video':40} {'size':>6} {'format':>6} {'kB':>9} {'ms':>9} "
+        f"{'size vs gif':>12} {'time vs gif':>12}"
+    )
+    for path in sorted(videos):
+        for size in args.sizes:
+            gif_size, gif_time = measure(
+                path, size, veedrive.config.GIF_VIDEO_THUMBNAIL
+            )
+            for thumbnail_format in args.formats:
+                if thumbnail_format == veedrive.config.GIF_VIDEO_THUMBNAIL:
+                    encoded_size, encode_time = gif_size, gif_time
+                else:
+                    encoded_size, encode_time = measure(path, size, thumbnail_format)
+                print(
+                    f"{os.path.relpath(path, args.source):40} {size:6} "
+                    f"{thumbnail_format:>6} {encoded_size / 1024:9.1f} "
+                    f"{encode_time * 1000:9.1f} {encoded_size / gif_size:12.2f} "
+                    f"{encode_time / gif_time:12.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,8 @@ import scandir
 import veedrive.config
 import veedrive.content.content_manager
 from veedrive.content import utils
-from veedrive.content.content_manager import cache_thumbnail, optimize_image
+from veedrive.content.content_manager import (cache_image_pyramid,
+                                              cache_thumbnail, optimize_image)
 
 parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
 parser.add_argument(
@@ -42,11 +43,21 @@ parser.add_argument(
     "-m",
     "--mode",
     type=str,
-    help="Operation mode. Thumb to generate thumbnails (video, pdf, images), optimize to render optimized images",
-    choices=["thumb", "optimize"],
+    help="Operation mode. Thumb to generate thumbnails (video, pdf, images), optimize to render optimized images, "
+    "tiles to generate deep zoom tiles of images",
+    choices=["thumb", "optimize", "tiles"],
     default="optimize",
 )
 
+parser.add_argument(
+    "--thumbnail-format",
+    dest="thumbnail_format",
+    type=str,
+    help="Format of video thumbnails (thumb mode)",
+    choices=list(veedrive.config.VIDEO_THUMBNAIL_CONTENT_TYPES),
+    default=None,
+)
+
 parser.add_argument(
     "--debug",
     action="store_true",
@@ -157,7 +168,9 @@ def generate_thumbnails(images_to_convert, media_path, cache_folder, result_queu
                     f, media_path, cache_folder, args.max_width, args.max_height
                 )
             elif args.mode == "thumb":
-                cache_thumbnail(f, cache_folder)
+                cache_thumbnail(f, cache_folder, thumbnail_format=args.thumbnail_format)
+            elif args.mode == "tiles":
+                cache_image_pyramid(f, cache_folder)
             dic = result_queue.get()
             dic["ok"].append(f)
             result_queue.put(dic)
@@ -176,7 +189,7 @@ def generate_thumbnails(images_to_convert, media_path, cache_folder, result_queu
 async def main():
     supported_exts = (
         veedrive.config.OPTIMIZABLE_IMAGE_EXTENSIONS
-        if args.mode == "optimize"
+        if args.mode in ["optimize", "tiles"]
         else veedrive.config.SUPPORTED_THUMBNAIL_EXTENSIONS
     )
 
@@ -10,6 +10,7 @@ import websockets
 from asyncpg import connect
 
 from veedrive import config
+from veedrive.presentation import migrations
 
 FNULL = open(os.devnull, "w")
 server = None
@@ -31,15 +32,7 @@ async def setup_db():
         host=config.DB_HOST,
         password=config.DB_PASSWORD,
     )
-    await conn.execute(
-        "CREATE TABLE IF NOT EXISTS public.presentations (id SERIAL NOT NULL, data jsonb NOT NULL,  CONSTRAINT presentation_pkey PRIMARY KEY (id))"
-    )
-    await conn.execute(
-        "CREATE TABLE IF NOT EXISTS public.archived_presentations (id SERIAL NOT NULL, data jsonb NOT NULL, CONSTRAINT archived_presentation_pkey PRIMARY KEY (id))"
-    )
-    await conn.execute(
-        "CREATE TABLE IF NOT EXISTS public.folders (name VARCHAR NOT NULL, PRIMARY KEY (name))"
-    )
+    await migrations.migrate(conn)
 
     await conn.execute(f"DELETE from presentations;")
     await conn.execute(f"DELETE from archived_presentations;")
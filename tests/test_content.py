@@ -120,6 +120,29 @@ async def test_get_image(testing_backend):
     )  # not 403 as '../' is handled by aiohttp.web.static
 
 
+@pytest.mark.asyncio
+async def test_get_image_tiles(testing_backend):
+    payload = {"method": "RequestImage", "id": "1", "params": {"path": "chess.jpg"}}
+    response = await testing_backend.send_ws(payload)
+    tiles_url = response["result"]["tiles"]
+
+    req = requests.get(tiles_url)
+    assert req.status_code == HTTPOk.status_code
+    descriptor = req.json()
+    assert descriptor["Image"]["Size"] == {"Width": "1000", "Height": "1000"}
+    assert descriptor["MaxLevel"] == 10
+
+    req = requests.get(f"{descriptor['Image']['Url']}10/3_3.jpg")
+    img = cv2.imdecode(np.frombuffer(req.content, np.uint8), cv2.IMREAD_UNCHANGED)
+    assert img.shape == (1000 - 3 * 256, 1000 - 3 * 256, 3)
+
+    req = requests.get(f"{descriptor['Image']['Url']}10/4_4.jpg")
+    assert req.status_code == HTTPNotFound.status_code
+
+    req = requests.get(f"{config.CONTENT_URL}/tiles/file.pdf")
+    assert req.status_code == HTTPBadRequest.status_code
+
+
 @pytest.mark.asyncio
 async def test_request_image_error(testing_backend):
     payload = {
@@ -176,6 +199,14 @@ async def test_get_pdf_thumbnail(testing_backend):
     img = cv2.imdecode(np.frombuffer(req.content, np.uint8), cv2.IMREAD_UNCHANGED)
     assert img.shape == (256, 181, 3)  # Aspect ratio of A4
 
+    req = requests.get(thumbnail_url + "?page=0&width=70&height=50&mode=fit")
+    img = cv2.imdecode(np.frombuffer(req.content, np.uint8), cv2.IMREAD_UNCHANGED)
+    assert img.shape == (50, 35, 3)
+
+    # Single page document
+    req = requests.get(thumbnail_url + "?page=1")
+    assert req.status_code == HTTPBadRequest.status_code
+
 
 @pytest.mark.asyncio
 async def test_get_pdf_thumbnail_with_size_constraint(testing_backend):
@@ -324,16 +355,19 @@ async def test_search(testing_backend):
     assert isinstance(dirs, list)
     assert len(dirs) == 2
 
-    payload = {"method": "SearchResult", "id": "1", "params": {"searchId": search_id_2}}
+    # only new matches since the cursor
+    payload["params"]["cursor"] = response["result"]["cursor"]
     response = await testing_backend.send_ws(payload)
-    assert (
-        response["error"]["message"]
-        == f"search id {search_id_2} has not been yet created"
-    )
+    assert response["result"]["done"]
+    assert response["result"]["directories"] == []
 
+    # finished results are reused
     payload = {"method": "Search", "id": "1", "params": {"name": "folder"}}
     response = await testing_backend.send_ws(payload)
-    search_id_2 = response["result"]["searchId"]
+    assert response["result"]["searchId"] == search_id_2
+    payload = {"method": "SearchResult", "id": "1", "params": {"searchId": search_id_2}}
+    response = await testing_backend.send_ws(payload)
+    assert len(response["result"]["directories"]) == 2
 
     time.sleep(
         config.SEARCH_FS_KEEP_FINISHED_INTERVAL + config.SEARCH_FS_PURGE_LOOP_INTERVAL
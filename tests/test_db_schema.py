@@ -0,0 +1,166 @@
+from unittest.mock import patch
+
+import pytest
+from asyncpg import connect
+
+from veedrive import config
+from veedrive.presentation import migrations, pg_connector
+
+
+def get_index_names(plan):
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for subplan in plan.get("Plans", []):
+        names |= get_index_names(subplan)
+    return names
+
+
+async def connect_db():
+    conn = await connect(
+        database=config.DB_NAME,
+        user=config.DB_USERNAME,
+        host=config.DB_HOST,
+        password=config.DB_PASSWORD,
+    )
+    await pg_connector.init_connection(conn)
+    return conn
+
+
+class SingleConnectionPool:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def acquire(self, timeout=None):
+        return self.connection
+
+    async def release(self, connection):
+        pass
+
+
+async def explain(query, *args):
+    conn = await connect_db()
+    try:
+        # test tables are tiny, sequential scans would always win
+        await conn.execute("SET enable_seqscan = off")
+        result = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+        return result[0]["Plan"]
+    finally:
+        await conn.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query, args, index",
+    [
+        (
+            pg_connector.GET_PRESENTATION_BY_ID,
+            ["1509d5ec-163f-4a79-8942-4a8b74dbd438"],
+            "presentations_presentation_id_key",
+        ),
+        (
+            pg_connector.GET_PRESENTATION_BY_NAME,
+            ["My presentation", "folder1"],
+            "presentations_folder_name_key",
+        ),
+        (
+            pg_connector.GET_PRESENTATION_VERSIONS,
+            [10, "1509d5ec-163f-4a79-8942-4a8b74dbd438"],
+            "archived_presentations_presentation_id_idx",
+        ),
+        (
+            pg_connector.GET_PRESENTATION_VERSIONS_AFTER,
+            [10, "1509d5ec-163f-4a79-8942-4a8b74dbd438", 10],
+            "archived_presentations_presentation_id_idx",
+        ),
+        (
+            pg_connector.GET_PRESENTATION_VERSION,
+            [10],
+            "archived_presentation_pkey",
+        ),
+        (
+            pg_connector.GET_PRESENTATIONS_TO_COMPACT,
+            [10],
+            "archived_presentations_uncompacted_idx",
+        ),
+        (
+            pg_connector.LOCK_ARCHIVED_VERSIONS,
+            ["1509d5ec-163f-4a79-8942-4a8b74dbd438"],
+            "archived_presentations_presentation_id_idx",
+        ),
+        (
+            pg_connector.LIST_PRESENTATIONS,
+            [10, "folder1"],
+            "presentations_folder_saved_at_idx",
+        ),
+        (
+            pg_connector.LIST_PRESENTATIONS_AFTER,
+            [10, "folder1", "2022-09-01", 10],
+            "presentations_folder_saved_at_idx",
+        ),
+        (
+            pg_connector.LIST_PRESENTATIONS_WITHOUT_FOLDER,
+            [10],
+            "presentations_folder_saved_at_idx",
+        ),
+        (
+            pg_connector.LIST_PRESENTATIONS_WITHOUT_FOLDER_AFTER,
+            [10, "2022-09-01", 10],
+            "presentations_folder_saved_at_idx",
+        ),
+    ],
+)
+async def test_queries_use_indexes(setup_db, query, args, index):
+    plan = await explain(query, *args)
+    assert index in get_index_names(plan)
+    if "ORDER BY" in query:
+        # rows come sorted from the index
+        assert plan["Node Type"] != "Sort"
+        assert all(p["Node Type"] != "Sort" for p in plan.get("Plans", []))
+
+
+@pytest.mark.asyncio
+async def test_compaction_of_versions_archived_before_migration():
+    presentation_id = "1509d5ec-163f-4a79-8942-4a8b74dbd438"
+    conn = await connect_db()
+    try:
+        # a database left at the schema preceding archiving times
+        await conn.execute("DROP SCHEMA IF EXISTS legacy_archive CASCADE")
+        await conn.execute("CREATE SCHEMA legacy_archive")
+        await conn.execute("SET search_path TO legacy_archive")
+        await migrations.migrate(conn, migrations.MIGRATIONS[:5])
+        await conn.executemany(
+            "INSERT INTO archived_presentations (data) VALUES ($1)",
+            [
+                ({"id": presentation_id, "name": "a", "savedAt": saved_at},)
+                for saved_at in (
+                    "2022-09-01T10:00:00",
+                    "2022-09-01T12:00:00",
+                    "draft",
+                    "2022-09-02T10:00:00",
+                    "2022-09-03T10:00:00",
+                )
+            ],
+        )
+        await migrations.migrate(conn)
+        archived_at = await conn.fetch(
+            "SELECT archived_at FROM archived_presentations ORDER BY id"
+        )
+        assert archived_at[0][0].year == 2022
+        assert archived_at[2][0] is None
+
+        connector = pg_connector.PgConnector()
+        connector.pool = SingleConnectionPool(conn)
+        with patch.multiple(config, ARCHIVE_KEEP_LAST=2, ARCHIVE_THIN_PERIOD=86400):
+            assert await connector.compact_archive(presentation_id) == (4, 1)
+        saved_at = await conn.fetch(
+            "SELECT saved_at FROM archived_presentations ORDER BY id"
+        )
+        # thinned to the last version of a day, the undated one is kept
+        assert [row[0] for row in saved_at] == [
+            "2022-09-01T12:00:00",
+            "draft",
+            "2022-09-02T10:00:00",
+            "2022-09-03T10:00:00",
+        ]
+    finally:
+        await conn.execute("DROP SCHEMA IF EXISTS legacy_archive CASCADE")
+        await conn.close()
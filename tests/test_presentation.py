@@ -1,6 +1,13 @@
+import asyncio
+import json
+from unittest.mock import patch
+
 import pytest
+import websockets
+from asyncpg import connect
 
 from veedrive import config
+from veedrive.presentation import pg_connector
 
 presentation_test_id = "1509d5ec-163f-4a79-8942-4a8b74dbd438"
 presentation_in_folder_id = "2783a682-e79f-4433-930d-1924f205a818"
@@ -75,6 +82,32 @@ async def test_save_and_load_presentation(testing_backend, setup_db):
     assert response_load_1["result"]["name"] == "My presentation in folder"
 
 
+@pytest.mark.asyncio
+async def test_saving_presentation_with_existing_name(testing_backend, setup_db):
+    request_payload = {
+        "method": "SavePresentation",
+        "id": "1",
+        "params": {
+            "id": "5a0f4b5c-3f8e-4b7e-9d0c-6f1de8a4b2c1",
+            "name": "My better presentation",
+        },
+    }
+    response = await testing_backend.send_ws(request_payload)
+    assert response["error"]["code"] == config.PRESENTATION_NAME_CONFLICT
+
+    # same name in another folder is fine
+    request_payload["params"]["folder"] = "folder2"
+    response = await testing_backend.send_ws(request_payload)
+    assert isinstance(response["result"], str)
+
+    request_payload = {
+        "method": "DeletePresentation",
+        "id": "2",
+        "params": {"id": "5a0f4b5c-3f8e-4b7e-9d0c-6f1de8a4b2c1"},
+    }
+    await testing_backend.send_ws(request_payload)
+
+
 @pytest.mark.asyncio
 async def test_listing_presentations(testing_backend, setup_db):
     request_payload = {
@@ -101,6 +134,65 @@ async def test_listing_presentations(testing_backend, setup_db):
     assert response["result"]["results"][0]["name"] == "My presentation in folder"
 
 
+@pytest.mark.asyncio
+async def test_listing_presentations_by_page(testing_backend, setup_db):
+    ids = [
+        "8d6c0f3e-5b1a-4c8e-9f2d-0a1b2c3d4e01",
+        "8d6c0f3e-5b1a-4c8e-9f2d-0a1b2c3d4e02",
+        "8d6c0f3e-5b1a-4c8e-9f2d-0a1b2c3d4e03",
+    ]
+    for i, presentation_id in enumerate(ids):
+        await testing_backend.send_ws(
+            {
+                "method": "SavePresentation",
+                "id": "1",
+                "params": {
+                    "id": presentation_id,
+                    "name": f"Paged presentation {i}",
+                    "folder": "paged",
+                    "savedAt": f"2022-09-0{i + 1}T00:00:00",
+                },
+            }
+        )
+
+    listed = []
+    cursor = None
+    while True:
+        params = {"folder": "paged", "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = await testing_backend.send_ws(
+            {"method": "ListPresentations", "id": "1", "params": params}
+        )
+        assert response["result"]["total"] == 3
+        assert set(response["result"]["results"][0]) == {
+            "id",
+            "name",
+            "createdAt",
+            "updatedAt",
+            "savedAt",
+        }
+        listed += [p["id"] for p in response["result"]["results"]]
+        cursor = response["result"]["next_cursor"]
+        if not cursor:
+            break
+    assert listed == ids[::-1]
+
+    response = await testing_backend.send_ws(
+        {"method": "ListPresentations", "id": "1", "params": {"cursor": "invalid"}}
+    )
+    assert response["error"]["code"] == config.MALFORMED_REQUEST
+
+    for presentation_id in ids:
+        await testing_backend.send_ws(
+            {
+                "method": "DeletePresentation",
+                "id": "1",
+                "params": {"id": presentation_id},
+            }
+        )
+
+
 @pytest.mark.asyncio
 async def test_listing_presentation_versions(testing_backend, setup_db):
     request_payload = {
@@ -113,9 +205,166 @@ async def test_listing_presentation_versions(testing_backend, setup_db):
     response_load = await testing_backend.send_ws(request_payload)
 
     assert "result" in response_load
-    result_list = response_load["result"]
+    result_list = response_load["result"]["results"]
     assert result_list[0]["id"] == presentation_test_id
     assert result_list[len(result_list) - 1]["id"] == presentation_test_id
+    assert result_list[0]["size"] > 0
+    assert "data" not in result_list[0]
+
+    request_payload = {
+        "method": "GetPresentationVersion",
+        "id": "2",
+        "params": {"archive_id": result_list[0]["archive_id"]},
+    }
+    response_load = await testing_backend.send_ws(request_payload)
+    assert response_load["result"]["id"] == presentation_test_id
+    assert response_load["result"]["name"] == "My presentation"
+
+    request_payload["params"]["archive_id"] = -1
+    response_load = await testing_backend.send_ws(request_payload)
+    assert response_load["error"]["code"] == config.PRESENTATION_NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_compacted_versions(testing_backend, setup_db):
+    for i in range(6):
+        payload = {
+            "method": "SavePresentation",
+            "id": "1",
+            "params": {
+                "id": presentation_test_id,
+                "name": "My presentation",
+                "savedAt": f"2022-09-0{i + 1}",
+                "windows": [
+                    {"uri": f"image{w}.png", "x": w, "y": 0, "width": 100}
+                    for w in range(20)
+                ],
+            },
+        }
+        await testing_backend.send_ws(payload)
+
+    async def get_versions():
+        request_payload = {
+            "method": "PresentationVersions",
+            "id": "1",
+            "params": {"id": presentation_test_id},
+        }
+        versions = []
+        for version in (await testing_backend.send_ws(request_payload))["result"][
+            "results"
+        ]:
+            request_payload = {
+                "method": "GetPresentationVersion",
+                "id": "2",
+                "params": {"archive_id": version["archive_id"]},
+            }
+            response_load = await testing_backend.send_ws(request_payload)
+            versions.append((version, response_load["result"]))
+        return versions
+
+    versions = await get_versions()
+    connector = await pg_connector.create_pg_connector()
+    try:
+        with patch.multiple(config, ARCHIVE_SNAPSHOT_INTERVAL=3, ARCHIVE_KEEP_LAST=4):
+            await connector.compact_archive(presentation_test_id)
+    finally:
+        await connector.close()
+
+    # the last versions and the most recent older one are kept
+    compacted_versions = await get_versions()
+    assert len(compacted_versions) == 5
+    assert [data for _, data in compacted_versions] == [
+        data for _, data in versions[:5]
+    ]
+    assert sum(metadata["size"] for metadata, _ in compacted_versions) < sum(
+        metadata["size"] for metadata, _ in versions[:5]
+    )
+
+
+@pytest.mark.asyncio
+async def test_cached_presentation_is_invalidated(testing_backend, setup_db):
+    request_payload = {
+        "method": "GetPresentation",
+        "id": "1",
+        "params": {"id": presentation_test_id},
+    }
+    response_load = await testing_backend.send_ws(request_payload)
+    assert response_load["result"]["name"] == "My presentation"
+
+    # changed by another instance
+    conn = await connect(
+        database=config.DB_NAME,
+        user=config.DB_USERNAME,
+        host=config.DB_HOST,
+        password=config.DB_PASSWORD,
+    )
+    try:
+        await conn.execute(
+            'UPDATE presentations SET data = data || \'{"name": "Renamed"}\' '
+            "WHERE presentation_id = $1",
+            presentation_test_id,
+        )
+    finally:
+        await conn.close()
+
+    for _ in range(20):
+        response_load = await testing_backend.send_ws(request_payload)
+        if response_load["result"]["name"] == "Renamed":
+            break
+        await asyncio.sleep(0.05)
+    assert response_load["result"]["name"] == "Renamed"
+
+
+@pytest.mark.asyncio
+async def test_subscriptions(testing_backend, setup_db):
+    presentation_id = "6f1b4e2a-0c55-4a0b-9a52-0d5c6fbbbd51"
+    async with websockets.connect(
+        f"ws://{config.DEFAULT_HOST}:{config.DEFAULT_PORT}/ws"
+    ) as websocket:
+        await websocket.send(
+            json.dumps(
+                {
+                    "method": "SubscribeFolder",
+                    "id": "1",
+                    "params": {"folder": "subscribed"},
+                }
+            )
+        )
+        subscription = json.loads(await websocket.recv())["result"]["subscription"]
+
+        # saved through another connection
+        for folder in ("other", "subscribed"):
+            payload = {
+                "method": "SavePresentation",
+                "id": "2",
+                "params": {
+                    "id": presentation_id,
+                    "name": "Subscribed",
+                    "folder": folder,
+                    "savedAt": folder,
+                },
+            }
+            await testing_backend.send_ws(payload)
+        await testing_backend.send_ws(
+            {
+                "method": "DeletePresentation",
+                "id": "3",
+                "params": {"id": presentation_id},
+            }
+        )
+
+        notifications = [
+            json.loads(await asyncio.wait_for(websocket.recv(), 2)) for _ in range(2)
+        ]
+    assert [n["method"] for n in notifications] == ["PresentationChanged"] * 2
+    assert notifications[0]["params"] == {
+        "subscription": subscription,
+        "id": presentation_id,
+        "folder": "subscribed",
+        "savedAt": "subscribed",
+        "action": "saved",
+    }
+    assert notifications[1]["params"]["action"] == "deleted"
 
 
 @pytest.mark.asyncio
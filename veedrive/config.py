@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import pytz
 
@@ -12,6 +13,29 @@ SANDBOX_PATH = os.path.normpath(
     os.getenv("VEEDRIVE_MEDIA_PATH", default_sandbox_folder)
 )
 THUMBNAIL_CACHE_PATH = os.path.join(SANDBOX_PATH, "cache")
+SCALED_CACHE_PATH = os.path.join(THUMBNAIL_CACHE_PATH, "scaled")
+TILES_CACHE_PATH = os.path.join(THUMBNAIL_CACHE_PATH, "tiles")
+TILE_SIZE = int(os.getenv("VEEDRIVE_TILE_SIZE", 256))
+# bigger JPEG images are tiled at reduced resolution, other images are rejected
+TILES_MAX_PIXELS = int(os.getenv("VEEDRIVE_TILES_MAX_MEGAPIXELS", 256)) * 1024 * 1024
+TILES_CACHE_MAX_SIZE = (
+    int(os.getenv("VEEDRIVE_TILES_CACHE_MAX_SIZE_MB", 10240)) * 1024 * 1024
+)
+TILES_CACHE_PURGE_LOOP_INTERVAL = int(
+    os.getenv("VEEDRIVE_TILES_CACHE_PURGE_LOOP_INTERVAL", 600)
+)
+SCALED_CACHE_BUCKETS = sorted(
+    int(size)
+    for size in os.getenv("VEEDRIVE_SCALED_CACHE_BUCKETS", "512,1024,2048,4096").split(
+        ","
+    )
+)
+SCALED_CACHE_MAX_SIZE = (
+    int(os.getenv("VEEDRIVE_SCALED_CACHE_MAX_SIZE_MB", 10240)) * 1024 * 1024
+)
+SCALED_CACHE_PURGE_LOOP_INTERVAL = int(
+    os.getenv("VEEDRIVE_SCALED_CACHE_PURGE_LOOP_INTERVAL", 600)
+)
 
 STATIC_CONTENT_URL = os.getenv(
     "VEEDRIVE_STATIC_CONTENT_URL", f"http://{DEFAULT_HOST}:{DEFAULT_PORT}/static"
@@ -24,14 +48,69 @@ DB_HOST = os.getenv("VEEDRIVE_DB_HOST", "127.0.0.1")
 DB_USERNAME = os.getenv("VEEDRIVE_DB_USERNAME")
 DB_PASSWORD = os.getenv("VEEDRIVE_DB_PASSWORD")
 DB_PORT = os.getenv("VEEDRIVE_DB_PORT", 27017)
+DB_POOL_MIN_SIZE = int(os.getenv("VEEDRIVE_DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("VEEDRIVE_DB_POOL_MAX_SIZE", 10))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(
+    os.getenv("VEEDRIVE_DB_POOL_MAX_INACTIVE_LIFETIME", 300)
+)
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("VEEDRIVE_DB_POOL_ACQUIRE_TIMEOUT", 10))
+DB_CONNECT_TIMEOUT = float(os.getenv("VEEDRIVE_DB_CONNECT_TIMEOUT", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("VEEDRIVE_DB_COMMAND_TIMEOUT", 10))
+DB_AUTO_MIGRATE = bool(int(os.getenv("VEEDRIVE_DB_AUTO_MIGRATE", 1)))
+LIST_PRESENTATIONS_MAX_LIMIT = int(
+    os.getenv("VEEDRIVE_LIST_PRESENTATIONS_MAX_LIMIT", 1000)
+)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("VEEDRIVE_DB_STATEMENT_CACHE_SIZE", 100))
+ARCHIVE_SNAPSHOT_INTERVAL = int(os.getenv("VEEDRIVE_ARCHIVE_SNAPSHOT_INTERVAL", 10))
+ARCHIVE_KEEP_LAST = int(os.getenv("VEEDRIVE_ARCHIVE_KEEP_LAST", 50))
+ARCHIVE_THIN_PERIOD = int(os.getenv("VEEDRIVE_ARCHIVE_THIN_PERIOD", 24 * 3600))
+ARCHIVE_COMPACTION_LOOP_INTERVAL = int(
+    os.getenv("VEEDRIVE_ARCHIVE_COMPACTION_LOOP_INTERVAL", 300)
+)
+ARCHIVE_COMPACTION_BATCH_SIZE = 100
+PRESENTATION_CACHE_SIZE = (
+    int(os.getenv("VEEDRIVE_PRESENTATION_CACHE_SIZE_MB", 64)) * 1024 * 1024
+)
+PRESENTATION_CACHE_TTL = float(os.getenv("VEEDRIVE_PRESENTATION_CACHE_TTL", 2))
+PRESENTATION_CACHE_KEEPALIVE_INTERVAL = float(
+    os.getenv("VEEDRIVE_PRESENTATION_CACHE_KEEPALIVE_INTERVAL", 30)
+)
+SUBSCRIPTION_MAX_PENDING = int(os.getenv("VEEDRIVE_SUBSCRIPTION_MAX_PENDING", 100))
 
 SEARCH_FS_KEEP_FINISHED_INTERVAL = int(
     os.getenv("VEEDRIVE_SEARCH_FS_KEEP_FINISHED_INTERVAL", 10)
 )
 SEARCH_FS_THREAD_TIMEOUT = int(os.getenv("VEEDRIVE_SEARCH_FS_THREAD_TIMEOUT", 600))
+# searches running at a time, others are queued
+SEARCH_MAX_CONCURRENT = int(os.getenv("VEEDRIVE_SEARCH_MAX_CONCURRENT", 4))
+SEARCH_MAX_QUEUED = int(os.getenv("VEEDRIVE_SEARCH_MAX_QUEUED", 32))
+# unfinished searches per websocket connection
+SEARCH_MAX_PER_CLIENT = int(os.getenv("VEEDRIVE_SEARCH_MAX_PER_CLIENT", 4))
+SEARCH_MAX_RESULTS = int(os.getenv("VEEDRIVE_SEARCH_MAX_RESULTS", 10000))
+# threads listing directories concurrently per search
+SEARCH_FS_THREADS = int(os.getenv("VEEDRIVE_SEARCH_FS_THREADS", 8))
 SEARCH_FS_PURGE_LOOP_INTERVAL = int(
     os.getenv("VEEDRIVE_SEARCH_FS_PURGE_LOOP_INTERVAL", 60)
 )
+# interval between the batches of matches pushed to clients, in seconds
+SEARCH_PUSH_INTERVAL = float(os.getenv("VEEDRIVE_SEARCH_PUSH_INTERVAL", 0.2))
+# on a local disk of each instance: SQLite locking and WAL journals are not
+# supported on network file systems such as the NFS share of the sandbox
+SEARCH_INDEX_PATH = os.getenv(
+    "VEEDRIVE_SEARCH_INDEX_PATH",
+    os.path.join(tempfile.gettempdir(), "veedrive", "search_index.sqlite"),
+)
+# 0 disables the index, searches crawl the file system
+SEARCH_INDEX_REFRESH_INTERVAL = int(
+    os.getenv("VEEDRIVE_SEARCH_INDEX_REFRESH_INTERVAL", 300)
+)
+
+SERVE_CACHED_FILES = bool(int(os.getenv("VEEDRIVE_SERVE_CACHED_FILES", 0)))
+CACHED_FILES_MAX_AGE = int(os.getenv("VEEDRIVE_CACHED_FILES_MAX_AGE", 86400))
+
+WORKER_POOL_SIZE = int(os.getenv("VEEDRIVE_WORKER_POOL_SIZE", os.cpu_count() or 1))
+VIDEO_THUMBNAIL_FORMAT = os.getenv("VEEDRIVE_VIDEO_THUMBNAIL_FORMAT", "gif")
+MEMORY_CACHE_SIZE = int(os.getenv("VEEDRIVE_MEMORY_CACHE_SIZE_MB", 256)) * 1024 * 1024
 
 LOG_LEVEL = os.getenv("VEEDRIVE_LOG_LEVEL", "INFO").upper()
 ENVIRONMENT = os.getenv("VEEDRIVE_ENVIRONMENT")
@@ -65,10 +144,25 @@ SUPPORTED_THUMBNAIL_EXTENSIONS = (
 FIT_TRANSFORM_IMAGE = "fit"
 FILL_TRANSFORM_IMAGE = "fill"
 PRESERVE_ASPECT = "preserve"
+SCALING_MODES = [FIT_TRANSFORM_IMAGE, FILL_TRANSFORM_IMAGE, PRESERVE_ASPECT]
+
+GIF_VIDEO_THUMBNAIL = "gif"
+WEBP_VIDEO_THUMBNAIL = "webp"
+MP4_VIDEO_THUMBNAIL = "mp4"
+JPG_VIDEO_THUMBNAIL = "jpg"
+VIDEO_THUMBNAIL_CONTENT_TYPES = {
+    GIF_VIDEO_THUMBNAIL: "image/gif",
+    WEBP_VIDEO_THUMBNAIL: "image/webp",
+    MP4_VIDEO_THUMBNAIL: "video/mp4",
+    JPG_VIDEO_THUMBNAIL: "image/jpeg",
+}
 
 MALFORMED_REQUEST = 0
 PERMISSION_DENIED = 1
 PATH_NOT_FOUND = 2
 WRONG_FILE_TYPE_REQUESTED = 5
+PRESENTATION_NAME_CONFLICT = 10
 PRESENTATION_NOT_FOUND = 11
 PRESENTATION_DB_ISSUE = 12
+SUBSCRIPTION_NOT_FOUND = 14
+SEARCH_LIMIT_REACHED = 71
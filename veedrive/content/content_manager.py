@@ -7,12 +7,20 @@ import cv2
 import numpy
 
 from .. import config
-from ..utils.asynchro import run_async
-from . import utils
-from .image import generate_pdf, resize_image
+from ..utils import metrics
+from ..utils.asynchro import SingleFlight, run_async
+from ..utils.cache import LRUCache
+from . import pyramid, scaled_cache, utils
+from .image import generate_pdf, is_fitting, read_image_size, resize_image
 from .utils import sanitize_path, validate_path
 from .video import get_video_thumbnail
 
+scaled_image_cache = LRUCache(config.MEMORY_CACHE_SIZE)
+metrics.register("scaled_image_cache", scaled_image_cache.get_stats)
+
+scaled_image_generations = SingleFlight()
+pyramid_generations = SingleFlight()
+
 
 @sanitize_path
 def get_image_urls(path, client_size=None):
@@ -29,6 +37,8 @@ def get_image_urls(path, client_size=None):
     response = _create_file_url_response(path)
     if client_size:
         response = _add_scaled_url(response, path, client_size)
+    if os.path.splitext(path)[1].lower() in config.OPTIMIZABLE_IMAGE_EXTENSIONS:
+        response["tiles"] = f"{config.CONTENT_URL}/tiles/{path}"
 
     return response
 
@@ -65,28 +75,199 @@ async def get_scaled_image(path, client_width, client_height, scaling_mode="fit"
     """
     absolute_path = os.path.join(config.SANDBOX_PATH, path)
     validate_path(absolute_path)
+    _validate_scaling_mode(scaling_mode)
     for ext in config.SUPPORTED_IMAGE_EXTENSIONS:
         if os.path.splitext(path)[1] == ext:
-            scaled_image, file_format = await run_async(
-                resize_image,
-                absolute_path,
-                client_width,
-                client_height,
-                scaling_mode,
-                ext,
+            cache_key = ("scaled", path, client_width, client_height, scaling_mode)
+            cached = _get_from_memory_cache(cache_key, absolute_path)
+            if cached:
+                return cached
+
+            bucket = scaled_cache.snap_to_bucket(
+                client_width, client_height, scaling_mode
             )
+            if bucket:
+                # derive the requested size from the (much smaller) cached bucket size
+                cache_file = await _get_scaled_cache_file(
+                    path, ext, *bucket, scaling_mode
+                )
+                source_path = os.path.join(config.SCALED_CACHE_PATH, cache_file)
+            else:
+                source_path = absolute_path
+
+            if bucket and _is_scaled_as_is(
+                source_path, bucket, client_width, client_height, scaling_mode
+            ):
+                with open(source_path, "rb") as f:
+                    scaled_image = f.read()
+                file_format = _get_encoded_format(ext)
+            else:
+                scaled_image, file_format = await run_async(
+                    resize_image,
+                    source_path,
+                    client_width,
+                    client_height,
+                    scaling_mode,
+                    ext,
+                )
+
+            return _put_in_memory_cache(
+                cache_key, absolute_path, (scaled_image, "image/" + file_format)
+            )
+
+
+@sanitize_path
+async def get_scaled_image_cache_file(
+    path, client_width, client_height, scaling_mode="fit"
+):
+    """Get a scaled image stored in the scaled images cache.
+    Only requests matching a configured bucket size, or fit requests resulting
+    in the image cached for a bucket, can be served from the cache as is.
+
+    :param path: relative to sandboxpath path of object
+    :type path: str
+    :param client_width: width of client's display
+    :type client_width: int
+    :param client_height: height of client's display
+    :type client_height: int
+    :param scaling_mode: mode to scale an image, see `get_scaled_image`
+    :type scaling_mode: str
+    :return: path of the scaled image relative to the scaled images cache folder
+        or None if it cannot be served from the cache
+    :rtype: str
+    """
+    absolute_path = os.path.join(config.SANDBOX_PATH, path)
+    validate_path(absolute_path)
+    _validate_scaling_mode(scaling_mode)
+    ext = os.path.splitext(path)[1]
+    if ext not in config.SUPPORTED_IMAGE_EXTENSIONS:
+        return None
+    bucket = scaled_cache.snap_to_bucket(client_width, client_height, scaling_mode)
+    if bucket is None or (
+        bucket != (client_width, client_height)
+        and scaling_mode != config.FIT_TRANSFORM_IMAGE
+    ):
+        return None
+    cache_file = await _get_scaled_cache_file(path, ext, *bucket, scaling_mode)
+    if not _is_scaled_as_is(
+        os.path.join(config.SCALED_CACHE_PATH, cache_file),
+        bucket,
+        client_width,
+        client_height,
+        scaling_mode,
+    ):
+        return None
+    return cache_file
+
+
+def get_scaled_image_content_type(path):
+    return "image/" + _get_encoded_format(os.path.splitext(path)[1])
+
+
+def get_thumbnail_content_type(path, thumbnail_format=None):
+    if os.path.splitext(path)[1].lower() in config.SUPPORTED_VIDEO_EXTENSIONS:
+        return config.VIDEO_THUMBNAIL_CONTENT_TYPES[
+            thumbnail_format or config.VIDEO_THUMBNAIL_FORMAT
+        ]
+    return "image/jpeg"
+
+
+def get_thumbnail_format(path, requested_format=None, accept=None):
+    """Choose the format of a thumbnail. Only videos have several thumbnail formats,
+    an explicitly requested format wins over the client's Accept header.
+
+    :param path: relative to sandboxpath path of object
+    :type path: str
+    :param requested_format: explicitly requested format, defaults to None
+    :type requested_format: str, optional
+    :param accept: value of the client's Accept header, defaults to None
+    :type accept: str, optional
+    :return: format of a video thumbnail, None for other objects
+    :rtype: str
+    """
+    if os.path.splitext(path)[1].lower() not in config.SUPPORTED_VIDEO_EXTENSIONS:
+        if requested_format not in (None, config.JPG_VIDEO_THUMBNAIL):
+            raise ValueError("Formats are supported only for videos")
+        return None
+    if requested_format:
+        if requested_format not in config.VIDEO_THUMBNAIL_CONTENT_TYPES:
+            raise ValueError(f"Unsupported thumbnail format {requested_format}")
+        return requested_format
+
+    if accept:
+        # wildcards are left to the configured default format
+        content_types = config.VIDEO_THUMBNAIL_CONTENT_TYPES
+        formats_by_type = {content_types[f]: f for f in content_types}
+        for media_range in _parse_accept(accept):
+            if media_range in formats_by_type:
+                return formats_by_type[media_range]
+    return config.VIDEO_THUMBNAIL_FORMAT
+
+
+def cache_scaled_image(path, box_width, box_height, scaling_mode, ext):
+    cache_file = os.path.join(
+        config.SCALED_CACHE_PATH,
+        scaled_cache.get_cache_file(path, box_width, box_height, scaling_mode),
+    )
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    scaled_image = resize_image(
+        os.path.join(config.SANDBOX_PATH, path),
+        box_width,
+        box_height,
+        scaling_mode,
+        ext,
+    )
+    _save_image(scaled_image, cache_file, path)
+    return cache_file
 
-            return scaled_image, "image/" + file_format
 
+@sanitize_path
+async def get_cached_thumbnail(
+    path, width, height, scaling_mode, page=0, thumbnail_format=None
+):
+    """Get a thumbnail of an object, generated in the worker pool and
+    kept in the in-memory cache
 
-def cache_thumbnail(file, cache_folder):
-    dir_hash, filename_hash = utils.get_dir_file_hash_pair(file)
-    thumbnail_path = Path(os.path.join(cache_folder, dir_hash, filename_hash))
+    :param path: relative to sandboxpath path of object
+    :type path: str
+    :param width: width of a sizebox
+    :type width: int
+    :param height: height of a sizebox
+    :type height: int
+    :param scaling_mode: mode to generate a thumbnail, see `get_thumbnail`
+    :type scaling_mode: str
+    :param page: page of a document, defaults to 0
+    :type page: int
+    :param thumbnail_format: format of a video thumbnail, see `get_thumbnail`
+    :type thumbnail_format: str, optional
+    :return: a thumbnail and its http content-type
+    :rtype: tuple(binary, str)
+    """
+    absolute_path = os.path.join(config.SANDBOX_PATH, path)
+    validate_path(absolute_path)
+    cache_key = ("thumb", path, width, height, scaling_mode, page, thumbnail_format)
+    cached = _get_from_memory_cache(cache_key, absolute_path)
+    if cached:
+        return cached
+
+    thumbnail = await run_async(
+        get_thumbnail, path, width, height, scaling_mode, page, thumbnail_format
+    )
+    return _put_in_memory_cache(cache_key, absolute_path, thumbnail)
+
+
+def cache_thumbnail(file, cache_folder, page=0, thumbnail_format=None):
+    thumbnail_format = get_thumbnail_format(file, thumbnail_format)
+    thumbnail_path = Path(
+        os.path.join(
+            cache_folder, utils.get_thumbnail_cache_file(file, page, thumbnail_format)
+        )
+    )
     if os.path.exists(thumbnail_path):
         logging.info(f"[INFO] Skipping thumbnail generation of: {file}")
         raise FileExistsError
     try:
-        thumbnail = get_thumbnail(file)
+        thumbnail = get_thumbnail(file, page=page, thumbnail_format=thumbnail_format)
     except cv2.error as e:
         logging.error(f"[ERROR] opencv issue with {file}, message {str(e)}")
         raise
@@ -99,6 +280,60 @@ def cache_thumbnail(file, cache_folder):
     return thumbnail_path
 
 
+def cache_image_pyramid(file, cache_folder):
+    absolute_path = os.path.join(config.SANDBOX_PATH, file)
+    pyramid_folder = os.path.join(cache_folder, pyramid.get_pyramid_folder(file))
+    if utils.is_cache_fresh(
+        os.path.join(pyramid_folder, pyramid.DESCRIPTOR_FILE), absolute_path
+    ):
+        logging.info(f"[INFO] Skipping image pyramid generation of: {file}")
+        raise FileExistsError
+    try:
+        pyramid.build_pyramid(absolute_path, pyramid_folder)
+    except Exception as e:
+        logging.error(
+            f"[ERROR] issue with {file}, exception {type(e).__name__}, message: {str(e)}"
+        )
+        raise
+    logging.info(f"[INFO] Generated image pyramid of: {file}")
+    return pyramid_folder
+
+
+@sanitize_path
+async def get_image_pyramid(path):
+    """Get Deep Zoom tiles of an image, building them if needed
+
+    :param path: relative to sandboxpath path of the image
+    :type path: str
+    :return: folder of the pyramid, relative to the tiles cache folder
+    :rtype: str
+    """
+    absolute_path = os.path.join(config.SANDBOX_PATH, path)
+    validate_path(absolute_path)
+    file_extension = os.path.splitext(path)[1].lower()
+    if file_extension not in config.OPTIMIZABLE_IMAGE_EXTENSIONS:
+        raise TypeError(f"Extension {file_extension} not supported for tiling")
+
+    pyramid_folder = pyramid.get_pyramid_folder(path)
+    descriptor_file = os.path.join(
+        config.TILES_CACHE_PATH, pyramid_folder, pyramid.DESCRIPTOR_FILE
+    )
+    if not utils.is_cache_fresh(descriptor_file, absolute_path):
+        try:
+            await pyramid_generations.run(
+                pyramid_folder,
+                run_async,
+                cache_image_pyramid,
+                path,
+                config.TILES_CACHE_PATH,
+            )
+        except FileExistsError:
+            pass
+    else:
+        scaled_cache.touch(descriptor_file)
+    return pyramid_folder
+
+
 def optimize_image(file, sandbox_path, cache_folder, box_width, box_height):
 
     original_folder = os.path.dirname(file)
@@ -131,7 +366,9 @@ def optimize_image(file, sandbox_path, cache_folder, box_width, box_height):
 
 
 @sanitize_path
-def get_thumbnail(path, width=256, height=256, scaling_mode="fit"):
+def get_thumbnail(
+    path, width=256, height=256, scaling_mode="fit", page=0, thumbnail_format=None
+):
     """Get a thumbnail of an object (image, video, document)
 
     :param path: relative to sandboxpath path of object
@@ -144,6 +381,11 @@ def get_thumbnail(path, width=256, height=256, scaling_mode="fit"):
         aspect ratio differs from object aspect ratio and may fill sizebox in only one axis.
         'Fill' will fill sizebox in both axis, cropping may be applied, defaults to 'fit'
     :type scaling_mode: str
+    :param page: page of a document to generate a thumbnail of, defaults to 0
+    :type page: int
+    :param thumbnail_format: format of a video thumbnail, 'gif', 'webp' or 'mp4' previews
+        or a 'jpg' poster frame, defaults to config.VIDEO_THUMBNAIL_FORMAT
+    :type thumbnail_format: str, optional
 
     :return: a thumbnail and its http content-type
     :rtype: tuple(binary, str)
@@ -157,6 +399,9 @@ def get_thumbnail(path, width=256, height=256, scaling_mode="fit"):
         raise TypeError(
             f"Extension {file_extension} not supported for thumbnail generation"
         )
+    if page and file_extension not in config.SUPPORTED_DOC_EXTENSIONS:
+        raise ValueError("Pages are supported only for documents")
+    thumbnail_format = get_thumbnail_format(path, thumbnail_format)
 
     if file_extension in config.SUPPORTED_IMAGE_EXTENSIONS:
         thumbnail, image_format = resize_image(
@@ -165,12 +410,14 @@ def get_thumbnail(path, width=256, height=256, scaling_mode="fit"):
         return thumbnail, "image/" + image_format
     if file_extension == ".pdf":
         thumbnail, image_format = generate_pdf(
-            absolute_path, width, height, scaling_mode
+            absolute_path, width, height, scaling_mode, page
         )
         return thumbnail, "image/" + image_format
     if file_extension in config.SUPPORTED_VIDEO_EXTENSIONS:
-        thumbnail = get_video_thumbnail(absolute_path, width, height, scaling_mode)
-        return thumbnail, "image/gif"
+        thumbnail = get_video_thumbnail(
+            absolute_path, width, height, scaling_mode, thumbnail_format
+        )
+        return thumbnail, config.VIDEO_THUMBNAIL_CONTENT_TYPES[thumbnail_format]
 
 
 def _create_file_url_response(path):
@@ -188,6 +435,8 @@ def _create_file_url_response(path):
         "thumbnail": thubmnail_url,
         "size": os.path.getsize(absolute_path),
     }
+    if ext.lower() in config.SUPPORTED_VIDEO_EXTENSIONS:
+        response["poster"] = f"{thubmnail_url}?format={config.JPG_VIDEO_THUMBNAIL}"
     return response
 
 
@@ -203,11 +452,99 @@ def _add_scaled_url(response, path, client_size):
     return response
 
 
+async def _get_scaled_cache_file(path, ext, box_width, box_height, scaling_mode):
+    cache_file = scaled_cache.get_cache_file(path, box_width, box_height, scaling_mode)
+    absolute_cache_file = os.path.join(config.SCALED_CACHE_PATH, cache_file)
+    if not utils.is_cache_fresh(
+        absolute_cache_file, os.path.join(config.SANDBOX_PATH, path)
+    ):
+        await scaled_image_generations.run(
+            cache_file,
+            run_async,
+            cache_scaled_image,
+            path,
+            box_width,
+            box_height,
+            scaling_mode,
+            ext,
+        )
+    scaled_cache.touch(absolute_cache_file)
+    return cache_file
+
+
+def _is_scaled_as_is(cache_file, bucket, box_width, box_height, scaling_mode):
+    """Whether the cached image of a bucket is the scaled image of a box, e.g.
+    a 1024x768 image cached for the 1024x1024 bucket fits a 1024x800 box as is
+    """
+    if bucket == (box_width, box_height):
+        return True
+    if scaling_mode != config.FIT_TRANSFORM_IMAGE:
+        return False
+    size = read_image_size(cache_file)
+    return size is not None and is_fitting(*size, box_width, box_height)
+
+
+def _validate_scaling_mode(scaling_mode):
+    if scaling_mode not in config.SCALING_MODES:
+        raise ValueError(f"Scaling mode {scaling_mode} not supported")
+
+
+def _get_encoded_format(ext):
+    if ext in config.IMAGE_EXTENSIONS_TO_ENCODE_TO_PNG:
+        return "png"
+    return "jpg"
+
+
+def _get_source_signature(absolute_path):
+    stat = os.stat(absolute_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _get_from_memory_cache(cache_key, absolute_path):
+    cached = scaled_image_cache.get(cache_key)
+    if cached is None:
+        return None
+    signature, data = cached
+    if signature != _get_source_signature(absolute_path):
+        # source file changed since the entry has been cached
+        scaled_image_cache.pop(cache_key)
+        return None
+    return data
+
+
+def _put_in_memory_cache(cache_key, absolute_path, data):
+    signature = _get_source_signature(absolute_path)
+    scaled_image_cache.put(cache_key, (signature, data), len(data[0]))
+    return data
+
+
 def _save_image(thumbnail, thumbnail_path, file):
+    # write to a temporary file first so a partially written file is never served
+    tmp_path = f"{thumbnail_path}.{os.getpid()}.tmp"
     try:
         buf = numpy.frombuffer(thumbnail[0], numpy.uint8)
-        buf.tofile(str(thumbnail_path))
+        buf.tofile(tmp_path)
+        os.replace(tmp_path, str(thumbnail_path))
         logging.info(f"[INFO] Generated thumbnail of: {file}")
     except Exception as e:
         logging.error(f"[ERROR] Saving exception: {str(e)} on {file}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         raise
+
+
+def _parse_accept(accept):
+    """Get media ranges of an Accept header, by decreasing quality"""
+    media_ranges = []
+    for position, entry in enumerate(accept.split(",")):
+        media_range, *params = [p.strip() for p in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if media_range and quality > 0:
+            media_ranges.append((-quality, position, media_range.lower()))
+    return [media_range for _, _, media_range in sorted(media_ranges)]
@@ -0,0 +1,374 @@
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from .. import config
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS directories "
+    "(path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, "
+    "parent TEXT NOT NULL, name TEXT NOT NULL, is_dir INTEGER NOT NULL, "
+    "is_link INTEGER NOT NULL, size INTEGER, mtime_ns INTEGER, "
+    "UNIQUE (parent, name))",
+    # time of the last commit of a refresh, which commits while it progresses
+    "CREATE TABLE IF NOT EXISTS refresh_progress "
+    "(id INTEGER PRIMARY KEY CHECK (id = 1), updated_at REAL NOT NULL)",
+]
+# substring matches of names through a trigram index, SQLite >= 3.34, names are
+# scanned with LIKE on older versions
+NAMES_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS entry_names USING fts5"
+    "(name, content='entries', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN "
+    "INSERT INTO entry_names (rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN "
+    "INSERT INTO entry_names (entry_names, rowid, name) "
+    "VALUES ('delete', old.id, old.name); END",
+]
+# sub-directories of an indexed directory
+_CHILD_PATH = "CASE WHEN parent = '.' THEN name ELSE parent || '/' || name END"
+# entries in a subtree, given its path, the path followed by a slash and by the
+# next character, '0', as a range of the index of parents
+_IN_SUBTREE = "(? = '.' OR parent = ? OR (parent >= ? AND parent < ?))"
+# virtual machine instructions between checks of the interruption of a search
+PROGRESS_HANDLER_INSTRUCTIONS = 1000
+# refresh intervals after which an index without refresh progress is not searched
+STALE_INDEX_INTERVALS = 3
+
+refresh_stop_event = threading.Event()
+
+
+def child_path(parent, name):
+    """Relative path of a directory entry, as reported by searches"""
+    return name if parent == "." else os.path.join(parent, name)
+
+
+class FileIndex:
+    """On-disk index of the names, sizes and mtimes of the files and directories
+    of the sandbox, answering searches without crawling it.
+
+    Refreshes only list directories whose mtime changed since they were indexed,
+    so that the size of a file modified in place may be outdated until its
+    directory changes. The cache folder is not indexed.
+
+    :param path: path of the SQLite database
+    :type path: str
+    :param read_only: whether the index is only searched
+    :type read_only: bool, optional
+    """
+
+    def __init__(self, path, read_only=False):
+        if read_only:
+            self.connection = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+            self.has_names_index = bool(
+                self.connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'entry_names'"
+                ).fetchone()
+            )
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # searches read while the index is refreshed
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        try:
+            for statement in NAMES_SCHEMA:
+                self.connection.execute(statement)
+            self.has_names_index = True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Search index without trigram index of names: {e}")
+            self.has_names_index = False
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(self, root, excluded=(), stop_event=None):
+        """Bring the index up to date with the files under root
+
+        :param root: absolute path of the indexed tree
+        :type root: str
+        :param excluded: absolute paths of directories left out of the index
+        :type excluded: list, optional
+        :param stop_event: event interrupting the refresh when set
+        :type stop_event: class: `threading.Event`, optional
+        :return: numbers of visited and listed directories
+        :rtype: tuple
+        """
+        excluded = {os.path.normpath(path) for path in excluded}
+        visited = listed = 0
+        self._commit()
+        last_commit = time.monotonic()
+        stack = ["."]
+        while stack:
+            if stop_event and stop_event.is_set():
+                break
+            relative_path = stack.pop()
+            absolute_path = os.path.normpath(os.path.join(root, relative_path))
+            visited += 1
+            try:
+                mtime_ns = os.stat(absolute_path).st_mtime_ns
+                row = self.connection.execute(
+                    "SELECT mtime_ns FROM directories WHERE path = ?",
+                    (relative_path,),
+                ).fetchone()
+                if row is None or row[0] != mtime_ns:
+                    self._index_directory(
+                        relative_path, absolute_path, mtime_ns, excluded
+                    )
+                    listed += 1
+            except OSError as e:
+                logging.debug(f"Cannot index {absolute_path}: {e}")
+                self._remove_subtree(relative_path)
+                continue
+            stack += [
+                child_path(relative_path, name)
+                for (name,) in self.connection.execute(
+                    "SELECT name FROM entries "
+                    "WHERE parent = ? AND is_dir AND NOT is_link",
+                    (relative_path,),
+                )
+            ]
+            if time.monotonic() - last_commit > 1:
+                # searches see a partially refreshed index
+                self._commit()
+                last_commit = time.monotonic()
+        self._commit()
+        return visited, listed
+
+    def _commit(self):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO refresh_progress (id, updated_at) VALUES (1, ?)",
+            (time.time(),),
+        )
+        self.connection.commit()
+
+    def get_refresh_time(self):
+        """Time of the last progress of a refresh, None if never refreshed"""
+        row = self.connection.execute(
+            "SELECT updated_at FROM refresh_progress"
+        ).fetchone()
+        return row and row[0]
+
+    def _index_directory(self, relative_path, absolute_path, mtime_ns, excluded):
+        entries = {}
+        with os.scandir(absolute_path) as iterator:
+            for entry in iterator:
+                if os.path.normpath(entry.path) in excluded:
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    stat = entry.stat()
+                    entries[entry.name] = (
+                        is_dir,
+                        entry.is_symlink(),
+                        None if is_dir else stat.st_size,
+                        stat.st_mtime_ns,
+                    )
+                except OSError:
+                    # e.g. a broken link
+                    continue
+        indexed = self.connection.execute(
+            "SELECT name, is_dir, is_link, size, mtime_ns FROM entries "
+            "WHERE parent = ?",
+            (relative_path,),
+        ).fetchall()
+        for name, *values in indexed:
+            if tuple(entries.get(name, ())) == tuple(values):
+                del entries[name]
+                continue
+            # removed or changed
+            if values[0]:
+                self._remove_subtree(child_path(relative_path, name))
+            self.connection.execute(
+                "DELETE FROM entries WHERE parent = ? AND name = ?",
+                (relative_path, name),
+            )
+        self.connection.executemany(
+            "INSERT INTO entries (parent, name, is_dir, is_link, size, mtime_ns) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(relative_path, name, *values) for name, values in entries.items()],
+        )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO directories (path, mtime_ns) VALUES (?, ?)",
+            (relative_path, mtime_ns),
+        )
+
+    def _remove_subtree(self, relative_path):
+        subtree_args = _get_subtree_args(relative_path)[1:]
+        self.connection.execute(
+            "DELETE FROM entries WHERE parent = ? OR (parent >= ? AND parent < ?)",
+            subtree_args,
+        )
+        self.connection.execute(
+            "DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)",
+            subtree_args,
+        )
+
+    def search(self, query, relative_path=".", stop_event=None):
+        """Search names in a subtree
+
+        :param query: searched name and filters
+        :type query: class: `SearchQuery`
+        :param relative_path: path of the subtree, relative to the sandbox
+        :type relative_path: str, optional
+        :param stop_event: event interrupting the search when set, which then
+            returns no matches
+        :type stop_event: class: `threading.Event`, optional
+        :return: matching directories and files, the relative paths of subtrees
+            not indexed yet, to be crawled, and whether matches were left out
+            past the maximum number of results
+        :rtype: tuple
+        """
+        if stop_event:
+            # aborts running statements, e.g. scans of all names
+            self.connection.set_progress_handler(
+                stop_event.is_set, PROGRESS_HANDLER_INSTRUCTIONS
+            )
+        try:
+            return self._search(query, relative_path)
+        except sqlite3.OperationalError:
+            if stop_event and stop_event.is_set():
+                return [], [], [], False
+            raise
+        finally:
+            self.connection.set_progress_handler(None, 0)
+
+    def _search(self, query, relative_path):
+        relative_path = os.path.normpath(relative_path)
+        if query.is_excluded(relative_path):
+            return [], [], [], False
+        indexed = self.connection.execute(
+            "SELECT 1 FROM directories WHERE path = ?", (relative_path,)
+        ).fetchone()
+        if not indexed:
+            return [], [], [relative_path], False
+
+        subtree_args = _get_subtree_args(relative_path)
+        if (
+            query.is_substring
+            and query.name.isascii()
+            and not {"%", "_"}.intersection(query.name)
+        ):
+            # LIKE matches ASCII patterns case insensitively, through the trigram
+            # index when available
+            if self.has_names_index and len(query.name) >= 3:
+                names = "id IN (SELECT rowid FROM entry_names WHERE name LIKE ?)"
+            else:
+                names = "name LIKE ?"
+            rows = self.connection.execute(
+                "SELECT parent, name, is_dir, size, mtime_ns FROM entries "
+                f"WHERE {names} AND {_IN_SUBTREE}",
+                (f"%{query.name}%", *subtree_args),
+            )
+        else:
+            self.connection.create_function("matches", 1, query.matches_name)
+            rows = self.connection.execute(
+                "SELECT parent, name, is_dir, size, mtime_ns FROM entries "
+                f"WHERE matches(name) AND {_IN_SUBTREE}",
+                subtree_args,
+            )
+        directories, files = [], []
+        truncated = False
+        for parent, name, is_dir, size, mtime_ns in rows:
+            if is_dir:
+                if query.files_only or query.is_excluded(child_path(parent, name)):
+                    continue
+                if query.filters_mtime() and not query.matches_mtime(mtime_ns / 1e9):
+                    continue
+            elif query.is_excluded(parent) or not query.matches_file(
+                name, size, mtime_ns / 1e9
+            ):
+                continue
+            if len(directories) + len(files) >= query.max_results:
+                truncated = True
+                break
+            if is_dir:
+                directories.append(os.path.join(parent, name))
+            else:
+                files.append({"name": os.path.join(parent, name), "size": size})
+        if truncated:
+            return directories, files, [], True
+
+        unindexed = [
+            path
+            for (path,) in self.connection.execute(
+                f"SELECT {_CHILD_PATH} AS path FROM entries "
+                f"WHERE is_dir AND NOT is_link AND {_IN_SUBTREE} "
+                "AND NOT EXISTS (SELECT 1 FROM directories WHERE directories.path = "
+                f"{_CHILD_PATH})",
+                subtree_args,
+            )
+            if not query.is_excluded(path)
+        ]
+        return directories, files, unindexed, False
+
+
+def _get_subtree_args(relative_path):
+    return relative_path, relative_path, relative_path + "/", relative_path + "0"
+
+
+def open_index():
+    """Open the search index for searching, None if it does not exist yet or
+    its refreshes did not progress for several intervals
+    """
+    if not config.SEARCH_INDEX_REFRESH_INTERVAL or not os.path.exists(
+        config.SEARCH_INDEX_PATH
+    ):
+        return None
+    try:
+        index = FileIndex(config.SEARCH_INDEX_PATH, read_only=True)
+    except sqlite3.Error as e:
+        logging.warning(f"Cannot open the search index: {e}")
+        return None
+    try:
+        age = time.time() - (index.get_refresh_time() or 0)
+    except sqlite3.Error:
+        # created by a previous version, until its next refresh
+        age = math.inf
+    if age > STALE_INDEX_INTERVALS * config.SEARCH_INDEX_REFRESH_INTERVAL:
+        logging.warning(f"Search index not refreshed for {age:.0f} s, not used")
+        index.close()
+        return None
+    return index
+
+
+def refresh_index():
+    index = FileIndex(config.SEARCH_INDEX_PATH)
+    try:
+        t_start = time.perf_counter()
+        visited, listed = index.refresh(
+            config.SANDBOX_PATH, [config.THUMBNAIL_CACHE_PATH], refresh_stop_event
+        )
+        logging.debug(
+            f"Refreshed the search index in {time.perf_counter() - t_start:.2f} s, "
+            f"{listed} of {visited} directories listed"
+        )
+    finally:
+        index.close()
+
+
+async def refresh_search_index():
+    if not config.SEARCH_INDEX_REFRESH_INTERVAL:
+        return
+    loop = asyncio.get_event_loop()
+    while not refresh_stop_event.is_set():
+        try:
+            await loop.run_in_executor(None, refresh_index)
+        except Exception as e:
+            # retried at the next interval
+            logging.error(f"Search index issue: {e}")
+        await asyncio.sleep(config.SEARCH_INDEX_REFRESH_INTERVAL)
+
+
+async def on_cleanup(app):
+    # let a running refresh end rather than block the exit
+    refresh_stop_event.set()
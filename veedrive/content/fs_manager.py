@@ -3,16 +3,26 @@ import datetime
 import hashlib
 import logging
 import os
-import re
+import queue
+import sqlite3
 import threading
 import time
-
-import scandir
+from concurrent.futures import ThreadPoolExecutor
 
 from .. import config
+from ..utils import metrics
+from ..utils.exceptions import CodeException
+from . import file_index
+from .search_query import SearchQuery
 from .utils import sanitize_path, validate_path
 
 fs_search_results = {}
+# crawlers of the queued, running and finished searches, by search id
+search_crawlers = {}
+# ids of the searches of each client
+client_searches = {}
+search_executor = None
+search_stats = {"submitted": 0, "rejected": 0, "cancelled": 0, "superseded": 0}
 
 
 @sanitize_path
@@ -42,13 +52,52 @@ def list_directory(path):
     return {"directories": dirs, "files": files}
 
 
-def generate_search_id(absolute_path, name):
-    return hashlib.md5(absolute_path.encode()).hexdigest() + "_" + name
+def generate_search_id(absolute_path, name, filters_key=""):
+    return hashlib.md5((absolute_path + filters_key).encode()).hexdigest() + "_" + name
+
+
+def get_search_executor():
+    """Get the pool of threads running config.SEARCH_MAX_CONCURRENT searches at
+    a time, others are queued
+    """
+    global search_executor
+    if search_executor is None:
+        search_executor = ThreadPoolExecutor(
+            config.SEARCH_MAX_CONCURRENT, thread_name_prefix="search"
+        )
+    return search_executor
+
+
+def shutdown_search_executor():
+    global search_executor
+    for search_id in list(search_crawlers):
+        _stop_search(search_id)
+    if search_executor is not None:
+        # queued searches were cancelled above, cancel_futures needs Python 3.9
+        search_executor.shutdown(wait=False)
+        search_executor = None
 
 
-def search_file(search_query: str, starting_path=""):
+def search_file(search_query: SearchQuery, starting_path="", client=None):
+    """
+    Start a search, or join an identical one. The unfinished searches of the
+    client from the same path and with the same filters, e.g. typed letter by
+    letter, are cancelled.
+
+    :param search_query: searched name and filters
+    :type search_query: class: `SearchQuery`
+    :param starting_path: searched path, relative to the sandbox
+    :type starting_path: str, optional
+    :param client: client starting the search, e.g. its websocket connection,
+        defaults to None
+    :raises CodeException: if the client or the queue has too many searches
+    :return: search id
+    :rtype: str
+    """
     absolute_path = os.path.join(config.SANDBOX_PATH, starting_path)
-    search_id = generate_search_id(absolute_path, search_query)
+    search_id = generate_search_id(
+        absolute_path, search_query.name, search_query.get_key()
+    )
 
     try:
         absolute_path = os.path.join(config.SANDBOX_PATH, starting_path)
@@ -56,34 +105,202 @@ def search_file(search_query: str, starting_path=""):
     except Exception as e:
         raise
 
-    if search_id not in fs_search_results:
-        FileSystemCrawler(search_query, search_id, absolute_path).start()
-
+    scope = (absolute_path, search_query.get_key())
+    if client is not None:
+        for previous_id in list(client_searches.get(client, ())):
+            crawler = search_crawlers.get(previous_id)
+            if previous_id != search_id and crawler and crawler.scope == scope:
+                if _release_search(previous_id, client):
+                    search_stats["superseded"] += 1
+
+    if search_id not in search_crawlers:
+        if client is not None and (
+            len(_get_unfinished(client_searches.get(client, ())))
+            >= config.SEARCH_MAX_PER_CLIENT
+        ):
+            search_stats["rejected"] += 1
+            raise CodeException(
+                config.SEARCH_LIMIT_REACHED,
+                f"At most {config.SEARCH_MAX_PER_CLIENT} searches per client",
+            )
+        if (
+            len([c for c in search_crawlers.values() if c.state == QUEUED])
+            >= config.SEARCH_MAX_QUEUED
+        ):
+            search_stats["rejected"] += 1
+            raise CodeException(config.SEARCH_LIMIT_REACHED, "Too many searches")
+        crawler = FileSystemCrawler(search_query, search_id, absolute_path)
+        crawler.scope = scope
+        search_crawlers[search_id] = crawler
+        fs_search_results[search_id] = crawler.result
+        crawler.future = get_search_executor().submit(crawler.run)
+        search_stats["submitted"] += 1
+
+    if client is not None:
+        search_crawlers[search_id].clients.add(client)
+        client_searches.setdefault(client, set()).add(search_id)
     return search_id
 
 
+def _get_unfinished(search_ids):
+    return [
+        search_id
+        for search_id in search_ids
+        if search_id in search_crawlers
+        and search_crawlers[search_id].state in (QUEUED, RUNNING)
+    ]
+
+
+def _stop_search(search_id):
+    crawler = search_crawlers.pop(search_id)
+    crawler.stop()
+    crawler.future.cancel()
+    fs_search_results.pop(search_id, None)
+    for client in crawler.clients:
+        client_searches.get(client, set()).discard(search_id)
+
+
+def _release_search(search_id, client):
+    """Remove a client of a search, which is stopped if unfinished and without
+    clients left. Returns whether it was stopped.
+    """
+    client_searches.get(client, set()).discard(search_id)
+    crawler = search_crawlers[search_id]
+    crawler.clients.discard(client)
+    if crawler.clients or crawler.state not in (QUEUED, RUNNING):
+        return False
+    _stop_search(search_id)
+    search_stats["cancelled"] += 1
+    return True
+
+
+def cancel_search(search_id, client=None):
+    """
+    Cancel a search for a client. It is stopped once no other client needs it,
+    finished results are kept for identical searches.
+
+    :param search_id: id returned by search_file
+    :type search_id: str
+    :param client: client cancelling the search, None to stop it for all clients
+    :raises KeyError: if there is no such search
+    :return: whether the search was stopped
+    :rtype: bool
+    """
+    crawler = search_crawlers[search_id]
+    if client is None:
+        crawler.clients.clear()
+    return _release_search(search_id, client)
+
+
+def release_client_searches(client):
+    """Forget the searches of a disconnected client. They keep running, e.g. to
+    be polled from another connection, until finished, timed out or cancelled.
+    """
+    for search_id in client_searches.pop(client, ()):
+        if search_id in search_crawlers:
+            search_crawlers[search_id].clients.discard(client)
+
+
+async def on_cleanup(app):
+    shutdown_search_executor()
+
+
+def get_search_stats():
+    states = [crawler.state for crawler in search_crawlers.values()]
+    return {
+        "queued": states.count(QUEUED),
+        "running": states.count(RUNNING),
+        "max_concurrent": config.SEARCH_MAX_CONCURRENT,
+        "results": len(fs_search_results),
+        **search_stats,
+    }
+
+
+metrics.register("search", get_search_stats)
+
+
+def _decode_search_cursor(cursor):
+    try:
+        files, directories = (int(position) for position in cursor.split("."))
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if files < 0 or directories < 0:
+        raise ValueError("Invalid cursor")
+    return files, directories
+
+
+def get_search_result(search_id, cursor=None):
+    """
+    Get the matches of a search, all of them or those found since a cursor.
+    Finished results are kept config.SEARCH_FS_KEEP_FINISHED_INTERVAL seconds,
+    and reused by identical searches.
+
+    :param search_id: id returned by search_file
+    :type search_id: str
+    :param cursor: cursor returned with previous matches, defaults to None
+    :type cursor: str, optional
+    :raises KeyError: if there is no such search
+    :raises ValueError: if the cursor is invalid
+    :return: whether the search is done, the matching files and directories,
+        whether matches were left out past the maximum number of results, and the
+        cursor of the next matches
+    :rtype: dict
+    """
+    result = fs_search_results[search_id]
+    files_start, directories_start = _decode_search_cursor(cursor) if cursor else (0, 0)
+    # matches are all appended before the search is done
+    done = result["done"]
+    files_end, directories_end = len(result["files"]), len(result["directories"])
+    return {
+        "done": done,
+        "files": result["files"][files_start:files_end],
+        "directories": result["directories"][directories_start:directories_end],
+        "truncated": result["truncated"],
+        "cursor": f"{files_end}.{directories_end}",
+    }
+
+
+async def follow_search_result(search_id, cursor=None):
+    """
+    Yield the matches of a search in batches as they are found, see
+    get_search_result, until it is done or stopped
+
+    :param search_id: id returned by search_file
+    :type search_id: str
+    :param cursor: cursor returned with previous matches, defaults to None
+    :type cursor: str, optional
+    :raises KeyError: if the search is stopped
+    """
+    while True:
+        result = get_search_result(search_id, cursor)
+        if result["files"] or result["directories"] or result["done"]:
+            yield result
+        if result["done"]:
+            return
+        cursor = result["cursor"]
+        await asyncio.sleep(config.SEARCH_PUSH_INTERVAL)
+
+
 async def purge_search_results():
     def purge_done(result):
         finish_time = result["finished_at"]
         delta = datetime.datetime.now() - finish_time
         if delta > datetime.timedelta(seconds=config.SEARCH_FS_KEEP_FINISHED_INTERVAL):
             fs_search_results.pop(e)
-            logging.debug(
-                f"Purging Search result: {e} finished_at {finish_time} "
-                "and not retrieved by a client"
-            )
+            crawler = search_crawlers.pop(e, None)
+            for client in crawler.clients if crawler else ():
+                client_searches.get(client, set()).discard(e)
+            logging.debug(f"Purging Search result: {e} finished_at {finish_time}")
 
     def purge_running(result):
         start_time = result["started_at"]
         delta = datetime.datetime.now() - start_time
         if delta > datetime.timedelta(seconds=config.SEARCH_FS_THREAD_TIMEOUT):
-            for th in threading.enumerate():
-                if e == th.getName():
-                    th.stop()
-                    fs_search_results.pop(e)
-                    logging.debug(
-                        f"Killed Search thread: {th.getName()}, started at {start_time}"
-                    )
+            if e in search_crawlers:
+                _stop_search(e)
+            else:
+                fs_search_results.pop(e)
+            logging.debug(f"Stopped Search: {e}, started at {start_time}")
 
     try:
         while True:
@@ -99,60 +316,201 @@ async def purge_search_results():
         logging.error(f"Purge search issue: {e}")
 
 
-class FileSystemCrawler(threading.Thread):
-    def __init__(self, searched_name, search_id, starting_path):
-        super(FileSystemCrawler, self).__init__(name=search_id)
-        self.searched_name = searched_name
+def crawl(starting_paths, query, found_dirs, found_files, threads, stop_event):
+    """
+    Search names under directories, listed concurrently by a pool of threads
+    sharing a queue of directories, so that several listings are in flight on
+    network file systems. Matches are appended as found, in no particular order.
+    Excluded folders are not listed, and the crawl stops once the maximum number
+    of matches is found.
+
+    :param starting_paths: absolute paths of the crawled directories
+    :type starting_paths: list(str)
+    :param query: searched name and filters
+    :type query: class: `SearchQuery`
+    :param found_dirs: relative paths of the matching directories
+    :type found_dirs: list(str)
+    :param found_files: names and sizes of the matching files
+    :type found_files: list(dict)
+    :param threads: number of threads listing directories
+    :type threads: int
+    :param stop_event: event interrupting the crawl when set
+    :type stop_event: class: `threading.Event`
+    :return: whether matches were left out past the maximum number of matches
+    :rtype: bool
+    """
+    directories = queue.Queue()
+    for path in starting_paths:
+        if not query.is_excluded(os.path.relpath(path, config.SANDBOX_PATH)):
+            directories.put(path)
+    found_lock = threading.Lock()
+    full = threading.Event()
+
+    def add(found, match):
+        with found_lock:
+            if len(found_dirs) + len(found_files) >= query.max_results:
+                full.set()
+            else:
+                found.append(match)
+
+    def list_directory_entries(path):
+        # relative path in order to keep user's requests sandboxed
+        relative_path = os.path.relpath(path, config.SANDBOX_PATH)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        entry_path = os.path.join(relative_path, entry.name)
+                        if query.is_excluded(os.path.normpath(entry_path)):
+                            continue
+                        if not entry.is_symlink():
+                            directories.put(entry.path)
+                        if (
+                            not query.files_only
+                            and query.matches_name(entry.name)
+                            and (
+                                not query.filters_mtime()
+                                or query.matches_mtime(entry.stat().st_mtime)
+                            )
+                        ):
+                            add(found_dirs, entry_path)
+                    elif query.matches_name(entry.name):
+                        stat = entry.stat()
+                        if query.matches_file(entry.name, stat.st_size, stat.st_mtime):
+                            add(
+                                found_files,
+                                {
+                                    "name": os.path.join(relative_path, entry.name),
+                                    "size": stat.st_size,
+                                },
+                            )
+                except OSError:
+                    # e.g. a broken link
+                    continue
+
+    def work():
+        while True:
+            path = directories.get()
+            try:
+                if path is None:
+                    return
+                # once stopped or full, the remaining directories are skipped
+                if not stop_event.is_set() and not full.is_set():
+                    list_directory_entries(path)
+            except OSError as e:
+                logging.debug(f"Cannot list {path}: {e}")
+            finally:
+                directories.task_done()
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    directories.join()
+    for _ in workers:
+        directories.put(None)
+    for worker in workers:
+        worker.join()
+    return full.is_set()
+
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+STOPPED = "stopped"
+
+
+class FileSystemCrawler:
+    """Search run by the search executor. Its result is registered in
+    fs_search_results once queued.
+
+    :param query: searched name and filters
+    :type query: class: `SearchQuery`
+    :param search_id: search id
+    :type search_id: str
+    :param starting_path: absolute path of the searched directory
+    :type starting_path: str
+    """
+
+    def __init__(self, query, search_id, starting_path):
+        self.query = query
         self.search_id = search_id
         self.stating_paht = starting_path
         self._stop_event = threading.Event()
+        self.state = QUEUED
+        self.clients = set()
+        self.scope = None
+        self.future = None
+        self.result = {
+            "done": False,
+            "files": [],
+            "directories": [],
+            "truncated": False,
+            # queue time counts towards config.SEARCH_FS_THREAD_TIMEOUT
+            "started_at": datetime.datetime.now(),
+        }
 
     def stop(self):
         self._stop_event.set()
+        if self.state == QUEUED:
+            self.state = STOPPED
 
     def run(self):
-        name = self.searched_name
-        starting_path = self.stating_paht
-        search_id = self.search_id
+        if self._stop_event.is_set():
+            return
+        self.state = RUNNING
+        try:
+            self._search()
+        except Exception as e:
+            logging.error(f"Search {self.search_id} issue: {e}")
+        finally:
+            self.state = STOPPED if self._stop_event.is_set() else FINISHED
 
-        found_dirs = []
-        found_files = []
-        regex = re.compile(name, re.IGNORECASE)
-        file_list = scandir.walk(starting_path)
+    def _search(self):
+        query = self.query
+        starting_path = self.stating_paht
+        search_result = self.result
+        found_dirs = search_result["directories"]
+        found_files = search_result["files"]
 
         t1 = time.perf_counter()
-
-        search_result = {"done": False, "files": found_files, "directories": found_dirs}
-
-        import datetime
-
-        search_result["started_at"] = datetime.datetime.now()
-
-        fs_search_results[search_id] = search_result
         try:
-            for path, directories, files in file_list:
-                if self._stop_event.isSet():
-                    return
-
-                # relative path in order to keep user's requests sandboxed
-                relative_path = os.path.relpath(path, config.SANDBOX_PATH)
-
-                for directory in directories:
-                    if regex.search(directory):
-                        found_dirs.append(os.path.join(relative_path, directory))
-                for file in files:
-                    if regex.search(file):
-                        found_files.append(
-                            {
-                                "name": os.path.join(relative_path, file),
-                                "size": os.path.getsize(os.path.join(path, file)),
-                            }
-                        )
+            crawled_paths = [starting_path]
+            index = file_index.open_index()
+            if index:
+                try:
+                    directories, files, unindexed, truncated = index.search(
+                        query,
+                        os.path.relpath(starting_path, config.SANDBOX_PATH),
+                        self._stop_event,
+                    )
+                    found_dirs += directories
+                    found_files += files
+                    search_result["truncated"] = truncated
+                    crawled_paths = [
+                        os.path.join(config.SANDBOX_PATH, path) for path in unindexed
+                    ]
+                except sqlite3.Error as e:
+                    logging.warning(f"Search index issue, crawling: {e}")
+                finally:
+                    index.close()
+
+            if crawl(
+                crawled_paths,
+                query,
+                found_dirs,
+                found_files,
+                config.SEARCH_FS_THREADS,
+                self._stop_event,
+            ):
+                search_result["truncated"] = True
+            if self._stop_event.is_set():
+                return
             t2 = time.perf_counter()
             search_result["done"] = True
             search_result["finished_at"] = datetime.datetime.now()
             logging.debug(
-                f"Search for '{name}' at path '{starting_path}' took {t2 - t1:.2f} s."
+                f"Search for '{query.name}' at path '{starting_path}' took "
+                f"{t2 - t1:.2f} s, {len(crawled_paths)} unindexed folders crawled."
             )
         except Exception as e:
             raise
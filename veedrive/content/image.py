@@ -1,4 +1,8 @@
+import functools
 import logging
+import math
+import os
+import struct
 import subprocess
 
 import cv2
@@ -6,13 +10,150 @@ import numpy
 
 import veedrive.config as config
 
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+JPEG_REDUCTION_FLAGS = {
+    # factor: (color flag, grayscale flag)
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+}
+PDF_RENDERING_OVERSAMPLING = 2
+
+# start of frame markers, except DHT (0xC4), JPG (0xC8) and DAC (0xCC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
 
 def resize_image(path, box_width, box_height, scaling_mode, ext):
-    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    img = read_image(path, box_width, box_height, scaling_mode)
     return transform_image(img, box_width, box_height, scaling_mode, ext)
 
 
-def generate_pdf(path, box_width, box_height, scaling_mode):
+def read_image(path, box_width, box_height, scaling_mode):
+    """Read an image, JPEG images are decoded at the lowest resolution
+    which is still bigger than the one required by the requested box"""
+    jpeg_header = read_jpeg_header(path)
+    if jpeg_header:
+        width, height, components = jpeg_header
+        factor = get_jpeg_reduction_factor(
+            width, height, box_width, box_height, scaling_mode
+        )
+        if factor > 1:
+            color_flag, grayscale_flag = JPEG_REDUCTION_FLAGS[factor]
+            flag = grayscale_flag if components == 1 else color_flag
+            # IMREAD_UNCHANGED ignores EXIF orientation, so should reduced decoding
+            img = cv2.imread(path, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+            if img is not None:
+                return img
+    return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+
+def read_jpeg_header(path):
+    """Read size of a JPEG image without decoding it
+
+    :return: width, height and number of components or None if not a JPEG image
+    :rtype: tuple(int, int, int)
+    """
+    try:
+        with open(path, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                marker = f.read(2)
+                if len(marker) != 2 or marker[0] != 0xFF:
+                    return None
+                # fill bytes
+                while marker[1] == 0xFF:
+                    marker = marker[1:] + f.read(1)
+                if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD8:
+                    continue
+                length = int.from_bytes(f.read(2), "big")
+                if marker[1] in JPEG_SOF_MARKERS:
+                    segment = f.read(6)
+                    if len(segment) != 6:
+                        return None
+                    height = int.from_bytes(segment[1:3], "big")
+                    width = int.from_bytes(segment[3:5], "big")
+                    return width, height, segment[5]
+                if length < 2:
+                    return None
+                f.seek(length - 2, 1)
+    except OSError:
+        return None
+
+
+def read_image_size(path):
+    """Read size of a JPEG or PNG image without decoding it
+
+    :return: width and height or None if neither a JPEG nor a PNG image
+    :rtype: tuple(int, int)
+    """
+    jpeg_header = read_jpeg_header(path)
+    if jpeg_header:
+        return jpeg_header[:2]
+    try:
+        with open(path, "rb") as f:
+            header = f.read(24)
+    except OSError:
+        return None
+    if header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def is_fitting(image_width, image_height, box_width, box_height):
+    """Whether fitting an image in a box leaves it as is"""
+    if _is_smaller_than_box(image_width, image_height, box_width, box_height):
+        return True
+    fit_size = _get_fit_size(image_width, image_height, box_width, box_height)
+    return fit_size == (image_width, image_height)
+
+
+def get_jpeg_reduction_factor(
+    image_width, image_height, box_width, box_height, scaling_mode
+):
+    """Get the biggest JPEG decoding reduction factor (1, 2, 4 or 8) which
+    keeps the decoded image bigger than the result of its transformation"""
+    if not image_width or not image_height:
+        return 1
+    if _is_smaller_than_box(image_width, image_height, box_width, box_height):
+        return 1
+
+    if scaling_mode == config.FILL_TRANSFORM_IMAGE:
+        ratio = max(box_width / image_width, box_height / image_height)
+    else:
+        ratio = min(box_width / image_width, box_height / image_height)
+    target_width = math.ceil(image_width * ratio)
+    target_height = math.ceil(image_height * ratio)
+
+    for factor in JPEG_REDUCTION_FLAGS:
+        reduced_width = math.ceil(image_width / factor)
+        reduced_height = math.ceil(image_height / factor)
+        if (
+            reduced_width >= target_width
+            and reduced_height >= target_height
+            and not _is_smaller_than_box(
+                reduced_width, reduced_height, box_width, box_height
+            )
+        ):
+            return factor
+    return 1
+
+
+def generate_pdf(path, box_width, box_height, scaling_mode, page=0):
+    if fitz is None:
+        if page:
+            raise ValueError("Rendering of PDF pages requires PyMuPDF")
+        return generate_pdf_with_imagemagick(path, box_width, box_height, scaling_mode)
+    img = render_pdf_page(path, page, box_width, box_height, scaling_mode)
+    return transform_image(img, box_width, box_height, scaling_mode, ".jpg")
+
+
+def generate_pdf_with_imagemagick(path, box_width, box_height, scaling_mode):
     im_args = ["convert", "-background", "white", path + "[0]", "bmp:-"]
     process = subprocess.Popen(im_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = process.communicate()
@@ -22,14 +163,54 @@ def generate_pdf(path, box_width, box_height, scaling_mode):
     return transform_image(img, box_width, box_height, scaling_mode, ".jpg")
 
 
+def render_pdf_page(path, page, box_width, box_height, scaling_mode):
+    """Rasterise a PDF page directly at the resolution required by a box
+
+    :param path: absolute path of the PDF document
+    :type path: str
+    :param page: page number, starting from 0
+    :type page: int
+    :return: rendered page (BGR)
+    :rtype: numpy.ndarray
+    """
+    document = _open_pdf(path, os.stat(path).st_mtime_ns)
+    if not 0 <= page < document.page_count:
+        raise ValueError(
+            f"Page {page} out of range, document has {document.page_count}"
+        )
+    pdf_page = document.load_page(page)
+
+    page_width, page_height = pdf_page.rect.width, pdf_page.rect.height
+    if scaling_mode == config.FILL_TRANSFORM_IMAGE:
+        zoom = max(box_width / page_width, box_height / page_height)
+    else:
+        zoom = min(box_width / page_width, box_height / page_height)
+    # render bigger than needed, final size is given by transform_image.
+    # Never below 72 dpi, small thumbnails keep the rounding of the page size in points
+    zoom = max(zoom * PDF_RENDERING_OVERSAMPLING, 1.0)
+
+    # integer output size, so that the rendered page keeps the page aspect
+    width, height = round(page_width * zoom), round(page_height * zoom)
+    matrix = fitz.Matrix(width / page_width, height / page_height)
+    pixmap = pdf_page.get_pixmap(matrix=matrix, alpha=False)
+    img = numpy.frombuffer(pixmap.samples, numpy.uint8).reshape(
+        pixmap.height, pixmap.width, pixmap.n
+    )
+    if pixmap.n == 1:
+        return img.copy()
+    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+
+@functools.lru_cache(maxsize=16)
+def _open_pdf(path, mtime_ns):
+    """Open a PDF document, kept open for subsequent renderings in the same process"""
+    return fitz.open(path)
+
+
 def transform_image(img: numpy.ndarray, box_width, box_height, scaling_mode, ext):
     image_height, image_width = img.shape[:2]
-    image_aspect = image_width / image_height
 
-    image_smaller_than_box = (image_aspect > 1.0 and box_width >= image_width) or (
-        image_aspect <= 1.0 and box_height >= image_height
-    )
-    if image_smaller_than_box:
+    if _is_smaller_than_box(image_width, image_height, box_width, box_height):
         return _encode_image(img, ext)
 
     if scaling_mode == config.FIT_TRANSFORM_IMAGE:
@@ -48,6 +229,13 @@ def transform_image(img: numpy.ndarray, box_width, box_height, scaling_mode, ext
     return _encode_image(resized_image, ext)
 
 
+def _is_smaller_than_box(image_width, image_height, box_width, box_height):
+    image_aspect = image_width / image_height
+    return (image_aspect > 1.0 and box_width >= image_width) or (
+        image_aspect <= 1.0 and box_height >= image_height
+    )
+
+
 def _resize(img: numpy.ndarray, box_width, box_height):
     image_height, image_width = img.shape[:2]
     image_aspect = image_width / image_height
@@ -80,6 +268,11 @@ def _resize(img: numpy.ndarray, box_width, box_height):
 def _resize_to_fit(
     img: numpy.ndarray, image_width, image_height, box_width, box_height
 ):
+    requested_aspect = _get_fit_size(image_width, image_height, box_width, box_height)
+    return cv2.resize(img, requested_aspect, interpolation=cv2.INTER_AREA)
+
+
+def _get_fit_size(image_width, image_height, box_width, box_height):
     requested_aspect = box_width / box_height
     image_aspect = image_width / image_height
 
@@ -89,14 +282,12 @@ def _resize_to_fit(
         )
         logging.debug("so we take height and use it as a basis for calculation")
 
-        requested_aspect = (round(box_height * image_aspect), box_height)
-    else:
-        logging.debug(
-            f"requested box is higher or eq to image: {requested_aspect} : {image_aspect}"
-        )
-        logging.debug("so we take width and use it as a basis for calculation")
-        requested_aspect = (box_width, round(box_width / image_aspect))
-    return cv2.resize(img, requested_aspect, interpolation=cv2.INTER_AREA)
+        return round(box_height * image_aspect), box_height
+    logging.debug(
+        f"requested box is higher or eq to image: {requested_aspect} : {image_aspect}"
+    )
+    logging.debug("so we take width and use it as a basis for calculation")
+    return box_width, round(box_width / image_aspect)
 
 
 def _resize_to_fill(
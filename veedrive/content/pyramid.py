@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+
+import cv2
+import scandir
+
+from .. import config
+from .image import JPEG_REDUCTION_FLAGS, read_image_size, read_jpeg_header
+from .utils import get_dir_file_hash_pair
+
+DESCRIPTOR_FILE = "descriptor.json"
+TILE_FORMAT = "jpg"
+
+
+def get_pyramid_folder(path):
+    """Get folder of an image pyramid, relative to the tiles cache folder"""
+    return os.path.join(*get_dir_file_hash_pair(path))
+
+
+def get_max_level(width, height):
+    """Get the level of full resolution tiles, level 0 being a 1x1 image"""
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def get_tile_file(level, column, row):
+    return os.path.join(str(level), f"{column}_{row}.{TILE_FORMAT}")
+
+
+def read_descriptor(pyramid_folder):
+    with open(os.path.join(pyramid_folder, DESCRIPTOR_FILE)) as f:
+        return json.load(f)
+
+
+def read_image(absolute_path):
+    """Decode an image to be tiled within config.TILES_MAX_PIXELS. Bigger JPEG
+    images are decoded at a reduced resolution, other images are rejected
+    rather than decoded at once.
+
+    :param absolute_path: absolute path of the image
+    :type absolute_path: str
+    :return: decoded image
+    :rtype: class: `numpy.ndarray`
+    """
+    size = read_image_size(absolute_path)
+    factor = 1
+    if size:
+        while size[0] * size[1] > config.TILES_MAX_PIXELS * factor**2:
+            factor *= 2
+    if factor > 1:
+        if factor not in JPEG_REDUCTION_FLAGS or not read_jpeg_header(absolute_path):
+            raise ValueError(
+                f"{os.path.basename(absolute_path)} is too large to be tiled "
+                f"({size[0]}x{size[1]})"
+            )
+        img = cv2.imread(absolute_path, JPEG_REDUCTION_FLAGS[factor][0])
+    else:
+        img = cv2.imread(absolute_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Cannot decode {os.path.basename(absolute_path)}")
+    return img
+
+
+def build_pyramid(absolute_path, pyramid_folder, tile_size=None):
+    """Build Deep Zoom tiles of an image at all power-of-two levels
+
+    Tiles of level `n` are stored in `pyramid_folder/n/{column}_{row}.jpg`,
+    the highest level holding full resolution tiles. The pyramid is built in a
+    temporary folder which replaces `pyramid_folder` once complete.
+    Images bigger than config.TILES_MAX_PIXELS are tiled at reduced resolution
+    (see `read_image`).
+
+    :param absolute_path: absolute path of the source image
+    :type absolute_path: str
+    :param pyramid_folder: absolute path of the folder to store tiles in
+    :type pyramid_folder: str
+    :param tile_size: size of tiles, defaults to config.TILE_SIZE
+    :type tile_size: int, optional
+    :return: Deep Zoom descriptor of the pyramid
+    :rtype: dict
+    """
+    tile_size = tile_size or config.TILE_SIZE
+    img = read_image(absolute_path)
+    height, width = img.shape[:2]
+    max_level = get_max_level(width, height)
+    tmp_folder = f"{pyramid_folder}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+
+    try:
+        for level in range(max_level, -1, -1):
+            os.makedirs(os.path.join(tmp_folder, str(level)))
+            level_height, level_width = img.shape[:2]
+            for row in range(math.ceil(level_height / tile_size)):
+                for column in range(math.ceil(level_width / tile_size)):
+                    tile = img[
+                        row * tile_size : (row + 1) * tile_size,
+                        column * tile_size : (column + 1) * tile_size,
+                    ]
+                    cv2.imwrite(
+                        os.path.join(tmp_folder, get_tile_file(level, column, row)),
+                        tile,
+                        [int(cv2.IMWRITE_JPEG_QUALITY), 90],
+                    )
+            if level:
+                img = cv2.resize(
+                    img,
+                    (math.ceil(level_width / 2), math.ceil(level_height / 2)),
+                    interpolation=cv2.INTER_AREA,
+                )
+
+        descriptor = {
+            "Image": {
+                "xmlns": "http://schemas.microsoft.com/deepzoom/2008",
+                "Format": TILE_FORMAT,
+                "Overlap": "0",
+                "TileSize": str(tile_size),
+                "Size": {"Width": str(width), "Height": str(height)},
+            },
+            "MaxLevel": max_level,
+        }
+        # descriptor is written last, it marks the pyramid as complete
+        with open(os.path.join(tmp_folder, DESCRIPTOR_FILE), "w") as f:
+            json.dump(descriptor, f)
+
+        if os.path.exists(pyramid_folder):
+            shutil.rmtree(pyramid_folder)
+        os.rename(tmp_folder, pyramid_folder)
+    finally:
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+    return descriptor
+
+
+def evict(cache_path, max_size):
+    """Remove least recently used pyramids until cache size is below max_size.
+    Pyramids are removed as a whole, their use is tracked on their descriptor.
+
+    :return: number of removed pyramids
+    :rtype: int
+    """
+    entries = []
+    total_size = 0
+    for dir_hash in _list_folders(cache_path):
+        for pyramid_folder in _list_folders(dir_hash):
+            if pyramid_folder.endswith(".tmp"):
+                # being built
+                continue
+            try:
+                last_use = os.stat(
+                    os.path.join(pyramid_folder, DESCRIPTOR_FILE)
+                ).st_atime
+            except FileNotFoundError:
+                continue
+            size = 0
+            for path, _, files in scandir.walk(pyramid_folder):
+                for file in files:
+                    try:
+                        size += os.stat(os.path.join(path, file)).st_size
+                    except FileNotFoundError:
+                        pass
+            entries.append((last_use, size, pyramid_folder))
+            total_size += size
+
+    removed = 0
+    for _, size, pyramid_folder in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(pyramid_folder, ignore_errors=True)
+        total_size -= size
+        removed += 1
+    return removed
+
+
+def _list_folders(path):
+    try:
+        return [entry.path for entry in scandir.scandir(path) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+async def purge_tiles_cache():
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            removed = await loop.run_in_executor(
+                None, evict, config.TILES_CACHE_PATH, config.TILES_CACHE_MAX_SIZE
+            )
+            if removed:
+                logging.debug(f"Evicted {removed} image pyramids from cache")
+        except Exception as e:
+            # retried at the next interval
+            logging.error(f"Purge tiles cache issue: {e}")
+        await asyncio.sleep(config.TILES_CACHE_PURGE_LOOP_INTERVAL)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+import time
+
+import scandir
+
+from .. import config
+from .utils import get_dir_file_hash_pair
+
+
+def snap_to_bucket(box_width, box_height, scaling_mode):
+    """Snap a requested box to the closest bigger configured bucket size
+
+    'fit' boxes are snapped on each axis, 'fill' boxes are scaled uniformly
+    in order to keep the requested aspect (and so the cropped area).
+
+    :return: bucket box or None if the box is bigger than the biggest bucket
+    :rtype: tuple(int, int)
+    """
+
+    def bucket(size):
+        return next((b for b in config.SCALED_CACHE_BUCKETS if b >= size), None)
+
+    if scaling_mode == config.FILL_TRANSFORM_IMAGE:
+        longest_side = max(box_width, box_height)
+        longest_bucket = bucket(longest_side)
+        if longest_bucket is None:
+            return None
+        ratio = longest_bucket / longest_side
+        return round(box_width * ratio), round(box_height * ratio)
+
+    bucket_width, bucket_height = bucket(box_width), bucket(box_height)
+    if bucket_width is None or bucket_height is None:
+        return None
+    return bucket_width, bucket_height
+
+
+def get_cache_file(path, box_width, box_height, scaling_mode):
+    """Get path of a scaled image, relative to the scaled cache folder"""
+    dir_hash, file_hash = get_dir_file_hash_pair(path)
+    return os.path.join(f"{box_width}x{box_height}_{scaling_mode}", dir_hash, file_hash)
+
+
+def touch(cache_file):
+    """Mark a cached file as recently used, keeping its modification time"""
+    os.utime(cache_file, (time.time(), os.stat(cache_file).st_mtime))
+
+
+def evict(cache_path, max_size):
+    """Remove least recently used files until cache size is below max_size
+
+    :return: number of removed files
+    :rtype: int
+    """
+    entries = []
+    total_size = 0
+    for path, _, files in scandir.walk(cache_path):
+        for file in files:
+            try:
+                stat = os.stat(os.path.join(path, file))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, os.path.join(path, file)))
+            total_size += stat.st_size
+
+    removed = 0
+    for _, size, file in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        removed += 1
+    return removed
+
+
+async def purge_scaled_cache():
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            removed = await loop.run_in_executor(
+                None, evict, config.SCALED_CACHE_PATH, config.SCALED_CACHE_MAX_SIZE
+            )
+            if removed:
+                logging.debug(f"Evicted {removed} scaled images from cache")
+        except Exception as e:
+            # retried at the next interval
+            logging.error(f"Purge scaled cache issue: {e}")
+        await asyncio.sleep(config.SCALED_CACHE_PURGE_LOOP_INTERVAL)
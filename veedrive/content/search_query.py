@@ -0,0 +1,188 @@
+import hashlib
+import os
+import re
+
+from .. import config
+
+# characters giving a regular expression a special meaning
+REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]\\|()")
+
+TYPE_EXTENSIONS = {
+    "image": config.SUPPORTED_IMAGE_EXTENSIONS,
+    "video": config.SUPPORTED_VIDEO_EXTENSIONS,
+    "pdf": config.SUPPORTED_DOC_EXTENSIONS,
+}
+
+
+def is_literal(name):
+    return not REGEX_SPECIAL_CHARACTERS.intersection(name)
+
+
+def _number(params, key):
+    value = params.get(key)
+    if value is not None and (
+        isinstance(value, bool) or not isinstance(value, (int, float))
+    ):
+        raise ValueError(f"{key} must be a number")
+    return value
+
+
+def _strings(params, key):
+    values = params.get(key) or []
+    if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+        raise ValueError(f"{key} must be a list of strings")
+    return values
+
+
+class SearchQuery:
+    """Searched name and filters of a search. Names are matched case
+    insensitively, as a substring when they contain no regular expression
+    special characters. With a filter on file types or sizes, only files match.
+    The cache folder is always excluded.
+
+    :param name: searched name, a substring or a regular expression
+    :type name: str
+    :param types: file types among TYPE_EXTENSIONS, defaults to None
+    :type types: list(str), optional
+    :param extensions: file extensions, e.g. ".png", defaults to None
+    :type extensions: list(str), optional
+    :param min_size: minimum size of files, in bytes, defaults to None
+    :type min_size: int, optional
+    :param max_size: maximum size of files, in bytes, defaults to None
+    :type max_size: int, optional
+    :param modified_after: minimum mtime, as a Unix timestamp, defaults to None
+    :type modified_after: float, optional
+    :param modified_before: maximum mtime, as a Unix timestamp, defaults to None
+    :type modified_before: float, optional
+    :param exclude: folders not searched, relative to the sandbox, defaults to ()
+    :type exclude: list(str), optional
+    :param max_results: maximum number of matches, at most (and by default)
+        config.SEARCH_MAX_RESULTS
+    :type max_results: int, optional
+    :raises ValueError: if the name is not a valid regular expression or a
+        filter is invalid
+    """
+
+    def __init__(
+        self,
+        name,
+        types=None,
+        extensions=None,
+        min_size=None,
+        max_size=None,
+        modified_after=None,
+        modified_before=None,
+        exclude=(),
+        max_results=None,
+    ):
+        self.name = name
+        self.is_substring = is_literal(name)
+        if self.is_substring:
+            self.lower_name = name.lower()
+        else:
+            try:
+                self.regex = re.compile(name, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"Invalid name: {e}")
+
+        self.extensions = None
+        if types or extensions:
+            self.extensions = {extension.lower() for extension in extensions or []}
+            for file_type in types or []:
+                if file_type not in TYPE_EXTENSIONS:
+                    raise ValueError(f"Unknown type {file_type}")
+                self.extensions.update(TYPE_EXTENSIONS[file_type])
+        self.min_size = min_size
+        self.max_size = max_size
+        self.files_only = self.extensions is not None or (
+            min_size is not None or max_size is not None
+        )
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+
+        self.excluded = {
+            os.path.relpath(config.THUMBNAIL_CACHE_PATH, config.SANDBOX_PATH)
+        }
+        self.excluded.update(os.path.normpath(folder.strip("/")) for folder in exclude)
+        if max_results is not None and max_results < 1:
+            raise ValueError("max_results must be positive")
+        self.max_results = min(
+            max_results or config.SEARCH_MAX_RESULTS, config.SEARCH_MAX_RESULTS
+        )
+
+    @classmethod
+    def from_params(cls, params):
+        """Create a query from the params of a Search JSON-RPC request
+
+        :raises ValueError: if a param is invalid
+        """
+        name = params["name"]
+        if not isinstance(name, str):
+            raise ValueError("name must be a string")
+        max_results = _number(params, "max_results")
+        if max_results is not None and not isinstance(max_results, int):
+            raise ValueError("max_results must be an integer")
+        return cls(
+            name,
+            types=_strings(params, "types"),
+            extensions=_strings(params, "extensions"),
+            min_size=_number(params, "min_size"),
+            max_size=_number(params, "max_size"),
+            modified_after=_number(params, "modified_after"),
+            modified_before=_number(params, "modified_before"),
+            exclude=_strings(params, "exclude"),
+            max_results=max_results,
+        )
+
+    def get_key(self):
+        """Hash of the filters, identical searches have the same key"""
+        filters = (
+            sorted(self.extensions) if self.extensions is not None else None,
+            self.min_size,
+            self.max_size,
+            self.modified_after,
+            self.modified_before,
+            sorted(self.excluded),
+            self.max_results,
+        )
+        return hashlib.md5(repr(filters).encode()).hexdigest()
+
+    def matches_name(self, name):
+        if self.is_substring:
+            return self.lower_name in name.lower()
+        return self.regex.search(name) is not None
+
+    def matches_file(self, name, size, mtime):
+        """
+        :param name: file name
+        :type name: str
+        :param size: size in bytes
+        :type size: int
+        :param mtime: Unix timestamp of the last modification
+        :type mtime: float
+        """
+        if self.extensions is not None:
+            if os.path.splitext(name)[1].lower() not in self.extensions:
+                return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        return self.matches_mtime(mtime)
+
+    def matches_mtime(self, mtime):
+        if self.modified_after is not None and mtime < self.modified_after:
+            return False
+        if self.modified_before is not None and mtime > self.modified_before:
+            return False
+        return True
+
+    def filters_mtime(self):
+        return self.modified_after is not None or self.modified_before is not None
+
+    def is_excluded(self, relative_path):
+        """Whether a folder, relative to the sandbox, is in an excluded one"""
+        return any(
+            relative_path == folder or relative_path.startswith(folder + "/")
+            for folder in self.excluded
+        )
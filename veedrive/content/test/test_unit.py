@@ -1,12 +1,26 @@
+import asyncio
+import json
+import math
 import os.path
 import shutil
+import threading
+import time
 import unittest
+from unittest.mock import patch
 
+import aiounittest
 import cv2
+import numpy
+from aiohttp.test_utils import make_mocked_request
+from aiohttp.web import FileResponse, HTTPNotFound
 
-from ... import config
-from ...utils.exceptions import WrongObjectType
-from .. import content_manager, fs_manager
+from ... import config, server
+from ...presentation.subscriptions import Subscriber
+from ...utils import asynchro
+from ...utils.exceptions import CodeException, WrongObjectType
+from .. import (content_manager, file_index, fs_manager, image, pyramid,
+                scaled_cache, utils, video, ws_handlers)
+from ..search_query import SearchQuery
 
 
 class TestPath(unittest.TestCase):
@@ -45,10 +59,901 @@ class TestWsHandlers(unittest.TestCase):
         assert obj["thumbnail"] == f"{config.CONTENT_URL}/thumb/{path}"
 
 
-class TestThumbnail(unittest.TestCase):
-    # TODO Add TestThumbnail
-    # def test_correct_thumbnail_size():
-    pass
+class TestThumbnail(aiounittest.AsyncTestCase):
+    cache_folder = "/tmp/testthumbnails"
+
+    def setUp(self):
+        if os.path.exists(self.cache_folder):
+            shutil.rmtree(self.cache_folder)
+        utils.create_cache_subfolders(self.cache_folder)
+
+    async def test_concurrent_requests_generate_once(self):
+        generated = []
+
+        async def fake_run_async(func, path, cache_folder, page, thumbnail_format):
+            generated.append(path)
+            await asyncio.sleep(0.1)
+            open(os.path.join(cache_folder, *utils.get_dir_file_hash_pair(path)), "w")
+
+        requests = [
+            make_mocked_request(
+                "GET", "/content/thumb/chess.jpg", match_info={"path": "chess.jpg"}
+            )
+            for _ in range(50)
+        ]
+        with patch.object(server, "run_async", fake_run_async), patch.object(
+            config, "THUMBNAIL_CACHE_PATH", self.cache_folder
+        ):
+            responses = await asyncio.gather(
+                *[server.handle_thumbnail_request(r) for r in requests]
+            )
+
+        assert generated == ["chess.jpg"]
+        assert len({r.location for r in responses}) == 1
+        assert all(r.status == 302 for r in responses)
+
+    async def test_serve_cached_thumbnail(self):
+        async def fake_run_async(func, path, cache_folder, page, thumbnail_format):
+            open(os.path.join(cache_folder, *utils.get_dir_file_hash_pair(path)), "w")
+
+        def request(headers=None):
+            return make_mocked_request(
+                "GET",
+                "/content/thumb/chess.jpg",
+                headers=headers,
+                match_info={"path": "chess.jpg"},
+            )
+
+        with patch.object(server, "run_async", fake_run_async), patch.object(
+            config, "THUMBNAIL_CACHE_PATH", self.cache_folder
+        ), patch.object(config, "SERVE_CACHED_FILES", True):
+            response = await server.handle_thumbnail_request(request())
+            assert isinstance(response, FileResponse)
+            assert response.headers["Content-Type"] == "image/jpeg"
+            assert "max-age" in response.headers["Cache-Control"]
+            etag = response.headers["ETag"]
+            last_modified = response.headers["Last-Modified"]
+
+            response = await server.handle_thumbnail_request(
+                request({"If-None-Match": etag})
+            )
+            assert response.status == 304
+            response = await server.handle_thumbnail_request(
+                request({"If-None-Match": '"other"'})
+            )
+            assert response.status == 200
+            response = await server.handle_thumbnail_request(
+                request({"If-Modified-Since": last_modified})
+            )
+            assert response.status == 304
+
+    def test_etag_per_representation(self):
+        source_file = os.path.join(config.SANDBOX_PATH, "bbb_short.mp4")
+        responses = [
+            server._serve_cached_file(
+                make_mocked_request("GET", "/content/thumb/bbb_short.mp4"),
+                os.path.join(self.cache_folder, cache_file),
+                source_file,
+                "image/gif",
+            )
+            for cache_file in ("gif", "webp")
+        ]
+        assert responses[0].headers["ETag"] != responses[1].headers["ETag"]
+
+        response = server._serve_cached_file(
+            make_mocked_request(
+                "GET",
+                "/content/thumb/bbb_short.mp4",
+                headers={"If-None-Match": responses[0].headers["ETag"]},
+            ),
+            os.path.join(self.cache_folder, "webp"),
+            source_file,
+            "image/webp",
+        )
+        assert response.status == 200
+
+    async def test_concurrent_requests_share_error(self):
+        generated = []
+
+        async def fake_run_async(func, path, cache_folder, page, thumbnail_format):
+            generated.append(path)
+            await asyncio.sleep(0.1)
+            raise FileNotFoundError
+
+        requests = [
+            make_mocked_request(
+                "GET", "/content/thumb/missing.jpg", match_info={"path": "missing.jpg"}
+            )
+            for _ in range(50)
+        ]
+        with patch.object(server, "run_async", fake_run_async), patch.object(
+            config, "THUMBNAIL_CACHE_PATH", self.cache_folder
+        ):
+            results = await asyncio.gather(
+                *[server.handle_thumbnail_request(r) for r in requests],
+                return_exceptions=True,
+            )
+
+        assert len(generated) == 1
+        assert all(isinstance(r, HTTPNotFound) for r in results)
+
+
+class TestReducedDecoding(unittest.TestCase):
+    def test_read_jpeg_header(self):
+        assert image.read_jpeg_header(
+            os.path.join(config.SANDBOX_PATH, "chess.jpg")
+        ) == (1000, 1000, 3)
+        assert (
+            image.read_jpeg_header(os.path.join(config.SANDBOX_PATH, "file.pdf"))
+            is None
+        )
+
+    def test_read_image_size(self):
+        assert image.read_image_size(
+            os.path.join(config.SANDBOX_PATH, "chess.jpg")
+        ) == (1000, 1000)
+        path = "/tmp/test_image_size.png"
+        cv2.imwrite(path, numpy.zeros((20, 30, 3), numpy.uint8))
+        assert image.read_image_size(path) == (30, 20)
+        assert image.is_fitting(30, 20, 60, 40)
+        assert image.is_fitting(30, 20, 30, 25)
+        assert not image.is_fitting(30, 20, 20, 20)
+
+    def test_reduction_factor(self):
+        assert image.get_jpeg_reduction_factor(1000, 1000, 256, 256, "fit") == 2
+        assert image.get_jpeg_reduction_factor(4000, 3000, 256, 256, "fit") == 8
+        assert image.get_jpeg_reduction_factor(4000, 1000, 256, 256, "fill") == 2
+        # image smaller than box is not resized, so it has to be fully decoded
+        assert image.get_jpeg_reduction_factor(1000, 1000, 1000, 1000, "fit") == 1
+
+    def test_reduced_resize(self):
+        path = os.path.join(config.SANDBOX_PATH, "chess.jpg")
+        resized, _ = image.resize_image(path, 256, 128, "fill", ".jpg")
+        resized = cv2.imdecode(
+            numpy.frombuffer(resized, numpy.uint8), cv2.IMREAD_UNCHANGED
+        )
+        assert resized.shape == (128, 256, 3)
+
+
+class TestPdfRendering(unittest.TestCase):
+    path = os.path.join(config.SANDBOX_PATH, "file.pdf")
+
+    def test_thumbnail(self):
+        thumbnail, _ = image.generate_pdf(self.path, 256, 256, "fit")
+        thumbnail = cv2.imdecode(
+            numpy.frombuffer(thumbnail, numpy.uint8), cv2.IMREAD_UNCHANGED
+        )
+        assert thumbnail.shape == (256, 181, 3)
+
+        thumbnail, _ = image.generate_pdf(self.path, 70, 50, "fill")
+        thumbnail = cv2.imdecode(
+            numpy.frombuffer(thumbnail, numpy.uint8), cv2.IMREAD_UNCHANGED
+        )
+        assert thumbnail.shape == (50, 70, 3)
+
+    def test_page_out_of_range(self):
+        with self.assertRaises(ValueError):
+            image.generate_pdf(self.path, 256, 256, "fit", 1)
+        with self.assertRaises(ValueError):
+            content_manager.get_thumbnail("chess.jpg", page=1)
+
+
+class TestVideoProbe(unittest.TestCase):
+    path = os.path.join(config.SANDBOX_PATH, "chess.jpg")
+
+    def setUp(self):
+        video._probe_video.cache_clear()
+
+    def probe(self, output):
+        with patch.object(video.subprocess, "Popen") as popen:
+            popen.return_value.communicate.return_value = (output, b"")
+            metadata = video.probe_video(self.path)
+            # second probe is served from cache
+            assert video.probe_video(self.path) == metadata
+            assert popen.call_count == 1
+        return metadata
+
+    def test_probe(self):
+        metadata = self.probe(
+            b'{"streams": [{"width": 3840, "height": 2160}],'
+            b' "format": {"duration": "10.5"}}'
+        )
+        assert metadata == video.VideoMetadata(3840, 2160, 10.5)
+
+    def test_probe_rotated(self):
+        metadata = self.probe(
+            b'{"streams": [{"width": 3840, "height": 2160,'
+            b' "side_data_list": [{"rotation": -90}]}], "format": {}}'
+        )
+        assert metadata == video.VideoMetadata(2160, 3840, None)
+
+    def test_probe_no_stream(self):
+        with self.assertRaises(ValueError):
+            self.probe(b'{"streams": []}')
+
+
+class TestVideoThumbnailFormat(aiounittest.AsyncTestCase):
+    def test_negotiation(self):
+        path = "bbb_short.mp4"
+        get_format = content_manager.get_thumbnail_format
+        assert get_format(path) == config.VIDEO_THUMBNAIL_FORMAT
+        assert get_format(path, accept="*/*") == config.VIDEO_THUMBNAIL_FORMAT
+        assert get_format(path, accept="image/avif,image/webp,*/*;q=0.8") == "webp"
+        assert get_format(path, accept="image/webp;q=0.5,video/mp4") == "mp4"
+        assert get_format(path, "jpg", accept="image/webp") == "jpg"
+        with self.assertRaises(ValueError):
+            get_format(path, "png")
+
+        assert get_format("chess.jpg", accept="image/webp") is None
+        with self.assertRaises(ValueError):
+            get_format("chess.jpg", "webp")
+
+    def test_ffmpeg_args(self):
+        for thumbnail_format in config.VIDEO_THUMBNAIL_CONTENT_TYPES:
+            args = video.compile_ffmpeg_args(
+                "0:00:00", "video.mp4", "70:-1", "fill", 70, 50, thumbnail_format
+            )
+            filters = args[args.index("-vf") + 1]
+            assert "crop=70:50" in filters
+            assert (
+                args[args.index("-f") + 1]
+                == {
+                    "gif": "gif",
+                    "webp": "webp",
+                    "mp4": "mp4",
+                    "jpg": "image2",
+                }[thumbnail_format]
+            )
+        with self.assertRaises(ValueError):
+            video.compile_ffmpeg_args(
+                "0:00:00", "video.mp4", "70:-1", "fit", 70, 50, "png"
+            )
+
+    def test_cache_file_per_format(self):
+        assert utils.get_thumbnail_cache_file(
+            "bbb_short.mp4", thumbnail_format="webp"
+        ) != utils.get_thumbnail_cache_file("bbb_short.mp4", thumbnail_format="gif")
+        # thumbnails cached before formats were selectable are GIF thumbnails
+        assert utils.get_thumbnail_cache_file(
+            "bbb_short.mp4", thumbnail_format="gif"
+        ) == os.path.join(*utils.get_dir_file_hash_pair("bbb_short.mp4"))
+        response = content_manager._create_file_url_response("bbb_short.mp4")
+        assert response["poster"] == f"{response['thumbnail']}?format=jpg"
+
+    async def test_negotiated_thumbnail_request(self):
+        cache_folder = "/tmp/testthumbnails"
+        generated = []
+
+        async def fake_run_async(func, path, cache_folder, page, thumbnail_format):
+            generated.append(thumbnail_format)
+            cache_file = utils.get_thumbnail_cache_file(path, page, thumbnail_format)
+            os.makedirs(
+                os.path.dirname(os.path.join(cache_folder, cache_file)), exist_ok=True
+            )
+            open(os.path.join(cache_folder, cache_file), "w")
+
+        def request(query="", headers=None):
+            return make_mocked_request(
+                "GET",
+                f"/content/thumb/bbb_short.mp4{query}",
+                headers=headers,
+                match_info={"path": "bbb_short.mp4"},
+            )
+
+        with patch.object(server, "run_async", fake_run_async), patch.object(
+            config, "THUMBNAIL_CACHE_PATH", cache_folder
+        ):
+            response = await server.handle_thumbnail_request(
+                request(headers={"Accept": "image/webp,*/*"})
+            )
+            assert response.headers["Vary"] == "Accept"
+            assert response.location.endswith(
+                utils.get_thumbnail_cache_file("bbb_short.mp4", 0, "webp")
+            )
+            response = await server.handle_thumbnail_request(
+                request("?format=jpg", {"Accept": "image/webp,*/*"})
+            )
+            assert "Vary" not in response.headers
+        assert generated == ["webp", "jpg"]
+        shutil.rmtree(cache_folder)
+
+
+class TestMemoryCache(aiounittest.AsyncTestCase):
+    file_name = "memory_cache_test.jpg"
+
+    def setUp(self):
+        content_manager.scaled_image_cache.clear()
+        shutil.copy(
+            os.path.join(config.SANDBOX_PATH, "chess.jpg"),
+            os.path.join(config.SANDBOX_PATH, self.file_name),
+        )
+
+    def tearDown(self):
+        os.remove(os.path.join(config.SANDBOX_PATH, self.file_name))
+
+    async def test_repeated_requests_hit_cache(self):
+        calls = []
+
+        async def fake_run_async(func, *args):
+            calls.append(args)
+            return b"image", "jpg"
+
+        with patch.object(content_manager, "run_async", fake_run_async), patch.object(
+            config, "SCALED_CACHE_BUCKETS", []
+        ):
+            for _ in range(3):
+                data = await content_manager.get_scaled_image(self.file_name, 100, 100)
+                assert data == (b"image", "image/jpg")
+            assert len(calls) == 1
+
+            # touching the source invalidates the cached entry
+            absolute_path = os.path.join(config.SANDBOX_PATH, self.file_name)
+            stat = os.stat(absolute_path)
+            os.utime(absolute_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            await content_manager.get_scaled_image(self.file_name, 100, 100)
+            assert len(calls) == 2
+
+
+class TestScaledCache(aiounittest.AsyncTestCase):
+    cache_folder = "/tmp/testscaled"
+
+    def setUp(self):
+        if os.path.exists(self.cache_folder):
+            shutil.rmtree(self.cache_folder)
+        content_manager.scaled_image_cache.clear()
+        self.config_patch = patch.object(config, "SCALED_CACHE_PATH", self.cache_folder)
+        self.config_patch.start()
+        # workers need to be forked with patched config
+        asynchro.shutdown_worker_pool()
+
+    def tearDown(self):
+        self.config_patch.stop()
+        asynchro.shutdown_worker_pool()
+
+    def test_snap_to_bucket(self):
+        with patch.object(config, "SCALED_CACHE_BUCKETS", [512, 1024, 2048]):
+            assert scaled_cache.snap_to_bucket(500, 100, "fit") == (512, 512)
+            assert scaled_cache.snap_to_bucket(1920, 1080, "fit") == (2048, 2048)
+            assert scaled_cache.snap_to_bucket(1000, 500, "fill") == (1024, 512)
+            assert scaled_cache.snap_to_bucket(4000, 100, "fit") is None
+
+    async def test_scaled_image_from_bucket(self):
+        data = await content_manager.get_scaled_image("chess.jpg", 100, 50)
+        img = cv2.imdecode(numpy.frombuffer(data[0], numpy.uint8), cv2.IMREAD_UNCHANGED)
+        assert img.shape == (50, 50, 3)
+
+        cache_file = scaled_cache.get_cache_file("chess.jpg", 512, 512, "fit")
+        cached = cv2.imread(os.path.join(self.cache_folder, cache_file))
+        assert cached.shape == (512, 512, 3)
+
+        assert (
+            await content_manager.get_scaled_image_cache_file("chess.jpg", 512, 512)
+            == cache_file
+        )
+        assert (
+            await content_manager.get_scaled_image_cache_file("chess.jpg", 100, 50)
+            is None
+        )
+
+    async def test_fit_request_served_from_bucket(self):
+        # the 1000x1000 image fits the 1024x512 bucket as 512x512
+        cache_file = scaled_cache.get_cache_file("chess.jpg", 1024, 512, "fit")
+        assert (
+            await content_manager.get_scaled_image_cache_file("chess.jpg", 600, 512)
+            == cache_file
+        )
+        # not re-encoded
+        data = await content_manager.get_scaled_image("chess.jpg", 600, 512)
+        with open(os.path.join(self.cache_folder, cache_file), "rb") as f:
+            assert data == (f.read(), "image/jpg")
+
+        assert (
+            await content_manager.get_scaled_image_cache_file(
+                "chess.jpg", 600, 512, "fill"
+            )
+            is None
+        )
+
+    def test_evict(self):
+        os.makedirs(self.cache_folder)
+        for i in range(5):
+            file = os.path.join(self.cache_folder, str(i))
+            with open(file, "wb") as f:
+                f.write(b"0" * 100)
+            os.utime(file, (i, i))
+
+        assert scaled_cache.evict(self.cache_folder, 300) == 2
+        assert sorted(os.listdir(self.cache_folder)) == ["2", "3", "4"]
+
+    async def test_purge_failures_are_retried(self):
+        purges = []
+
+        def evict(cache_path, max_size):
+            purges.append(None)
+            raise OSError("busy")
+
+        async def sleep(delay):
+            if len(purges) == 2:
+                raise asyncio.CancelledError()
+
+        with patch.object(scaled_cache, "evict", evict), patch("asyncio.sleep", sleep):
+            with self.assertRaises(asyncio.CancelledError):
+                await scaled_cache.purge_scaled_cache()
+        assert len(purges) == 2
+
+
+class FakeWebSocket:
+    closed = False
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, message):
+        self.sent.append(json.loads(message))
+
+
+class TestSearchResult(aiounittest.AsyncTestCase):
+    search_id = "test_search"
+
+    def setUp(self):
+        self.result = {
+            "done": False,
+            "files": [],
+            "directories": ["./a"],
+            "truncated": False,
+        }
+        fs_manager.fs_search_results[self.search_id] = self.result
+
+    def tearDown(self):
+        fs_manager.fs_search_results.pop(self.search_id, None)
+
+    def test_cursor(self):
+        result = fs_manager.get_search_result(self.search_id)
+        assert result["directories"] == ["./a"] and not result["done"]
+
+        self.result["files"].append({"name": "./b", "size": 1})
+        self.result["done"] = True
+        result = fs_manager.get_search_result(self.search_id, result["cursor"])
+        assert result["done"] and result["directories"] == []
+        assert result["files"] == [{"name": "./b", "size": 1}]
+        assert fs_manager.get_search_result(self.search_id, result["cursor"]) == {
+            **result,
+            "files": [],
+        }
+        # kept for other clients
+        assert len(fs_manager.get_search_result(self.search_id)["files"]) == 1
+
+        with self.assertRaises(ValueError):
+            fs_manager.get_search_result(self.search_id, "-1.0")
+
+    async def test_push(self):
+        ws = FakeWebSocket()
+        subscriber = Subscriber(ws)
+        with patch.object(config, "SEARCH_PUSH_INTERVAL", 0.01):
+            pushing = asyncio.ensure_future(
+                ws_handlers.push_search_result(self.search_id, subscriber)
+            )
+            await asyncio.sleep(0.05)
+            self.result["files"].append({"name": "./b", "size": 1})
+            self.result["done"] = True
+            await asyncio.wait_for(pushing, 1)
+
+            self.setUp()
+            pushing = asyncio.ensure_future(
+                ws_handlers.push_search_result(self.search_id, subscriber)
+            )
+            await asyncio.sleep(0.05)
+            # e.g. timed out
+            self.tearDown()
+            await asyncio.wait_for(pushing, 1)
+        await asyncio.sleep(0)
+
+        assert [(m["method"], m["params"]["done"]) for m in ws.sent[:2]] == [
+            ("SearchMatches", False),
+            ("SearchMatches", True),
+        ]
+        assert ws.sent[0]["params"]["directories"] == ["./a"]
+        assert ws.sent[1]["params"]["files"] == [{"name": "./b", "size": 1}]
+        assert ws.sent[1]["params"]["directories"] == []
+        assert ws.sent[3] == {
+            "method": "SearchStopped",
+            "params": {"searchId": self.search_id},
+        }
+
+
+class TestSearchQuery(unittest.TestCase):
+    def test_name(self):
+        query = SearchQuery("Beach")
+        assert query.is_substring and not hasattr(query, "regex")
+        assert query.matches_name("my_beach.jpg")
+        assert not SearchQuery("^beach").matches_name("my_beach.jpg")
+        with self.assertRaises(ValueError):
+            SearchQuery("beach(")
+
+    def test_filters(self):
+        query = SearchQuery(
+            "a", types=["video"], extensions=[".PNG"], min_size=10, max_size=100
+        )
+        assert query.files_only
+        assert query.matches_file("a.png", 10, 0)
+        assert query.matches_file("a.MP4", 100, 0)
+        assert not query.matches_file("a.pdf", 50, 0)
+        assert not query.matches_file("a.png", 101, 0)
+
+        query = SearchQuery("a", modified_after=10, modified_before=20)
+        assert not query.files_only
+        assert query.matches_mtime(15) and not query.matches_mtime(21)
+
+        query = SearchQuery("a", exclude=["/photos/", "videos/2022"])
+        assert query.is_excluded("cache") and query.is_excluded("photos/2022")
+        assert not query.is_excluded("videos") and not query.is_excluded("photo")
+
+    def test_from_params(self):
+        query = SearchQuery.from_params({"name": "a", "max_results": 10**9})
+        assert query.max_results == config.SEARCH_MAX_RESULTS
+        assert query.get_key() == SearchQuery("b").get_key()
+        assert query.get_key() != SearchQuery("a", types=["pdf"]).get_key()
+        for params in (
+            {"types": ["sound"]},
+            {"types": "video"},
+            {"min_size": "1"},
+            {"max_results": 0},
+        ):
+            with self.assertRaises(ValueError):
+                SearchQuery.from_params({"name": "a", **params})
+
+
+class TestSearchExecutor(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.patches = [
+            patch.object(fs_manager, "crawl", self.blocked_crawl),
+            patch.object(config, "SEARCH_INDEX_REFRESH_INTERVAL", 0),
+            patch.object(config, "SEARCH_MAX_CONCURRENT", 1),
+            patch.object(config, "SEARCH_MAX_PER_CLIENT", 2),
+        ]
+        for p in self.patches:
+            p.start()
+        fs_manager.search_stats.update(dict.fromkeys(fs_manager.search_stats, 0))
+
+    def tearDown(self):
+        self.release.set()
+        fs_manager.shutdown_search_executor()
+        fs_manager.fs_search_results.clear()
+        fs_manager.client_searches.clear()
+        for p in self.patches:
+            p.stop()
+
+    def blocked_crawl(self, paths, query, dirs, files, threads, stop_event):
+        while not stop_event.is_set() and not self.release.is_set():
+            stop_event.wait(0.01)
+        return False
+
+    def wait_for_state(self, search_id, state):
+        for _ in range(100):
+            if fs_manager.search_crawlers[search_id].state == state:
+                return
+            time.sleep(0.01)
+        raise AssertionError(f"{search_id} not {state}")
+
+    def test_queue_and_cancel(self):
+        client_a, client_b = object(), object()
+        running = fs_manager.search_file(SearchQuery("abc"), "", client_a)
+        self.wait_for_state(running, fs_manager.RUNNING)
+        queued = fs_manager.search_file(SearchQuery("xyz"), "folder1", client_b)
+        stats = fs_manager.get_search_stats()
+        assert stats["running"] == 1 and stats["queued"] == 1
+
+        # shared with client a
+        assert fs_manager.search_file(SearchQuery("abc"), "", client_b) == running
+        assert not fs_manager.cancel_search(running, client_b)
+        assert fs_manager.search_crawlers[running].state == fs_manager.RUNNING
+
+        assert fs_manager.cancel_search(queued, client_b)
+        assert queued not in fs_manager.fs_search_results
+        # disconnected clients are forgotten, their searches go on
+        fs_manager.release_client_searches(client_a)
+        fs_manager.release_client_searches(client_b)
+        assert fs_manager.search_crawlers[running].state == fs_manager.RUNNING
+        crawler = fs_manager.search_crawlers[running]
+        assert fs_manager.cancel_search(running, object())
+        crawler.future.result(1)
+        assert crawler.state == fs_manager.STOPPED
+        assert fs_manager.get_search_stats()["cancelled"] == 2
+        with self.assertRaises(KeyError):
+            fs_manager.cancel_search(running)
+
+    def test_supersede(self):
+        client = object()
+        first = fs_manager.search_file(SearchQuery("a"), "", client)
+        other_path = fs_manager.search_file(SearchQuery("ab"), "folder1", client)
+        second = fs_manager.search_file(SearchQuery("ab"), "", client)
+        assert first not in fs_manager.search_crawlers
+        assert {other_path, second} == fs_manager.client_searches[client]
+        assert fs_manager.get_search_stats()["superseded"] == 1
+
+        with self.assertRaises(CodeException):
+            fs_manager.search_file(SearchQuery("ab", types=["pdf"]), "", client)
+
+        self.release.set()
+        self.wait_for_state(second, fs_manager.FINISHED)
+        self.wait_for_state(other_path, fs_manager.FINISHED)
+        assert fs_manager.get_search_result(second)["done"]
+        # finished searches are kept
+        assert not fs_manager.cancel_search(second, client)
+        assert fs_manager.get_search_result(second)["done"]
+
+
+class TestCrawl(unittest.TestCase):
+    def test_crawl(self):
+        root = os.path.join(config.SANDBOX_PATH, "folder1")
+        query = SearchQuery("folder|file1")
+        found_dirs, found_files = [], []
+        fs_manager.crawl([root], query, found_dirs, found_files, 4, threading.Event())
+        assert found_dirs == ["folder1/folder2"]
+        assert [file["name"] for file in found_files] == ["folder1/file1"]
+        assert found_files[0]["size"] == os.path.getsize(os.path.join(root, "file1"))
+
+        stop_event = threading.Event()
+        stop_event.set()
+        found_dirs, found_files = [], []
+        fs_manager.crawl([root], query, found_dirs, found_files, 4, stop_event)
+        assert found_dirs == found_files == []
+
+    def test_filters(self):
+        found_dirs, found_files = [], []
+        query = SearchQuery("e", types=["image"], exclude=["folder1"])
+        fs_manager.crawl(
+            [config.SANDBOX_PATH], query, found_dirs, found_files, 4, threading.Event()
+        )
+        assert found_dirs == []
+        names = [file["name"] for file in found_files]
+        assert "./chess.jpg" in names and "folder1/folder2/chess.jpg" not in names
+        assert all(os.path.splitext(name)[1] in (".jpg", ".png") for name in names)
+
+        found_dirs, found_files = [], []
+        query = SearchQuery("e", max_results=2)
+        truncated = fs_manager.crawl(
+            [config.SANDBOX_PATH], query, found_dirs, found_files, 4, threading.Event()
+        )
+        assert truncated and len(found_dirs) + len(found_files) == 2
+
+
+class TestFileIndex(unittest.TestCase):
+    root = "/tmp/testindex"
+    index_path = "/tmp/testindex_cache/index.sqlite"
+
+    def setUp(self):
+        for folder in (self.root, os.path.dirname(self.index_path)):
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+        for folder in ("Photos/2022", "Photos/2023", "videos", "cache"):
+            os.makedirs(os.path.join(self.root, folder))
+        for file in ("Photos/2022/beach.JPG", "videos/beach.mp4", "cache/beach.png"):
+            with open(os.path.join(self.root, file), "wb") as f:
+                f.write(b"0" * 10)
+        self.index = file_index.FileIndex(self.index_path)
+
+    def tearDown(self):
+        self.index.close()
+
+    def search(self, query, path=".", **filters):
+        return self.index.search(SearchQuery(query, **filters), path)[:3]
+
+    def test_search(self):
+        excluded = [os.path.join(self.root, "cache")]
+        assert self.index.refresh(self.root, excluded) == (5, 5)
+        directories, files, unindexed = self.search("beach")
+        assert directories == [] and unindexed == []
+        assert sorted(files, key=lambda f: f["name"]) == [
+            {"name": "Photos/2022/beach.JPG", "size": 10},
+            {"name": "videos/beach.mp4", "size": 10},
+        ]
+        assert self.search("BEACH", "Photos")[1] == [
+            {"name": "Photos/2022/beach.JPG", "size": 10}
+        ]
+        assert sorted(self.search("^20\\d+$")[0]) == ["Photos/2022", "Photos/2023"]
+        assert self.search("photos")[0] == ["./Photos"]
+
+    def test_search_without_names_index(self):
+        os.makedirs(os.path.join(self.root, "Photos-old"))
+        with open(os.path.join(self.root, "Photos-old", "beach.jpg"), "wb") as f:
+            f.write(b"0")
+        self.index.refresh(self.root)
+        # e.g. SQLite < 3.34, names are matched with LIKE rather than in Python
+        self.index.has_names_index = False
+        with patch.object(SearchQuery, "matches_name", side_effect=AssertionError):
+            assert self.search("BEACH", "Photos")[1] == [
+                {"name": "Photos/2022/beach.JPG", "size": 10}
+            ]
+            assert self.search("ch", "Photos-old")[1] == [
+                {"name": "Photos-old/beach.jpg", "size": 1}
+            ]
+
+    def test_search_filters(self):
+        self.index.refresh(self.root)
+        assert self.search("beach", types=["video"])[1] == [
+            {"name": "videos/beach.mp4", "size": 10}
+        ]
+        assert self.search("beach", exclude=["videos"])[1] == [
+            {"name": "Photos/2022/beach.JPG", "size": 10}
+        ]
+        assert self.search("beach", min_size=11)[1] == []
+        assert self.search("20", modified_after=time.time() + 60) == ([], [], [])
+        query = SearchQuery("20", max_results=1)
+        directories, files, unindexed, truncated = self.index.search(query)
+        assert len(directories) == 1 and truncated
+
+    def test_stopped_search(self):
+        self.index.refresh(self.root)
+        stop_event = threading.Event()
+
+        def matches_name(name):
+            # e.g. cancelled while names are scanned
+            stop_event.set()
+            return True
+
+        query = SearchQuery("^.*$")
+        with patch.object(query, "matches_name", matches_name), patch.object(
+            file_index, "PROGRESS_HANDLER_INSTRUCTIONS", 1
+        ):
+            assert self.index.search(query, stop_event=stop_event) == (
+                [],
+                [],
+                [],
+                False,
+            )
+        # the handler is removed once the search is over
+        assert len(self.search("^.*$")[0]) == 4
+
+    def test_incremental_refresh(self):
+        self.index.refresh(self.root)
+        assert self.index.refresh(self.root) == (6, 0)
+
+        with open(os.path.join(self.root, "videos", "sea.mp4"), "wb") as f:
+            f.write(b"0")
+        shutil.rmtree(os.path.join(self.root, "Photos", "2022"))
+        assert self.index.refresh(self.root) == (5, 2)
+        assert self.search("sea")[1] == [{"name": "videos/sea.mp4", "size": 1}]
+        assert self.search("beach", "Photos")[1] == []
+
+    def test_unindexed_subtrees(self):
+        assert self.search("beach", "videos") == ([], [], ["videos"])
+
+        stop_event = threading.Event()
+        stop_event.set()
+        self.index.refresh(self.root, stop_event=stop_event)
+        assert self.search("beach") == ([], [], ["."])
+
+        # only the root is indexed
+        self.index._index_directory(
+            ".", self.root, os.stat(self.root).st_mtime_ns, set()
+        )
+        # the cache folder is never searched
+        assert sorted(self.search("beach")[2]) == ["Photos", "videos"]
+
+    def test_open_stale_index(self):
+        with patch.object(config, "SEARCH_INDEX_PATH", self.index_path), patch.object(
+            config, "SEARCH_INDEX_REFRESH_INTERVAL", 60
+        ):
+            # never refreshed
+            assert file_index.open_index() is None
+
+            self.index.refresh(self.root)
+            index = file_index.open_index()
+            assert index is not None
+            index.close()
+
+            # no refresh progress for too long, e.g. the refresh loop stopped
+            stale = time.time() - 60 * file_index.STALE_INDEX_INTERVALS - 1
+            with patch("time.time", return_value=stale):
+                self.index.refresh(self.root)
+            assert file_index.open_index() is None
+
+    def test_refresh_failures_are_retried(self):
+        refreshes = []
+
+        def refresh_index():
+            refreshes.append(None)
+            if len(refreshes) == 1:
+                raise OSError("busy")
+            file_index.refresh_stop_event.set()
+
+        async def sleep(delay):
+            pass
+
+        with patch.object(file_index, "refresh_index", refresh_index), patch.object(
+            config, "SEARCH_INDEX_REFRESH_INTERVAL", 60
+        ), patch("asyncio.sleep", sleep):
+            try:
+                asyncio.run(file_index.refresh_search_index())
+            finally:
+                file_index.refresh_stop_event.clear()
+        assert len(refreshes) == 2
+
+
+class TestPyramid(unittest.TestCase):
+    cache_folder = "/tmp/testtiles"
+
+    def setUp(self):
+        if os.path.exists(self.cache_folder):
+            shutil.rmtree(self.cache_folder)
+
+    def test_build_pyramid(self):
+        pyramid_folder = content_manager.cache_image_pyramid(
+            "HorizontalGroup.jpg", self.cache_folder
+        )
+        img = cv2.imread(os.path.join(config.SANDBOX_PATH, "HorizontalGroup.jpg"))
+        height, width = img.shape[:2]
+
+        descriptor = pyramid.read_descriptor(pyramid_folder)
+        max_level = descriptor["MaxLevel"]
+        assert max_level == pyramid.get_max_level(width, height)
+        assert descriptor["Image"]["Size"] == {
+            "Width": str(width),
+            "Height": str(height),
+        }
+
+        for level in (max_level, max_level - 3, 0):
+            scale = 2 ** (max_level - level)
+            columns = math.ceil(math.ceil(width / scale) / config.TILE_SIZE)
+            rows = math.ceil(math.ceil(height / scale) / config.TILE_SIZE)
+            tiles = os.listdir(os.path.join(pyramid_folder, str(level)))
+            assert len(tiles) == columns * rows
+
+        columns = math.ceil(width / config.TILE_SIZE)
+        rows = math.ceil(height / config.TILE_SIZE)
+        last_tile = cv2.imread(
+            os.path.join(
+                pyramid_folder, pyramid.get_tile_file(max_level, columns - 1, rows - 1)
+            )
+        )
+        assert last_tile.shape[:2] == (
+            height - (rows - 1) * config.TILE_SIZE,
+            width - (columns - 1) * config.TILE_SIZE,
+        )
+        assert cv2.imread(
+            os.path.join(pyramid_folder, pyramid.get_tile_file(0, 0, 0))
+        ).shape[:2] == (1, 1)
+
+        with self.assertRaises(FileExistsError):
+            content_manager.cache_image_pyramid(
+                "HorizontalGroup.jpg", self.cache_folder
+            )
+
+    def test_large_images(self):
+        source = os.path.join(config.SANDBOX_PATH, "HorizontalGroup.jpg")
+        pyramid_folder = os.path.join(self.cache_folder, "pyramid")
+        # 14950x3910 decoded at a quarter of its resolution
+        with patch.object(config, "TILES_MAX_PIXELS", 14950 * 3910 // 10):
+            descriptor = pyramid.build_pyramid(source, pyramid_folder)
+        assert descriptor["Image"]["Size"] == {"Width": "3738", "Height": "978"}
+
+        png = os.path.join(self.cache_folder, "large.png")
+        os.makedirs(self.cache_folder, exist_ok=True)
+        cv2.imwrite(png, numpy.zeros((200, 300, 3), numpy.uint8))
+        with patch.object(config, "TILES_MAX_PIXELS", 300 * 200 - 1):
+            with self.assertRaises(ValueError):
+                pyramid.build_pyramid(png, pyramid_folder)
+
+    def test_evict(self):
+        for i, name in enumerate(("a", "b", "c")):
+            pyramid_folder = os.path.join(self.cache_folder, "d", name)
+            os.makedirs(os.path.join(pyramid_folder, "0"))
+            with open(os.path.join(pyramid_folder, "0", "0_0.jpg"), "wb") as f:
+                f.write(b"0" * 100)
+            descriptor = os.path.join(pyramid_folder, pyramid.DESCRIPTOR_FILE)
+            with open(descriptor, "w") as f:
+                f.write("{}")
+            os.utime(descriptor, (1000 * (i + 1), 0))
+        os.makedirs(os.path.join(self.cache_folder, "d", "d.1.tmp"))
+
+        assert pyramid.evict(self.cache_folder, 250) == 1
+        assert sorted(os.listdir(os.path.join(self.cache_folder, "d"))) == [
+            "b",
+            "c",
+            "d.1.tmp",
+        ]
 
 
 class TestContentOptimization(unittest.TestCase):
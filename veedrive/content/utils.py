@@ -12,9 +12,9 @@ def sanitize_path(func):
     """Sanitize a path passed to a function."""
 
     @wraps(func)
-    def validate(*args):
+    def validate(*args, **kwargs):
         path = fix_root_slash(args[0])
-        return func(path, *args[1:])
+        return func(path, *args[1:], **kwargs)
 
     return validate
 
@@ -62,6 +62,23 @@ def get_dir_file_hash_pair(file):
     return hashed_path[:2], hashed_path[2:]
 
 
+def is_cache_fresh(cache_file, source_file):
+    """Check if a cached file exists and is newer than its source."""
+    try:
+        return os.stat(cache_file).st_mtime >= os.stat(source_file).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def get_thumbnail_cache_file(file, page=0, thumbnail_format=None):
+    """Get path of a thumbnail, relative to the thumbnail cache folder."""
+    key = file if not page else f"{file}?page={page}"
+    # GIF video thumbnails keep the key they had before formats were selectable
+    if thumbnail_format and thumbnail_format != config.GIF_VIDEO_THUMBNAIL:
+        key = f"{key}?format={thumbnail_format}"
+    return os.path.join(*get_dir_file_hash_pair(key))
+
+
 def create_cache_subfolders(cache_path):
     cache_dirs = [
         val1.lower() + val2.lower()
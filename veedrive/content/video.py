@@ -1,35 +1,129 @@
+import collections
 import datetime
+import functools
+import json
+import logging
 import math
+import os
 import subprocess
-
-import cv2
+import time
 
 from .. import config
 
+VideoMetadata = collections.namedtuple("VideoMetadata", ["width", "height", "duration"])
+
+PREVIEW_FPS = 10
+PREVIEW_DURATION = 3
 
-def get_video_thumbnail(path, box_width, box_height, scaling_mode):
-    video = cv2.VideoCapture(path)
-    video_height = video.get(cv2.CAP_PROP_FRAME_HEIGHT)
-    video_width = video.get(cv2.CAP_PROP_FRAME_WIDTH)
+
+def get_video_thumbnail(
+    path,
+    box_width,
+    box_height,
+    scaling_mode,
+    thumbnail_format=config.GIF_VIDEO_THUMBNAIL,
+):
+    """Get a preview of a video, starting at 1% of its duration
+
+    :param path: absolute path of the video
+    :type path: str
+    :param box_width: width of a sizebox
+    :type box_width: int
+    :param box_height: height of a sizebox
+    :type box_height: int
+    :param scaling_mode: mode to scale the video, 'fit' or 'fill'
+    :type scaling_mode: str
+    :param thumbnail_format: animated preview ('gif', 'webp', 'mp4')
+        or poster frame ('jpg'), defaults to 'gif'
+    :type thumbnail_format: str
+    :return: encoded preview
+    :rtype: bytes
+    """
+    t_start = time.perf_counter()
+    metadata = probe_video(path)
 
     # seek until 1% of video's duration
-    video_duration = _get_video_length(path)
-    seek_time = str(datetime.timedelta(seconds=int(math.floor(video_duration / 100))))
+    seek_time = str(
+        datetime.timedelta(seconds=int(math.floor((metadata.duration or 0) / 100)))
+    )
 
     # fit the output to the specified box
     requested_size = calculate_size(
-        scaling_mode, box_width, box_height, video_width, video_height
+        scaling_mode, box_width, box_height, metadata.width, metadata.height
     )
 
     ffargs = compile_ffmpeg_args(
-        seek_time, path, requested_size, scaling_mode, box_width, box_height
+        seek_time,
+        path,
+        requested_size,
+        scaling_mode,
+        box_width,
+        box_height,
+        thumbnail_format,
     )
+    t_probed = time.perf_counter()
     process = subprocess.Popen(ffargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     stdout, stderr = process.communicate()
+    t_encoded = time.perf_counter()
+    logging.debug(
+        f"Video thumbnail ({thumbnail_format}) of {path}: probe {t_probed - t_start:.3f} s, "
+        f"encoding {t_encoded - t_probed:.3f} s"
+    )
     return stdout
 
 
+def probe_video(path):
+    """Get dimensions and duration of a video with a single ffprobe call.
+    Results are cached per path and modification time.
+
+    :param path: absolute path of the video
+    :type path: str
+    :return: width, height and duration (in seconds, None if unknown) of the video
+    :rtype: VideoMetadata
+    """
+    return _probe_video(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1024)
+def _probe_video(path, mtime_ns):
+    ffprobe_args = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=width,height:stream_tags=rotate:stream_side_data=rotation"
+        ":format=duration",
+        "-of",
+        "json",
+        path,
+    ]
+
+    proc = subprocess.Popen(
+        ffprobe_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = proc.communicate()
+    try:
+        probe = json.loads(stdout)
+        stream = probe["streams"][0]
+        width, height = int(stream["width"]), int(stream["height"])
+    except (ValueError, KeyError, IndexError):
+        raise ValueError(f"Cannot read video stream of {os.path.basename(path)}")
+    # ffmpeg applies rotation metadata when decoding, dimensions have to follow
+    rotation = stream.get("tags", {}).get("rotate", 0)
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    if abs(int(rotation)) % 180 == 90:
+        width, height = height, width
+    try:
+        duration = float(probe["format"]["duration"])
+    except (ValueError, KeyError):
+        duration = None
+    return VideoMetadata(width, height, duration)
+
+
 def calculate_size(scaling_mode, box_width, box_height, video_width, video_height):
     if scaling_mode == config.FIT_TRANSFORM_IMAGE:
         requested_aspect = box_width / box_height
@@ -50,45 +144,88 @@ def calculate_size(scaling_mode, box_width, box_height, video_width, video_heigh
 
 
 def compile_ffmpeg_args(
-    seek_time, path, requested_size, scaling_mode, box_width, box_height
+    seek_time,
+    path,
+    requested_size,
+    scaling_mode,
+    box_width,
+    box_height,
+    thumbnail_format=config.GIF_VIDEO_THUMBNAIL,
 ):
-    extra_ffmpeg_params = ""
+    filters = [f"scale={requested_size}:flags=lanczos"]
     if scaling_mode == config.FILL_TRANSFORM_IMAGE:
-        crop_area = f"{box_width}:{box_height}"
-        extra_ffmpeg_params = f",crop={crop_area}"
+        filters.append(f"crop={box_width}:{box_height}")
+
+    if thumbnail_format == config.JPG_VIDEO_THUMBNAIL:
+        # single poster frame
+        return [
+            "ffmpeg",
+            "-ss",
+            seek_time,
+            "-y",
+            "-i",
+            path,
+            "-frames:v",
+            "1",
+            "-vf",
+            ",".join(filters),
+            "-c:v",
+            "mjpeg",
+            "-q:v",
+            "3",
+            "-f",
+            "image2",
+            "pipe:1",
+        ]
+
+    filters.insert(0, f"fps={PREVIEW_FPS}")
+    if thumbnail_format == config.GIF_VIDEO_THUMBNAIL:
+        filters.append("split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse")
+        output_args = ["-f", "gif"]
+    elif thumbnail_format == config.WEBP_VIDEO_THUMBNAIL:
+        output_args = [
+            "-c:v",
+            "libwebp",
+            "-quality",
+            "75",
+            "-loop",
+            "0",
+            "-an",
+            "-f",
+            "webp",
+        ]
+    elif thumbnail_format == config.MP4_VIDEO_THUMBNAIL:
+        # yuv420p needs even dimensions, fragmented mp4 can be written to a pipe
+        filters.append("crop=trunc(iw/2)*2:trunc(ih/2)*2")
+        output_args = [
+            "-c:v",
+            "libx264",
+            "-preset",
+            "veryfast",
+            "-crf",
+            "28",
+            "-pix_fmt",
+            "yuv420p",
+            "-an",
+            "-movflags",
+            "frag_keyframe+empty_moov",
+            "-f",
+            "mp4",
+        ]
+    else:
+        raise ValueError(f"Unsupported video thumbnail format {thumbnail_format}")
 
     return [
         "ffmpeg",
         "-ss",
         seek_time,
         "-t",
-        "3",
+        str(PREVIEW_DURATION),
         "-y",
         "-i",
         path,
-        "-f",
-        "gif",
         "-vf",
-        f"fps=10,scale={requested_size}:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse\
-            {extra_ffmpeg_params}",
+        ",".join(filters),
+        *output_args,
         "pipe:1",
     ]
-
-
-def _get_video_length(file):
-    ffprobe_args = [
-        "ffprobe",
-        "-v",
-        "error",
-        "-show_entries",
-        "format=duration",
-        "-of",
-        "default=noprint_wrappers=1:nokey=1",
-        file,
-    ]
-
-    proc = subprocess.Popen(
-        ffprobe_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    stdout, stderr = proc.communicate()
-    return float(stdout)
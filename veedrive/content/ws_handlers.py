@@ -1,7 +1,11 @@
+import asyncio
+
+from .. import config
 from ..utils import jsonrpc
 from ..utils.asynchro import run_async
+from ..utils.exceptions import CodeException
 from . import content_manager, fs_manager
-from .fs_manager import fs_search_results
+from .search_query import SearchQuery
 
 
 @jsonrpc.validate_jsonrpc(required_param="path")
@@ -39,38 +43,70 @@ async def list_directory(data):
 
 
 @jsonrpc.validate_jsonrpc(required_param="name")
-async def search(data):
-    """Handler for Search JSON-RPC method. Search media path for a file"""
-    search_query = data["params"]["name"]
-
+async def search(data, subscriber=None):
+    """Handler for Search JSON-RPC method. Search media path for a file, with
+    optional filters (see SearchQuery). With "push", matches are pushed to the
+    client as SearchMatches notifications instead of being polled with
+    SearchResult. Unfinished searches of the client with the same path and
+    filters are cancelled.
+    """
     try:
-        starting_path = data["params"]["starting_path"]
-        search_id = fs_manager.search_file(search_query, starting_path)
-    except KeyError:
-        search_id = fs_manager.search_file(search_query)
+        search_query = SearchQuery.from_params(data["params"])
+        starting_path = data["params"].get("starting_path", "")
+        search_id = fs_manager.search_file(search_query, starting_path, subscriber)
+    except CodeException:
+        raise
     except Exception as e:
         return jsonrpc.prepare_error(data, 70, str(e))
 
+    if data["params"].get("push") and subscriber:
+        asyncio.ensure_future(push_search_result(search_id, subscriber))
     return jsonrpc.prepare_response(data, {"searchId": search_id})
 
 
+async def push_search_result(search_id, subscriber):
+    """Push the matches of a search as SearchMatches notifications, and
+    SearchStopped if it is stopped before being done
+    """
+    try:
+        async for result in fs_manager.follow_search_result(search_id):
+            if subscriber.ws.closed:
+                return
+            subscriber.notify("SearchMatches", {"searchId": search_id, **result})
+    except KeyError:
+        if not subscriber.ws.closed:
+            subscriber.notify("SearchStopped", {"searchId": search_id})
+
+
 @jsonrpc.validate_jsonrpc(required_param="searchId")
 async def get_search_result(data):
-    """Handler for SearchResult JSON-RPC method """
+    """Handler for SearchResult JSON-RPC method. With the "cursor" returned by a
+    previous call, only matches found since are returned.
+    """
+    search_id = data["params"]["searchId"]
+
+    try:
+        result = fs_manager.get_search_result(search_id, data["params"].get("cursor"))
+    except KeyError:
+        return jsonrpc.prepare_error(
+            data, 69, f"search id {search_id} has not been yet created"
+        )
+    except ValueError as e:
+        return jsonrpc.prepare_error(data, config.MALFORMED_REQUEST, str(e))
+    return jsonrpc.prepare_response(data, result)
+
+
+@jsonrpc.validate_jsonrpc(required_param="searchId")
+async def cancel_search(data, subscriber=None):
+    """Handler for CancelSearch JSON-RPC method. The search is stopped unless
+    other clients run the same search.
+    """
     search_id = data["params"]["searchId"]
 
     try:
-        result = fs_search_results[search_id].copy()
-        try:
-            result.pop("started_at")
-            result.pop("finished_at")
-        except KeyError:
-            pass
-        if result["done"]:
-            fs_search_results.pop(search_id)
-        return jsonrpc.prepare_response(data, result)
-
-    except KeyError as e:
+        cancelled = fs_manager.cancel_search(search_id, subscriber)
+    except KeyError:
         return jsonrpc.prepare_error(
             data, 69, f"search id {search_id} has not been yet created"
         )
+    return jsonrpc.prepare_response(data, {"cancelled": cancelled})
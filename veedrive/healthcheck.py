@@ -1,4 +1,3 @@
-import json
 import logging
 
 import aiohttp
@@ -7,7 +6,7 @@ from sentry_sdk import configure_scope
 
 from .content import fs_manager
 from .presentation import db_manager
-from .utils import jsonrpc
+from .utils import json_encoders, jsonrpc
 from .utils.asynchro import run_async
 
 
@@ -28,7 +27,7 @@ async def handle_healthcheck(request):
             if msg.data == "close":
                 await ws.close()
             else:
-                data = json.loads(msg.data)
+                data = json_encoders.loads(msg.data)
                 try:
                     if data["method"] == "HealthCheck":
                         data["params"] = {"path": "."}
@@ -39,11 +38,15 @@ async def handle_healthcheck(request):
                             else False
                         )
 
-                        presentation_list = await (
-                            await db_manager.get_db()
-                        ).list_presentations()
-                        folder_list = await (await db_manager.get_db()).list_folders()
-                        db_operational = bool(presentation_list or folder_list)
+                        # uncached, the database itself is checked
+                        db = await db_manager.get_db()
+                        presentation_page = await db.list_presentations(
+                            limit=1, use_cache=False
+                        )
+                        folder_list = await db.list_folders(use_cache=False)
+                        db_operational = bool(
+                            presentation_page["results"] or folder_list
+                        )
                         response = {
                             "fs_ok": fs_operational,
                             "db_ok": db_operational,
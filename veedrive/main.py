@@ -5,8 +5,9 @@ import logging
 from aiohttp import web
 
 from . import config, healthcheck, server
-from .content import fs_manager, utils
-from .utils import logger, sentry
+from .content import file_index, fs_manager, pyramid, scaled_cache, utils
+from .presentation import db_manager
+from .utils import asynchro, logger, sentry
 
 parser = argparse.ArgumentParser(description="websocket proxy application")
 parser.add_argument(
@@ -51,15 +52,29 @@ async def start_app():
         sentry.set_up()
 
     app = web.Application(middlewares=get_middlewares())
+    app.on_startup.append(asynchro.on_startup)
+    app.on_cleanup.append(asynchro.on_cleanup)
+    app.on_startup.append(db_manager.on_startup)
+    app.on_cleanup.append(db_manager.on_cleanup)
+    app.on_cleanup.append(file_index.on_cleanup)
+    app.on_cleanup.append(fs_manager.on_cleanup)
     app.router.add_routes(
         [
             web.get("/ws", server.handle_ws),
             web.get("/config", server.handle_config_request),
+            web.get("/metrics", server.handle_metrics_request),
             web.get("/healthcheck", healthcheck.handle_healthcheck),
             web.get("/content/thumb/{path:[^{}]+}", server.handle_thumbnail_request),
             web.get(
                 "/content/scaled/{path:[^{}]+}", server.handle_scaled_image_request
             ),
+            web.get(
+                r"/content/tiles/{path:[^{}]+}/{level:\d+}/{column:\d+}_{row:\d+}.jpg",
+                server.handle_tile_request,
+            ),
+            web.get(
+                "/content/tiles/{path:[^{}]+}", server.handle_tiles_descriptor_request
+            ),
             web.static("/static", config.SANDBOX_PATH),
             web.get("/authorized", server.authorized),
         ]
@@ -68,6 +83,11 @@ async def start_app():
     await app_runner.setup()
 
     loop.create_task(fs_manager.purge_search_results())
+    loop.create_task(file_index.refresh_search_index())
+    loop.create_task(scaled_cache.purge_scaled_cache())
+    loop.create_task(pyramid.purge_tiles_cache())
+    loop.create_task(db_manager.compact_archives())
+    loop.create_task(db_manager.listen_for_changes())
     utils.create_cache_subfolders(config.THUMBNAIL_CACHE_PATH)
 
     tcp_site = web.TCPSite(app_runner, args.address, args.port)
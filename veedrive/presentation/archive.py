@@ -0,0 +1,99 @@
+import json
+
+import jsonpatch
+
+# keys kept in the data of delta versions, they feed the generated columns
+# used to list versions (see migrations)
+METADATA_KEYS = ("id", "name", "folder", "savedAt")
+
+
+def reconstruct(data, delta, base_data):
+    """Get the full document of an archived version
+
+    :param data: stored data of the version
+    :type data: dict
+    :param delta: JSON patch against the base snapshot, None for a snapshot
+    :type delta: list
+    :param base_data: data of the base snapshot
+    :type base_data: dict
+    :return: full presentation document
+    :rtype: dict
+    """
+    if delta is None:
+        return data
+    return jsonpatch.apply_patch(base_data, delta)
+
+
+def reconstruct_all(versions):
+    """Get the full documents of archived versions of a presentation
+
+    :param versions: rows (id, data, delta, base_id, ...) including the snapshots
+        referenced by deltas
+    :type versions: list
+    :return: full documents by archive id
+    :rtype: dict
+    """
+    stored = {version[0]: version for version in versions}
+    return {
+        archive_id: reconstruct(data, delta, base_id and stored[base_id][1])
+        for archive_id, data, delta, base_id, *_ in versions
+    }
+
+
+def select_retained(versions, keep_last, thin_period):
+    """Apply the retention policy: the last versions are all kept, older ones are
+    thinned down to the most recent version of each period. Older versions
+    without archiving time (archived before it was recorded) are not thinned.
+
+    :param versions: rows (id, ..., archived_at) sorted by id
+    :type versions: list
+    :param keep_last: number of most recent versions kept, 0 keeps everything
+    :type keep_last: int
+    :param thin_period: period in seconds, 0 drops all older versions
+    :type thin_period: int
+    :return: archive ids of the retained versions
+    :rtype: set
+    """
+    if keep_last <= 0 or len(versions) <= keep_last:
+        return {version[0] for version in versions}
+    retained = {version[0] for version in versions[-keep_last:]}
+    if thin_period > 0:
+        latest_of_period = {}
+        for version in versions[:-keep_last]:
+            if version[-1] is None:
+                retained.add(version[0])
+                continue
+            period = int(version[-1].timestamp() // thin_period)
+            latest_of_period[period] = version[0]
+        retained.update(latest_of_period.values())
+    return retained
+
+
+def encode(documents, snapshot_interval):
+    """Encode versions as periodic full snapshots and JSON patches against the
+    preceding snapshot, so that any version is rebuilt with a single patch.
+    A version is stored in full when its patch would not be smaller.
+
+    :param documents: full documents by archive id
+    :type documents: dict
+    :param snapshot_interval: number of versions between two snapshots
+    :type snapshot_interval: int
+    :return: stored (data, delta, base_id) by archive id
+    :rtype: dict
+    """
+    encoded = {}
+    snapshot_id = None
+    since_snapshot = 0
+    for archive_id in sorted(documents):
+        document = documents[archive_id]
+        if snapshot_id is not None and since_snapshot < snapshot_interval:
+            delta = jsonpatch.make_patch(documents[snapshot_id], document).patch
+            if len(json.dumps(delta)) < len(json.dumps(document)):
+                data = {key: document[key] for key in METADATA_KEYS if key in document}
+                encoded[archive_id] = (data, delta, snapshot_id)
+                since_snapshot += 1
+                continue
+        encoded[archive_id] = (document, None, None)
+        snapshot_id = archive_id
+        since_snapshot = 1
+    return encoded
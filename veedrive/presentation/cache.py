@@ -0,0 +1,127 @@
+from ..utils.cache import LRUCache
+from ..utils.json_encoders import RawJSON
+
+# channel of the notifications sent by the presentations and folders triggers
+NOTIFICATION_CHANNEL = "veedrive_cache"
+# estimated size of scalars and of the delimiters of containers, in bytes
+SCALAR_SIZE = 8
+
+
+def _get_size(value):
+    # documents are sized by their JSON text, which is not serialized again
+    if isinstance(value, (RawJSON, str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return SCALAR_SIZE + sum(
+            len(str(key)) + _get_size(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return SCALAR_SIZE + sum(_get_size(item) for item in value)
+    return SCALAR_SIZE
+
+
+class PresentationCache:
+    """Read-through cache of presentations, listings and folders.
+
+    Entries are invalidated by the database notifications of changes
+    (see migrations), so that several instances stay coherent. While no
+    notification can be received, entries expire after a TTL instead.
+
+    :param max_size: maximum total size of cached entries (estimated from
+        their JSON text), in bytes. 0 disables the cache
+    :type max_size: int
+    :param ttl: lifetime of entries while not listening to notifications, in seconds
+    :type ttl: float
+    """
+
+    def __init__(self, max_size, ttl):
+        self.entries = LRUCache(max_size)
+        self.ttl = ttl
+        self.listening = False
+        # bumped by every invalidation, loads started before are not cached
+        self.generation = 0
+        # listings are cached under the current generation of their folder
+        self.folder_generations = {}
+        self.invalidations = 0
+
+    def presentation_key(self, presentation_id):
+        return ("presentation", presentation_id)
+
+    def listing_key(self, folder, *args):
+        # no folder and an empty folder are listed alike
+        folder = folder or None
+        return ("listing", folder, self.folder_generations.get(folder, 0), *args)
+
+    def folders_key(self):
+        return ("folders",)
+
+    async def get_or_load(self, key, load):
+        """Get a cached value or load it
+
+        :param key: cache key
+        :type key: tuple
+        :param load: coroutine function loading the value from the database
+        :type load: callable
+        :return: cached or loaded value
+        """
+        cached = self.entries.get(key, max_age=None if self.listening else self.ttl)
+        if cached is not None:
+            return cached[0]
+        generation = self.generation
+        value = await load()
+        # it may predate a change notified during the load
+        if generation == self.generation:
+            # wrapped, missing presentations are cached too
+            self.entries.put(key, (value,), _get_size(value))
+        return value
+
+    def invalidate(self, presentation_ids=(), folders=(), folder_list=False):
+        """Invalidate presentations, listings of folders and the list of folders
+
+        :param presentation_ids: ids of changed presentations
+        :type presentation_ids: list, optional
+        :param folders: folders (None for no folder) whose listings changed
+        :type folders: list, optional
+        :param folder_list: whether the list of folders changed
+        :type folder_list: bool, optional
+        """
+        self.generation += 1
+        self.invalidations += 1
+        for presentation_id in presentation_ids:
+            self.entries.pop(self.presentation_key(presentation_id))
+        for folder in {folder or None for folder in folders}:
+            self.folder_generations[folder] = self.folder_generations.get(folder, 0) + 1
+        if folder_list:
+            self.entries.pop(self.folders_key())
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += 1
+        self.entries.clear()
+
+    def handle_change(self, change):
+        """Invalidate entries from a change notified by the database, e.g.
+        {"presentations": [{"id": ..., "folder": ...}]}, {"folders": [...]} or
+        {"all": true}
+        """
+        if change.get("all"):
+            self.clear()
+            return
+        presentations = change.get("presentations", [])
+        self.invalidate(
+            {presentation["id"] for presentation in presentations},
+            {presentation["folder"] for presentation in presentations},
+            bool(change.get("folders")),
+        )
+
+    def set_listening(self, listening):
+        """Switch between invalidation by notifications and expiry. Changes may
+        have been missed in between, the cache is cleared.
+        """
+        self.listening = listening
+        self.clear()
+
+    def get_stats(self):
+        stats = self.entries.get_stats()
+        stats.update({"listening": self.listening, "invalidations": self.invalidations})
+        return stats
@@ -1,3 +1,5 @@
+import base64
+import json
 from abc import abstractmethod
 
 LIST_PRESENTATIONS_EXPOSE_ATTRIBUTES = [
@@ -13,17 +15,33 @@ def prepare_presentation_data(item):
     return {key: item.get(key) for key in LIST_PRESENTATIONS_EXPOSE_ATTRIBUTES}
 
 
+def encode_cursor(*position):
+    """Encode the position of the last listed item as an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
 class DBInterface:
     @abstractmethod
     def get_presentation(self, presentation_id):
         raise NotImplementedError
 
     @abstractmethod
-    def get_presentation_versions(self, presentation_id):
+    def get_presentation_versions(self, presentation_id, limit=None, cursor=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_presentation_version(self, archive_id):
         raise NotImplementedError
 
     @abstractmethod
-    def list_presentations(self):
+    def list_presentations(self, folder=None, limit=None, cursor=None):
         raise NotImplementedError
 
     @abstractmethod
@@ -49,7 +67,3 @@ class DBInterface:
     @abstractmethod
     def remove_folder(self, folder_name: str):
         raise NotImplementedError
-
-    @abstractmethod
-    def _archive_presentation(self, presentation):
-        raise NotImplementedError
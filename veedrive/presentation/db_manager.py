@@ -1,10 +1,104 @@
+import asyncio
+import logging
+
+import asyncpg
+
+from .. import config
+from ..utils import metrics
+from . import subscriptions
 from .pg_connector import create_pg_connector
 
 db = None
+# created on first use, a lock is bound to the event loop running at creation
+db_lock = None
 
 
 async def get_db():
-    global db
-    if db:
-        return db
-    return await create_pg_connector()
+    """Get the shared database connector, connecting its pool on first use"""
+    global db, db_lock
+    if db is None:
+        if db_lock is None:
+            db_lock = asyncio.Lock()
+        async with db_lock:
+            if db is None:
+                db = await create_pg_connector()
+                db.change_listeners.append(subscriptions.dispatch)
+    return db
+
+
+async def close_db():
+    global db, db_lock
+    if db is not None:
+        await db.close()
+        db = None
+    db_lock = None
+
+
+async def on_startup(app):
+    try:
+        await get_db()
+    except (OSError, asyncio.TimeoutError, asyncpg.exceptions.PostgresError) as e:
+        # presentations are unavailable until the database is reachable
+        logging.error(f"Cannot connect to the database, retrying on demand: {e}")
+
+
+async def on_cleanup(app):
+    await close_db()
+
+
+async def compact_archives():
+    """Periodically compact versions archived since the last run"""
+    while True:
+        full_batch = False
+        try:
+            db = await get_db()
+            presentation_ids = await db.get_presentations_to_compact(
+                config.ARCHIVE_COMPACTION_BATCH_SIZE
+            )
+            failed = False
+            for presentation_id in presentation_ids:
+                try:
+                    updated, deleted = await db.compact_archive(presentation_id)
+                except Exception as e:
+                    # the other archives of the batch are still compacted
+                    logging.error(f"Cannot compact archive of {presentation_id}: {e}")
+                    failed = True
+                    continue
+                logging.debug(
+                    f"Compacted archive of {presentation_id}: "
+                    f"{updated} versions updated, {deleted} deleted"
+                )
+            # failed archives are retried on the next run rather than right away
+            full_batch = (
+                len(presentation_ids) == config.ARCHIVE_COMPACTION_BATCH_SIZE
+                and not failed
+            )
+        except Exception as e:
+            # keep running, the database may be back on the next run
+            logging.error(f"Archive compaction issue: {e}")
+        if not full_batch:
+            await asyncio.sleep(config.ARCHIVE_COMPACTION_LOOP_INTERVAL)
+
+
+async def listen_for_changes():
+    """Keep presentation caches coherent with the database, caches fall back to
+    expiring entries while the listening connection is down
+    """
+    while True:
+        try:
+            await (await get_db()).listen_for_changes()
+        except Exception as e:
+            logging.error(f"Cannot listen to presentation changes: {e}")
+        await asyncio.sleep(config.PRESENTATION_CACHE_KEEPALIVE_INTERVAL)
+
+
+def get_db_pool_stats():
+    return db.get_pool_stats() if db else {}
+
+
+def get_presentation_cache_stats():
+    return db.cache.get_stats() if db else {}
+
+
+metrics.register("db_pool", get_db_pool_stats)
+metrics.register("presentation_cache", get_presentation_cache_stats)
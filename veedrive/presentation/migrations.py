@@ -0,0 +1,295 @@
+import logging
+
+# arbitrary key of the advisory lock serializing migrations of concurrent instances
+MIGRATIONS_LOCK_ID = 7426518
+
+SCHEMA_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version integer PRIMARY KEY,
+    description text NOT NULL,
+    applied_at timestamptz NOT NULL DEFAULT now()
+)
+"""
+
+
+def _indexed_presentation_columns(table):
+    return [
+        f"""
+        ALTER TABLE {table}
+            ADD COLUMN IF NOT EXISTS presentation_id text
+                GENERATED ALWAYS AS (data ->> 'id') STORED,
+            ADD COLUMN IF NOT EXISTS name text
+                GENERATED ALWAYS AS (data ->> 'name') STORED,
+            ADD COLUMN IF NOT EXISTS folder text
+                GENERATED ALWAYS AS (data ->> 'folder') STORED,
+            ADD COLUMN IF NOT EXISTS saved_at text
+                GENERATED ALWAYS AS (data ->> 'savedAt') STORED
+        """,
+        f"CREATE INDEX IF NOT EXISTS {table}_presentation_id_idx "
+        f"ON {table} (presentation_id)",
+        f"CREATE INDEX IF NOT EXISTS {table}_folder_name_idx ON {table} (folder, name)",
+        f"CREATE INDEX IF NOT EXISTS {table}_folder_saved_at_idx "
+        f"ON {table} (folder, saved_at DESC)",
+    ]
+
+
+# (version, description, statements), append only: applied migrations are never re-run
+MIGRATIONS = [
+    (
+        1,
+        "Base schema",
+        [
+            "CREATE TABLE IF NOT EXISTS presentations (id SERIAL NOT NULL, "
+            "data jsonb NOT NULL, CONSTRAINT presentation_pkey PRIMARY KEY (id))",
+            "CREATE TABLE IF NOT EXISTS archived_presentations (id SERIAL NOT NULL, "
+            "data jsonb NOT NULL, "
+            "CONSTRAINT archived_presentation_pkey PRIMARY KEY (id))",
+            "CREATE TABLE IF NOT EXISTS folders "
+            "(name VARCHAR NOT NULL, PRIMARY KEY (name))",
+        ],
+    ),
+    (
+        2,
+        "Indexed id, name, folder and savedAt columns of presentations",
+        _indexed_presentation_columns("presentations")
+        + _indexed_presentation_columns("archived_presentations"),
+    ),
+    (
+        3,
+        "Unique presentation ids and names per folder, archive on update",
+        [
+            # keep the latest row of duplicated ids, archiving the others
+            """
+            WITH duplicates AS (
+                DELETE FROM presentations p USING presentations newer
+                WHERE p.presentation_id = newer.presentation_id AND p.id < newer.id
+                RETURNING p.data
+            )
+            INSERT INTO archived_presentations (data) SELECT data FROM duplicates
+            """,
+            # rename duplicated names of a folder rather than losing presentations
+            """
+            UPDATE presentations p
+            SET data = p.data || jsonb_build_object(
+                'name', p.name || ' (' || p.presentation_id || ')'
+            )
+            FROM presentations other
+            WHERE COALESCE(p.folder, '') = COALESCE(other.folder, '')
+                AND p.name = other.name AND p.id > other.id
+            """,
+            "DROP INDEX IF EXISTS presentations_presentation_id_idx",
+            "DROP INDEX IF EXISTS presentations_folder_name_idx",
+            "CREATE UNIQUE INDEX presentations_presentation_id_key "
+            "ON presentations (presentation_id)",
+            # no folder and an empty folder are the same folder
+            "CREATE UNIQUE INDEX presentations_folder_name_key "
+            "ON presentations ((COALESCE(folder, '')), name)",
+            """
+            CREATE OR REPLACE FUNCTION archive_presentation() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO archived_presentations (data) VALUES (OLD.data);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "CREATE TRIGGER presentations_archive BEFORE UPDATE ON presentations "
+            "FOR EACH ROW EXECUTE FUNCTION archive_presentation()",
+        ],
+    ),
+    (
+        4,
+        "Keyset pagination of presentation listings",
+        [
+            "DROP INDEX IF EXISTS presentations_folder_saved_at_idx",
+            "CREATE INDEX presentations_folder_saved_at_idx ON presentations "
+            "(folder, (COALESCE(saved_at, '')) DESC, id DESC)",
+        ],
+    ),
+    (
+        5,
+        "Paginated listing of presentation versions",
+        [
+            "DROP INDEX IF EXISTS archived_presentations_presentation_id_idx",
+            "CREATE INDEX archived_presentations_presentation_id_idx "
+            "ON archived_presentations (presentation_id, id DESC)",
+        ],
+    ),
+    (
+        6,
+        "Delta compressed archive of presentation versions",
+        [
+            # versions archived by the trigger are full copies until compacted
+            "ALTER TABLE archived_presentations "
+            "ADD COLUMN base_id integer REFERENCES archived_presentations (id), "
+            "ADD COLUMN delta jsonb, "
+            "ADD COLUMN compacted boolean NOT NULL DEFAULT false, "
+            "ADD COLUMN archived_at timestamptz",
+            """
+            CREATE OR REPLACE FUNCTION pg_temp.to_timestamptz(value text)
+            RETURNS timestamptz AS $$
+            BEGIN
+                RETURN value::timestamptz;
+            EXCEPTION WHEN others THEN
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            # versions archived before are dated by their savedAt where it parses,
+            # the others are left undated and not thinned by compactions
+            "UPDATE archived_presentations "
+            "SET archived_at = pg_temp.to_timestamptz(data ->> 'savedAt')",
+            "ALTER TABLE archived_presentations "
+            "ALTER COLUMN archived_at SET DEFAULT now()",
+            "CREATE INDEX archived_presentations_base_id_idx "
+            "ON archived_presentations (base_id)",
+            "CREATE INDEX archived_presentations_uncompacted_idx "
+            "ON archived_presentations (presentation_id) WHERE NOT compacted",
+        ],
+    ),
+    (
+        7,
+        "Notify changes of presentations and folders to caches",
+        [
+            """
+            CREATE OR REPLACE FUNCTION notify_presentation_change() RETURNS trigger AS $$
+            DECLARE
+                changed jsonb := '[]';
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    changed := changed || jsonb_build_object(
+                        'id', OLD.presentation_id, 'folder', OLD.folder
+                    );
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    changed := changed || jsonb_build_object(
+                        'id', NEW.presentation_id, 'folder', NEW.folder
+                    );
+                END IF;
+                PERFORM pg_notify(
+                    'veedrive_cache',
+                    jsonb_build_object('presentations', changed)::text
+                );
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "CREATE TRIGGER presentations_notify "
+            "AFTER INSERT OR UPDATE OR DELETE ON presentations "
+            "FOR EACH ROW EXECUTE FUNCTION notify_presentation_change()",
+            """
+            CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+            BEGIN
+                -- the payload is given as argument of the trigger
+                PERFORM pg_notify('veedrive_cache', TG_ARGV[0]);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "CREATE TRIGGER presentations_notify_truncate "
+            "AFTER TRUNCATE ON presentations "
+            """FOR EACH STATEMENT EXECUTE FUNCTION notify_change('{"all": true}')""",
+            "CREATE TRIGGER folders_notify "
+            "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON folders "
+            """FOR EACH STATEMENT EXECUTE FUNCTION notify_change('{"folders": true}')""",
+        ],
+    ),
+    (
+        8,
+        "Notify the action and savedAt of changes to subscribers",
+        [
+            # a presentation moved to another folder (or id) is deleted from the
+            # previous one
+            """
+            CREATE OR REPLACE FUNCTION notify_presentation_change() RETURNS trigger AS $$
+            DECLARE
+                changed jsonb := '[]';
+            BEGIN
+                IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND (
+                    OLD.presentation_id IS DISTINCT FROM NEW.presentation_id
+                    OR OLD.folder IS DISTINCT FROM NEW.folder
+                )) THEN
+                    changed := changed || jsonb_build_object(
+                        'id', OLD.presentation_id, 'folder', OLD.folder,
+                        'savedAt', OLD.data -> 'savedAt', 'action', 'deleted'
+                    );
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    changed := changed || jsonb_build_object(
+                        'id', NEW.presentation_id, 'folder', NEW.folder,
+                        'savedAt', NEW.data -> 'savedAt', 'action', 'saved'
+                    );
+                END IF;
+                PERFORM pg_notify(
+                    'veedrive_cache',
+                    jsonb_build_object('presentations', changed)::text
+                );
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION notify_folder_change() RETURNS trigger AS $$
+            DECLARE
+                changed jsonb := '[]';
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    changed := changed || jsonb_build_object(
+                        'name', OLD.name, 'action', 'deleted'
+                    );
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    changed := changed || jsonb_build_object(
+                        'name', NEW.name, 'action', 'created'
+                    );
+                END IF;
+                PERFORM pg_notify(
+                    'veedrive_cache', jsonb_build_object('folders', changed)::text
+                );
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER folders_notify ON folders",
+            "CREATE TRIGGER folders_notify "
+            "AFTER INSERT OR UPDATE OR DELETE ON folders "
+            "FOR EACH ROW EXECUTE FUNCTION notify_folder_change()",
+            "CREATE TRIGGER folders_notify_truncate AFTER TRUNCATE ON folders "
+            """FOR EACH STATEMENT EXECUTE FUNCTION notify_change('{"all": true}')""",
+        ],
+    ),
+]
+
+
+async def migrate(connection, migrations=None):
+    """Apply pending schema migrations in a single transaction.
+    Concurrent callers (e.g. several instances starting) wait for each other.
+
+    :param connection: database connection
+    :type connection: class: `asyncpg.Connection`
+    :param migrations: migrations to apply, defaults to MIGRATIONS
+    :type migrations: list, optional
+    :return: versions of the applied migrations
+    :rtype: list
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+    applied = []
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_ID)
+        await connection.execute(SCHEMA_MIGRATIONS_TABLE)
+        schema_versions = {
+            row[0]
+            for row in await connection.fetch("SELECT version FROM schema_migrations")
+        }
+        for version, description, statements in sorted(migrations):
+            if version in schema_versions:
+                continue
+            for statement in statements:
+                await connection.execute(statement)
+            await connection.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                version,
+                description,
+            )
+            logging.info(f"Applied schema migration {version}: {description}")
+            applied.append(version)
+    return applied
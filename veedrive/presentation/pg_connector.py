@@ -1,119 +1,524 @@
-import json
+import asyncio
+import contextlib
+import logging
+import time
 import uuid
 
 import asyncpg
 
 from .. import config
+from ..utils import json_encoders
 from ..utils.exceptions import CodeException
-from .db import DBInterface, prepare_presentation_data
+from ..utils.json_encoders import RawJSON
+from . import archive, migrations
+from .cache import NOTIFICATION_CHANNEL, PresentationCache
+from .db import (LIST_PRESENTATIONS_EXPOSE_ATTRIBUTES, DBInterface,
+                 decode_cursor, encode_cursor)
+
+# errors of a connection lost between two queries, worth a retry on a new connection
+RECONNECT_ERRORS = (
+    asyncpg.exceptions.ConnectionDoesNotExistError,
+    asyncpg.exceptions.InterfaceError,
+    ConnectionResetError,
+)
+
+# lookups use the indexed columns generated from presentations' data (see migrations)
+# presentations are read as JSON text, spliced as is into responses
+GET_PRESENTATION_BY_ID = (
+    "SELECT data::text FROM presentations WHERE presentation_id = $1;"
+)
+GET_PRESENTATION_BY_NAME = (
+    "SELECT data::text FROM presentations "
+    "WHERE COALESCE(folder, '') = $2 AND name = $1;"
+)
+_VERSION_METADATA = (
+    "SELECT jsonb_build_object('archive_id', id, 'id', presentation_id, "
+    "'name', name, 'savedAt', data -> 'savedAt', "
+    "'size', pg_column_size(data) + COALESCE(pg_column_size(delta), 0)), id "
+    "FROM archived_presentations WHERE presentation_id = $2"
+)
+GET_PRESENTATION_VERSIONS = f"{_VERSION_METADATA} ORDER BY id DESC LIMIT $1;"
+GET_PRESENTATION_VERSIONS_AFTER = (
+    f"{_VERSION_METADATA} AND id < $3 ORDER BY id DESC LIMIT $1;"
+)
+# delta versions are rebuilt from their base snapshot
+GET_PRESENTATION_VERSION = (
+    "SELECT version.data, version.delta, base.data FROM archived_presentations version "
+    "LEFT JOIN archived_presentations base ON base.id = version.base_id "
+    "WHERE version.id = $1;"
+)
+GET_PRESENTATIONS_TO_COMPACT = (
+    "SELECT DISTINCT presentation_id FROM archived_presentations "
+    "WHERE NOT compacted AND presentation_id IS NOT NULL "
+    "ORDER BY presentation_id LIMIT $1;"
+)
+LOCK_ARCHIVED_VERSIONS = (
+    "SELECT id, data, delta, base_id, compacted, archived_at "
+    "FROM archived_presentations "
+    "WHERE presentation_id = $1 ORDER BY id FOR UPDATE;"
+)
+UPDATE_ARCHIVED_VERSION = (
+    "UPDATE archived_presentations "
+    "SET data = $2, delta = $3, base_id = $4, compacted = true WHERE id = $1;"
+)
+DELETE_ARCHIVED_VERSIONS = "DELETE FROM archived_presentations WHERE id = ANY($1);"
+
+
+def _list_presentations_query(in_folder, after_cursor):
+    """Build a keyset paginated listing of presentations, newest first.
+    Only exposed attributes are selected.
+    """
+    projection = ", ".join(
+        f"'{key}', data -> '{key}'" for key in LIST_PRESENTATIONS_EXPOSE_ATTRIBUTES
+    )
+    conditions = ["folder = $2" if in_folder else "folder IS NULL"]
+    if after_cursor:
+        position = "$3, $4" if in_folder else "$2, $3"
+        conditions.append(f"(COALESCE(saved_at, ''), id) < ({position})")
+    return (
+        f"SELECT jsonb_build_object({projection})::text, COALESCE(saved_at, ''), id "
+        f"FROM presentations WHERE {' AND '.join(conditions)} "
+        "ORDER BY COALESCE(saved_at, '') DESC, id DESC LIMIT $1;"
+    )
+
+
+LIST_PRESENTATIONS = _list_presentations_query(True, False)
+LIST_PRESENTATIONS_AFTER = _list_presentations_query(True, True)
+LIST_PRESENTATIONS_WITHOUT_FOLDER = _list_presentations_query(False, False)
+LIST_PRESENTATIONS_WITHOUT_FOLDER_AFTER = _list_presentations_query(False, True)
+COUNT_PRESENTATIONS = "SELECT count(*) FROM presentations WHERE folder = $1;"
+COUNT_PRESENTATIONS_WITHOUT_FOLDER = (
+    "SELECT count(*) FROM presentations WHERE folder IS NULL;"
+)
+DELETE_PRESENTATION = "DELETE FROM presentations WHERE presentation_id = $1;"
+# the previous version is archived by the presentations_archive trigger
+SAVE_PRESENTATION = (
+    "INSERT INTO presentations (data) VALUES ($1) "
+    "ON CONFLICT (presentation_id) DO UPDATE SET data = EXCLUDED.data RETURNING id;"
+)
+NAME_CONSTRAINT = "presentations_folder_name_key"
+
+
+async def init_connection(connection):
+    """Encode and decode json(b) values natively instead of as text"""
+    for json_type in ("json", "jsonb"):
+        await connection.set_type_codec(
+            json_type,
+            encoder=json_encoders.dumps,
+            decoder=json_encoders.loads,
+            schema="pg_catalog",
+        )
 
 
 async def create_pg_connector():
     self = PgConnector()
     await self.set_up_connection()
+    if config.DB_AUTO_MIGRATE:
+        await self.migrate()
     return self
 
 
 class PgConnector(DBInterface):
     def __init__(self):
-        self.conn = None
+        self.pool = None
+        self.stats = {
+            "acquired": 0,
+            "acquire_timeouts": 0,
+            "reconnects": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0,
+        }
+        self.cache = PresentationCache(
+            config.PRESENTATION_CACHE_SIZE, config.PRESENTATION_CACHE_TTL
+        )
+        # callables receiving changes notified by the database
+        self.change_listeners = []
 
     async def set_up_connection(self):
-        self.conn = await asyncpg.connect(
+        self.pool = await asyncpg.create_pool(
             database=config.DB_NAME,
             user=config.DB_USERNAME,
             host=config.DB_HOST,
             password=config.DB_PASSWORD,
+            min_size=config.DB_POOL_MIN_SIZE,
+            max_size=config.DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=config.DB_POOL_MAX_INACTIVE_LIFETIME,
+            command_timeout=config.DB_COMMAND_TIMEOUT,
+            timeout=config.DB_CONNECT_TIMEOUT,
+            statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+            init=init_connection,
+        )
+
+    async def migrate(self):
+        """Bring the database schema up to date"""
+        async with self.pool.acquire() as connection:
+            return await migrations.migrate(connection)
+
+    async def close(self):
+        """Close all connections, waiting for running queries to complete"""
+        try:
+            await asyncio.wait_for(self.pool.close(), config.DB_COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.pool.terminate()
+
+    def get_pool_stats(self):
+        stats = self.stats.copy()
+        acquired = stats["acquired"]
+        size, idle_size = self.pool.get_size(), self.pool.get_idle_size()
+        stats.update(
+            {
+                "size": size,
+                "idle": idle_size,
+                "min_size": self.pool.get_min_size(),
+                "max_size": self.pool.get_max_size(),
+                "utilisation": (size - idle_size) / self.pool.get_max_size(),
+                "avg_wait": stats["total_wait"] / acquired if acquired else 0.0,
+            }
         )
+        return stats
+
+    async def fetch(self, query, *args):
+        return await self._run_query("fetch", query, *args)
 
-    async def get_presentation(self, presentation_id: str = None, presentation_name: str = None, presentation_folder: str = None,
+    async def fetchrow(self, query, *args):
+        return await self._run_query("fetchrow", query, *args)
+
+    async def fetchval(self, query, *args):
+        return await self._run_query("fetchval", query, *args)
+
+    async def execute(self, query, *args):
+        # not retried, the statement may have been applied before losing the connection
+        return await self._run_query("execute", query, *args, retry=False)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Run several statements in a transaction on a single pooled connection"""
+        connection = await self._acquire()
+        try:
+            async with connection.transaction():
+                yield connection
+        finally:
+            await self.pool.release(connection)
+
+    async def _acquire(self):
+        t_start = time.perf_counter()
+        try:
+            connection = await self.pool.acquire(timeout=config.DB_POOL_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats["acquire_timeouts"] += 1
+            raise
+        wait = time.perf_counter() - t_start
+        self.stats["acquired"] += 1
+        self.stats["total_wait"] += wait
+        self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+        return connection
+
+    async def _run_query(self, method, query, *args, retry=True):
+        """Run a query on a pooled connection. Connections which turn out to be
+        broken are replaced by the pool, read queries are retried once on a new one.
+        """
+        for attempt in range(2):
+            connection = await self._acquire()
+            try:
+                return await getattr(connection, method)(query, *args)
+            except RECONNECT_ERRORS as e:
+                if not retry or attempt:
+                    raise
+                self.stats["reconnects"] += 1
+                logging.warning(f"DB connection lost ({e}), retrying query")
+            finally:
+                await self.pool.release(connection)
+
+    async def get_presentation(
+        self,
+        presentation_id: str = None,
+        presentation_name: str = None,
+        presentation_folder: str = None,
     ):
-        sql_base = "SELECT data ::jsonb FROM presentations"
+        """Get a presentation by id, or by name in a folder
+
+        :return: JSON text of the presentation, None if not found
+        :rtype: class: `RawJSON`
+        """
         if presentation_id:
-            presentation_id = uuid.UUID(presentation_id)
-            sql_string = f"{sql_base} WHERE data ::jsonb ->> 'id' = '{presentation_id}';"
-        if presentation_name:
-            if presentation_folder:
-                sql_string = f"{sql_base} WHERE data ::jsonb ->> 'name' = '{presentation_name}' AND data ::jsonb ->> 'folder' = '{presentation_folder}';"
-            else:
-                sql_string = f"{sql_base} WHERE data ::jsonb ->> 'name' = '{presentation_name}' AND data ::jsonb ->> 'folder' IS NULL;"
-        result = await self.conn.fetchrow(sql_string)
-        if not result:
-            return None
+            presentation_id = str(uuid.UUID(presentation_id))
+            return await self.cache.get_or_load(
+                self.cache.presentation_key(presentation_id),
+                lambda: self._fetch_presentation(
+                    GET_PRESENTATION_BY_ID, presentation_id
+                ),
+            )
+        return await self._fetch_presentation(
+            GET_PRESENTATION_BY_NAME, presentation_name, presentation_folder or ""
+        )
+
+    async def _fetch_presentation(self, query, *args):
+        result = await self.fetchrow(query, *args)
+        return RawJSON(result[0]) if result else None
+
+    async def get_presentation_versions(
+        self, presentation_id: str, limit=None, cursor=None
+    ):
+        """List archived versions of a presentation, most recent first
+
+        :param presentation_id: id of the presentation
+        :type presentation_id: str
+        :param limit: maximum number of versions,
+            defaults to (and capped at) config.LIST_PRESENTATIONS_MAX_LIMIT
+        :type limit: int, optional
+        :param cursor: cursor returned with the previous page, defaults to None
+        :type cursor: str, optional
+        :return: metadata of versions (archive id, presentation id, name, savedAt,
+            stored size) and the cursor of the next page (None if last)
+        :rtype: dict
+        """
+        limit = _get_page_limit(limit)
+        if cursor:
+            archive_id = decode_cursor(cursor)
+            if (
+                not isinstance(archive_id, list)
+                or len(archive_id) != 1
+                or not isinstance(archive_id[0], int)
+            ):
+                raise ValueError("Invalid cursor")
+            rows = await self.fetch(
+                GET_PRESENTATION_VERSIONS_AFTER,
+                limit + 1,
+                presentation_id,
+                *archive_id,
+            )
         else:
-            return json.loads(result[0])
+            rows = await self.fetch(
+                GET_PRESENTATION_VERSIONS, limit + 1, presentation_id
+            )
+        return {
+            "results": [row[0] for row in rows[:limit]],
+            "next_cursor": (
+                encode_cursor(rows[limit - 1][1]) if len(rows) > limit else None
+            ),
+        }
 
-    async def get_presentation_versions(self, presentation_id: str):
-        sql_string = (
-            f"SELECT data ::jsonb FROM archived_presentations WHERE data ::jsonb ->> 'id' = "
-            f"'{presentation_id}';"
-        )
-        results = await self.conn.fetch(sql_string)
-        return [json.loads(result[0]) for result in results]
-
-    async def list_presentations(self, folder=None):
-        folder_filter_string = (
-            f"WHERE data::jsonb ->> 'folder' = '{folder}'"
-            if folder
-            else "WHERE NOT data ::jsonb ? 'folder' OR data::jsonb ->> 'folder' IS NULL "
+    async def get_presentation_version(self, archive_id: int):
+        result = await self.fetchrow(GET_PRESENTATION_VERSION, archive_id)
+        return archive.reconstruct(*result) if result else None
+
+    async def get_presentations_to_compact(self, limit: int):
+        """Get ids of presentations with versions archived since the last compaction"""
+        rows = await self.fetch(GET_PRESENTATIONS_TO_COMPACT, limit)
+        return [row[0] for row in rows]
+
+    async def compact_archive(self, presentation_id: str):
+        """Apply the retention policy to the archived versions of a presentation
+        and store them as snapshots and deltas (see archive.encode)
+
+        :param presentation_id: id of the presentation
+        :type presentation_id: str
+        :return: numbers of updated and deleted versions
+        :rtype: tuple
+        """
+        async with self.transaction() as connection:
+            # locked against concurrent compactions, versions archived meanwhile
+            # are full copies left to the next run
+            versions = await connection.fetch(LOCK_ARCHIVED_VERSIONS, presentation_id)
+            retained = archive.select_retained(
+                versions, config.ARCHIVE_KEEP_LAST, config.ARCHIVE_THIN_PERIOD
+            )
+            documents = archive.reconstruct_all(versions)
+            encoded = archive.encode(
+                {archive_id: documents[archive_id] for archive_id in retained},
+                config.ARCHIVE_SNAPSHOT_INTERVAL,
+            )
+            updates = [
+                (archive_id, *encoded[archive_id])
+                for archive_id, data, delta, base_id, compacted, _ in versions
+                if archive_id in encoded
+                and (not compacted or encoded[archive_id] != (data, delta, base_id))
+            ]
+            # rebased before deleting the snapshots they referenced
+            if updates:
+                await connection.executemany(UPDATE_ARCHIVED_VERSION, updates)
+            removed = [version[0] for version in versions if version[0] not in retained]
+            if removed:
+                await connection.execute(DELETE_ARCHIVED_VERSIONS, removed)
+        return len(updates), len(removed)
+
+    async def list_presentations(
+        self, folder=None, limit=None, cursor=None, use_cache=True
+    ):
+        """List presentations of a folder, most recently saved first
+
+        :param folder: folder of presentations, defaults to None (no folder)
+        :type folder: str, optional
+        :param limit: maximum number of presentations,
+            defaults to (and capped at) config.LIST_PRESENTATIONS_MAX_LIMIT
+        :type limit: int, optional
+        :param cursor: cursor returned with the previous page, defaults to None
+        :type cursor: str, optional
+        :param use_cache: whether the page may come from the presentation cache,
+            defaults to True
+        :type use_cache: bool, optional
+        :return: exposed attributes of presentations, the total number of
+            presentations in the folder and the cursor of the next page (None if last)
+        :rtype: dict
+        """
+        limit = _get_page_limit(limit)
+        if not use_cache:
+            return await self._fetch_presentations(folder, limit, cursor)
+        return await self.cache.get_or_load(
+            self.cache.listing_key(folder, limit, cursor),
+            lambda: self._fetch_presentations(folder, limit, cursor),
         )
-        sql_string = f"SELECT data ::jsonb FROM presentations {folder_filter_string} \
-                       ORDER BY data ::jsonb ->> 'savedAt' DESC LIMIT 1000;"
 
-        full_list = [
-            json.loads(result[0]) for result in await self.conn.fetch(sql_string)
-        ]
-        return list(map(prepare_presentation_data, full_list))
+    async def _fetch_presentations(self, folder, limit, cursor):
+        position = _decode_list_cursor(cursor) if cursor else []
+        # a missing key is NULL too
+        if folder:
+            folder_args = [folder]
+            count_query = COUNT_PRESENTATIONS
+            query = LIST_PRESENTATIONS_AFTER if cursor else LIST_PRESENTATIONS
+        else:
+            folder_args = []
+            count_query = COUNT_PRESENTATIONS_WITHOUT_FOLDER
+            query = (
+                LIST_PRESENTATIONS_WITHOUT_FOLDER_AFTER
+                if cursor
+                else LIST_PRESENTATIONS_WITHOUT_FOLDER
+            )
+
+        rows, total = await asyncio.gather(
+            self.fetch(query, limit + 1, *folder_args, *position),
+            self.fetchval(count_query, *folder_args),
+        )
+        next_cursor = encode_cursor(*rows[limit - 1][1:]) if len(rows) > limit else None
+        return {
+            "results": [RawJSON(row[0]) for row in rows[:limit]],
+            "total": total,
+            "next_cursor": next_cursor,
+        }
 
     async def save_presentation_to_storage(self, presentation_data: dict):
-        existing_presentation = await self.get_presentation(presentation_data["id"])
+        """Insert or replace a presentation in a single statement, the replaced
+        version being archived. Names are unique per folder.
+        """
         try:
-            presentation_folder = presentation_data["folder"]
-        except KeyError:
-            presentation_folder = None
-
-        if existing_presentation:
-            print("existing with same ID", flush=True)
-            await self._archive_presentation(existing_presentation)
-            await self.delete_presentation(presentation_data["id"])
-
-        if not existing_presentation:
-            existing_presentation_with_same_name = await self.get_presentation(
-                presentation_name=presentation_data["name"],
-                presentation_folder=presentation_folder,
+            presentation_id = str(uuid.UUID(presentation_data["id"]))
+        except (KeyError, TypeError, AttributeError, ValueError):
+            raise CodeException(
+                config.MALFORMED_REQUEST,
+                f'Invalid presentation id: {presentation_data.get("id")}',
             )
-            if existing_presentation_with_same_name:
-                print("existing with different ID and same name", flush=True)
-                raise CodeException(
-                    10,
-                    f'{presentation_data["name"]} already exists in folder: {presentation_folder}',
-                )
-
-        sql_string = f"INSERT INTO presentations (data) VALUES ('{json.dumps(presentation_data)}') RETURNING id;"
-        return await self.conn.execute(sql_string)
+        presentation_data = {**presentation_data, "id": presentation_id}
+        try:
+            result = await self.execute(SAVE_PRESENTATION, presentation_data)
+        except asyncpg.exceptions.UniqueViolationError as e:
+            if e.constraint_name != NAME_CONSTRAINT:
+                raise
+            raise CodeException(
+                config.PRESENTATION_NAME_CONFLICT,
+                f'{presentation_data["name"]} already exists in folder: '
+                f'{presentation_data.get("folder")}',
+            )
+        # read your own writes before the notification, which also covers
+        # the previous folder of a moved presentation
+        self.cache.invalidate([presentation_id], [presentation_data.get("folder")])
+        return result
 
     async def delete_presentation(self, presentation_id: str):
-        sql_string = f"DELETE from presentations WHERE data ::jsonb ->> 'id'  =  '{presentation_id}' ;"
-        return await self.conn.execute(sql_string)
+        result = await self.execute(DELETE_PRESENTATION, presentation_id)
+        self.cache.invalidate([presentation_id])
+        return result
 
     async def create_folder(self, folder_name: str):
-        sql_string = f"INSERT INTO folders(name) VALUES ('{folder_name}') ;"
+        sql_string = "INSERT INTO folders(name) VALUES ($1);"
         try:
-            await self.conn.execute(sql_string)
+            await self.execute(sql_string, folder_name)
         except asyncpg.exceptions.UniqueViolationError:
             raise Exception("Folder already exists")
+        self.cache.invalidate(folder_list=True)
 
     async def remove_folder(self, folder_name: str):
-        sql_string = f"DELETE FROM folders where name = '{folder_name}' RETURNING * ;"
-        res = await self.conn.fetchval(sql_string)
+        sql_string = "DELETE FROM folders WHERE name = $1 RETURNING *;"
+        # not retried, the folder may have been removed before losing the connection
+        res = await self._run_query("fetchval", sql_string, folder_name, retry=False)
         if not res:
             raise Exception("Specified folder does not exist")
+        self.cache.invalidate(folder_list=True)
+
+    async def list_folders(self, use_cache=True):
+        if not use_cache:
+            return await self._fetch_folders()
+        return await self.cache.get_or_load(
+            self.cache.folders_key(), self._fetch_folders
+        )
 
-    async def list_folders(self):
-        sql_string = f"SELECT name from folders;"
-        results = await self.conn.fetch(sql_string)
+    async def _fetch_folders(self):
+        sql_string = "SELECT name FROM folders;"
+        results = await self.fetch(sql_string)
         return [(result[0]) for result in results]
 
-    async def _archive_presentation(self, presentation_data: dict):
-        sql_string = f"INSERT INTO archived_presentations (data) VALUES ('{json.dumps(presentation_data)}') RETURNING id;"
-        return await self.conn.execute(sql_string)
+    async def listen_for_changes(self):
+        """Keep the cache coherent with changes notified by the database,
+        until the listening connection is lost
+        """
+        connection = await asyncpg.connect(
+            database=config.DB_NAME,
+            user=config.DB_USERNAME,
+            host=config.DB_HOST,
+            password=config.DB_PASSWORD,
+            timeout=config.DB_CONNECT_TIMEOUT,
+        )
+        lost = asyncio.Event()
+        connection.add_termination_listener(lambda _: lost.set())
+        try:
+            await connection.add_listener(NOTIFICATION_CHANNEL, self._on_notification)
+            self.cache.set_listening(True)
+            # changes may have been missed while not listening
+            self._dispatch_change({"all": True})
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(
+                        lost.wait(), config.PRESENTATION_CACHE_KEEPALIVE_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    # a silently dropped connection is only noticed when used
+                    await connection.execute(
+                        "SELECT 1", timeout=config.DB_COMMAND_TIMEOUT
+                    )
+        finally:
+            self.cache.set_listening(False)
+            if not connection.is_closed():
+                connection.terminate()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        change = json_encoders.loads(payload)
+        self.cache.handle_change(change)
+        self._dispatch_change(change)
+
+    def _dispatch_change(self, change):
+        for listener in self.change_listeners:
+            try:
+                listener(change)
+            except Exception as e:
+                logging.error(f"Cannot dispatch presentation change: {e}")
+
+
+def _decode_list_cursor(cursor):
+    position = decode_cursor(cursor)
+    if (
+        not isinstance(position, list)
+        or len(position) != 2
+        or not isinstance(position[0], str)
+        or not isinstance(position[1], int)
+    ):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def _get_page_limit(limit):
+    limit = min(
+        limit or config.LIST_PRESENTATIONS_MAX_LIMIT,
+        config.LIST_PRESENTATIONS_MAX_LIMIT,
+    )
+    if limit < 1:
+        raise ValueError("Limit must be positive")
+    return limit
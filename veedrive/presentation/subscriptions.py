@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import logging
+import uuid
+
+from .. import config
+from ..utils import jsonrpc, metrics
+
+PRESENTATIONS = "presentations"
+FOLDER = "folder"
+
+# subscribers with at least one subscription
+subscribers = set()
+stats = {"sent": 0, "overflows": 0}
+
+
+class Subscriber:
+    """Subscriptions of a websocket client, through which all its messages are
+    sent. Notifications are queued and sent by a task of its own, so that a
+    slow client only delays itself. Past config.SUBSCRIPTION_MAX_PENDING queued
+    notifications, they are replaced by a single SubscriptionsOverflow
+    notification, after which the client should reload: until it is sent,
+    further notifications are dropped.
+
+    :param ws: websocket of the client
+    :type ws: class: `aiohttp.web.WebSocketResponse`
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.subscriptions = {}
+        self.pending = collections.deque()
+        self.overflowed = False
+        self.sender = None
+        self.send_lock = asyncio.Lock()
+
+    def subscribe(self, kind, target):
+        """Subscribe to changes of presentations or of a folder
+
+        :param kind: PRESENTATIONS or FOLDER
+        :type kind: str
+        :param target: ids of presentations (None for all) or folder name
+            (None for no folder)
+        :return: id of the subscription
+        :rtype: str
+        """
+        subscription_id = str(uuid.uuid4())
+        self.subscriptions[subscription_id] = (kind, target)
+        subscribers.add(self)
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        removed = self.subscriptions.pop(subscription_id, None) is not None
+        if not self.subscriptions:
+            subscribers.discard(self)
+        return removed
+
+    def close(self):
+        self.subscriptions.clear()
+        subscribers.discard(self)
+        self.pending.clear()
+        if self.sender:
+            self.sender.cancel()
+
+    async def send(self, message):
+        """Send a message on the websocket, responses and notifications alike.
+        Messages are sent one at a time: aiohttp does not support a second
+        writer while the first one waits for a paused transport to drain.
+        """
+        async with self.send_lock:
+            await self.ws.send_str(message)
+
+    def notify(self, method, params):
+        if self.overflowed:
+            return
+        if len(self.pending) >= config.SUBSCRIPTION_MAX_PENDING:
+            stats["overflows"] += 1
+            self.pending.clear()
+            self.overflowed = True
+            method, params = "SubscriptionsOverflow", {}
+        self.pending.append(jsonrpc.prepare_notification(method, params))
+        if self.sender is None or self.sender.done():
+            self.sender = asyncio.ensure_future(self._send_pending())
+
+    async def _send_pending(self):
+        try:
+            while self.pending:
+                # waits for the client to read once its buffers are full
+                await self.send(self.pending.popleft())
+                stats["sent"] += 1
+            # the overflow notification, always last, was sent
+            self.overflowed = False
+        except (ConnectionResetError, RuntimeError) as e:
+            logging.debug(f"Subscriber disconnected: {e}")
+            self.sender = None
+            self.close()
+
+    def dispatch(self, change):
+        for subscription_id, (kind, target) in self.subscriptions.items():
+            # the last change of a presentation wins, e.g. saved after moved out
+            latest = {}
+            for presentation in change.get("presentations", []):
+                if kind == PRESENTATIONS:
+                    matches = target is None or presentation["id"] in target
+                else:
+                    matches = (presentation["folder"] or None) == target
+                if matches:
+                    latest[presentation["id"]] = presentation
+            for presentation in latest.values():
+                self.notify(
+                    "PresentationChanged",
+                    {"subscription": subscription_id, **presentation},
+                )
+
+            if kind == FOLDER:
+                for folder in change.get("folders", []):
+                    if folder["name"] == target:
+                        self.notify(
+                            "FolderChanged",
+                            {"subscription": subscription_id, **folder},
+                        )
+
+
+def dispatch(change):
+    """Push a change notified by the database to the matching subscriptions
+
+    :param change: e.g. {"presentations": [{"id": ..., "folder": ...,
+        "savedAt": ..., "action": "saved"}]}, {"folders": [{"name": ...,
+        "action": "created"}]} or {"all": true} when changes may have been missed
+    :type change: dict
+    """
+    for subscriber in list(subscribers):
+        if change.get("all"):
+            subscriber.notify("SubscriptionsReset", {})
+        else:
+            subscriber.dispatch(change)
+
+
+def get_subscription_stats():
+    return {
+        "subscribers": len(subscribers),
+        "subscriptions": sum(len(s.subscriptions) for s in subscribers),
+        "pending": sum(len(s.pending) for s in subscribers),
+        **stats,
+    }
+
+
+metrics.register("subscriptions", get_subscription_stats)
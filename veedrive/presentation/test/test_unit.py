@@ -0,0 +1,855 @@
+import asyncio
+import datetime
+import json
+import time
+from unittest.mock import patch
+
+import aiounittest
+import asyncpg
+
+from ... import config
+from ...utils import jsonrpc, metrics
+from ...utils.exceptions import CodeException
+from ...utils.json_encoders import RawJSON
+from .. import (archive, db_manager, migrations, pg_connector, subscriptions,
+                ws_handlers)
+from ..cache import PresentationCache
+from ..db import encode_cursor
+
+PRESENTATION_ID = "1509d5ec-163f-4a79-8942-4a8b74dbd438"
+
+
+class FakeConnection:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.queries = []
+        self.args = []
+
+    async def fetch(self, query, *args):
+        self.queries.append(query)
+        self.args.append(args)
+        if self.failures:
+            self.failures -= 1
+            raise asyncpg.exceptions.ConnectionDoesNotExistError("lost")
+        return [query]
+
+    async def fetchrow(self, query, *args):
+        await self.fetch(query, *args)
+        return None
+
+    execute = fetchval = fetch
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+        self.in_use = 0
+
+    async def acquire(self, timeout=None):
+        self.in_use += 1
+        return self.connection
+
+    async def release(self, connection):
+        self.in_use -= 1
+
+    async def close(self):
+        pass
+
+    def get_size(self):
+        return 4
+
+    def get_idle_size(self):
+        return 4 - self.in_use
+
+    def get_min_size(self):
+        return 2
+
+    def get_max_size(self):
+        return 8
+
+
+def create_connector(connection):
+    connector = pg_connector.PgConnector()
+    connector.pool = FakePool(connection)
+    return connector
+
+
+class TestDbManager(aiounittest.AsyncTestCase):
+    def tearDown(self):
+        db_manager.db = None
+        db_manager.db_lock = None
+
+    async def test_connector_is_shared(self):
+        created = []
+
+        async def fake_create_pg_connector():
+            await asyncio.sleep(0.1)
+            created.append(create_connector(FakeConnection()))
+            return created[-1]
+
+        with patch.object(db_manager, "create_pg_connector", fake_create_pg_connector):
+            connectors = await asyncio.gather(*[db_manager.get_db() for _ in range(10)])
+        assert len(created) == 1
+        assert all(c is created[0] for c in connectors)
+        assert metrics.collect()["db_pool"]["max_size"] == 8
+
+    def test_connector_is_shared_across_loops(self):
+        async def fake_create_pg_connector():
+            await asyncio.sleep(0.01)
+            return create_connector(FakeConnection())
+
+        async def get_db():
+            return await asyncio.gather(db_manager.get_db(), db_manager.get_db())
+
+        with patch.object(db_manager, "create_pg_connector", fake_create_pg_connector):
+            for _ in range(2):
+                # e.g. the application loop after a test loop
+                loop = asyncio.new_event_loop()
+                try:
+                    connectors = loop.run_until_complete(get_db())
+                    loop.run_until_complete(db_manager.close_db())
+                finally:
+                    loop.close()
+                assert connectors[0] is connectors[1]
+
+    async def test_folder_removal_checks_uncached_presentations(self):
+        class FakeDb:
+            async def list_presentations(self, folder, limit=None, use_cache=True):
+                return {"results": [] if use_cache else [{"id": "1"}]}
+
+            async def remove_folder(self, folder_name):
+                raise AssertionError("removed a folder with presentations")
+
+        db_manager.db = FakeDb()
+        response = await ws_handlers.remove_folder(
+            {"id": "1", "params": {"folder_name": "a"}}
+        )
+        assert json.loads(response)["error"]["code"] == 403
+
+    async def test_compaction_failures_do_not_stop_the_batch(self):
+        compacted = []
+
+        class FakeDb:
+            async def get_presentations_to_compact(self, limit):
+                return ["a", "b"]
+
+            async def compact_archive(self, presentation_id):
+                if presentation_id == "a":
+                    raise asyncpg.exceptions.DataError("corrupted")
+                compacted.append(presentation_id)
+                return 1, 0
+
+        async def sleep(delay):
+            raise asyncio.CancelledError
+
+        db_manager.db = FakeDb()
+        with patch("asyncio.sleep", sleep), self.assertLogs(level="ERROR") as logs:
+            with self.assertRaises(asyncio.CancelledError):
+                await db_manager.compact_archives()
+        assert compacted == ["b"]
+        assert "Cannot compact archive of a" in logs.output[0]
+
+
+class TestPgConnector(aiounittest.AsyncTestCase):
+    async def test_read_is_retried_on_lost_connection(self):
+        connector = create_connector(FakeConnection(failures=1))
+        assert await connector.fetch("SELECT 1") == ["SELECT 1"]
+        stats = connector.get_pool_stats()
+        assert stats["reconnects"] == 1
+        assert stats["acquired"] == 2
+        assert connector.pool.in_use == 0
+
+    async def test_write_is_not_retried(self):
+        connection = FakeConnection(failures=1)
+        connector = create_connector(connection)
+        with self.assertRaises(asyncpg.exceptions.ConnectionDoesNotExistError):
+            await connector.execute("INSERT 1")
+        assert connection.queries == ["INSERT 1"]
+        assert connector.pool.in_use == 0
+
+    async def test_folder_removal_is_not_retried(self):
+        connection = FakeConnection(failures=1)
+        connector = create_connector(connection)
+        with self.assertRaises(asyncpg.exceptions.ConnectionDoesNotExistError):
+            await connector.remove_folder("a")
+        assert len(connection.queries) == 1
+
+    async def test_uncached_listings(self):
+        connection = FakeConnection()
+        connector = create_connector(connection)
+        for _ in range(2):
+            await connector.list_folders()
+        assert len(connection.queries) == 1
+        for _ in range(2):
+            await connector.list_folders(use_cache=False)
+        assert len(connection.queries) == 3
+
+    async def test_utilisation(self):
+        connector = create_connector(FakeConnection())
+        await connector.pool.acquire()
+        assert connector.get_pool_stats()["utilisation"] == 1 / 8
+
+    async def test_queries_are_parameterised(self):
+        connection = FakeConnection()
+        connector = create_connector(connection)
+        name = "x'; DROP TABLE folders; --"
+        await connector.save_presentation_to_storage(
+            {"id": "1509d5ec-163f-4a79-8942-4a8b74dbd438", "name": name}
+        )
+        await connector.get_presentation("1509d5ec-163f-4a79-8942-4a8b74dbd438")
+        await connector.create_folder(name)
+        for query in connection.queries:
+            assert "DROP" not in query
+            assert "1509d5ec" not in query
+        # json payloads are encoded by the connection's jsonb codec
+        assert connection.args[0][0]["name"] == name
+        assert connection.args[2] == (name,)
+
+    async def test_save_is_a_single_statement(self):
+        connection = FakeConnection()
+        connector = create_connector(connection)
+        await connector.save_presentation_to_storage(
+            {"id": PRESENTATION_ID, "name": "a"}
+        )
+        assert connection.queries == [pg_connector.SAVE_PRESENTATION]
+
+    async def test_save_validates_id(self):
+        connection = FakeConnection()
+        connector = create_connector(connection)
+        await connector.save_presentation_to_storage(
+            {"id": PRESENTATION_ID.upper(), "name": "a"}
+        )
+        assert connection.args[0][0]["id"] == PRESENTATION_ID
+        for presentation in ({"name": "a"}, {"id": None}, {"id": "1"}, {"id": 1}):
+            with self.assertRaises(CodeException) as cm:
+                await connector.save_presentation_to_storage(presentation)
+            assert cm.exception.code == config.MALFORMED_REQUEST
+        assert len(connection.queries) == 1
+
+    async def test_save_name_conflict(self):
+        class ConflictConnection(FakeConnection):
+            async def execute(self, query, *args):
+                raise asyncpg.exceptions.UniqueViolationError.new(
+                    {"C": "23505", "M": "duplicate", "n": self.constraint_name}
+                )
+
+        connection = ConflictConnection()
+        connector = create_connector(connection)
+        connection.constraint_name = pg_connector.NAME_CONSTRAINT
+        with self.assertRaises(CodeException) as cm:
+            await connector.save_presentation_to_storage(
+                {"id": PRESENTATION_ID, "name": "a", "folder": "f"}
+            )
+        assert cm.exception.code == config.PRESENTATION_NAME_CONFLICT
+
+        connection.constraint_name = "presentations_presentation_id_key"
+        with self.assertRaises(asyncpg.exceptions.UniqueViolationError):
+            await connector.save_presentation_to_storage(
+                {"id": PRESENTATION_ID, "name": "a"}
+            )
+
+    async def test_jsonb_codec(self):
+        codecs = []
+
+        class CodecConnection:
+            async def set_type_codec(self, type_name, **kwargs):
+                codecs.append(type_name)
+                assert kwargs["decoder"]('{"a": 1}') == {"a": 1}
+
+        await pg_connector.init_connection(CodecConnection())
+        assert "jsonb" in codecs
+
+
+class TestRawPresentation(aiounittest.AsyncTestCase):
+    async def test_presentation_is_spliced_in_response(self):
+        text = '{"id": "1509d5ec-163f-4a79-8942-4a8b74dbd438", "big": 1e400}'
+
+        class TextConnection(FakeConnection):
+            async def fetchrow(self, query, *args):
+                return (text,)
+
+        connector = create_connector(TextConnection())
+        presentation = await connector.get_presentation(
+            "1509d5ec-163f-4a79-8942-4a8b74dbd438"
+        )
+        # not decoded, 1e400 would become Infinity
+        response = jsonrpc.prepare_response({"id": "1"}, presentation)
+        assert response == '{"id":"1","result":' + text + "}"
+
+
+class ListConnection(FakeConnection):
+    def __init__(self, total):
+        super().__init__()
+        self.rows = [
+            (json.dumps({"id": str(i)}), f"2022-09-{30 - i:02}", total - i)
+            for i in range(total)
+        ]
+
+    async def fetch(self, query, limit, *args):
+        await super().fetch(query, limit, *args)
+        rows = self.rows
+        if args and isinstance(args[-1], int):
+            rows = [r for r in rows if (r[1], r[2]) < tuple(args[-2:])]
+        return rows[:limit]
+
+    async def fetchval(self, query, *args):
+        return len(self.rows)
+
+
+class TestListPresentations(aiounittest.AsyncTestCase):
+    async def test_pages(self):
+        connection = ListConnection(total=5)
+        connector = create_connector(connection)
+        listed = []
+        cursor = None
+        while True:
+            page = await connector.list_presentations("folder", 2, cursor)
+            assert page["total"] == 5
+            listed += [json.loads(p.text)["id"] for p in page["results"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        assert listed == ["0", "1", "2", "3", "4"]
+        assert connection.queries[-1] == pg_connector.LIST_PRESENTATIONS_AFTER
+
+    async def test_limit_is_capped(self):
+        connection = ListConnection(total=5)
+        connector = create_connector(connection)
+        with patch.object(config, "LIST_PRESENTATIONS_MAX_LIMIT", 3):
+            page = await connector.list_presentations(limit=100)
+        assert len(page["results"]) == 3
+        assert connection.args[0][0] == 4
+        assert connection.queries[0] == pg_connector.LIST_PRESENTATIONS_WITHOUT_FOLDER
+
+    async def test_invalid_cursor(self):
+        connector = create_connector(ListConnection(total=5))
+        for cursor in ["invalid", encode_cursor("a"), encode_cursor(1, "a")]:
+            with self.assertRaises(ValueError):
+                await connector.list_presentations(cursor=cursor)
+        with self.assertRaises(ValueError):
+            await connector.list_presentations(limit=-1)
+
+
+class VersionsConnection(FakeConnection):
+    async def fetch(self, query, limit, presentation_id, *args):
+        await super().fetch(query, limit, presentation_id, *args)
+        archive_ids = [i for i in range(10, 0, -1) if not args or i < args[0]]
+        return [({"archive_id": i}, i) for i in archive_ids][:limit]
+
+
+class TestPresentationVersions(aiounittest.AsyncTestCase):
+    async def test_pages(self):
+        connection = VersionsConnection()
+        connector = create_connector(connection)
+        listed = []
+        cursor = None
+        while True:
+            page = await connector.get_presentation_versions("1", 4, cursor)
+            listed += [v["archive_id"] for v in page["results"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        assert listed == list(range(10, 0, -1))
+        assert connection.queries[0] == pg_connector.GET_PRESENTATION_VERSIONS
+        assert connection.queries[-1] == pg_connector.GET_PRESENTATION_VERSIONS_AFTER
+
+    async def test_invalid_cursor(self):
+        connector = create_connector(VersionsConnection())
+        for cursor in ["invalid", encode_cursor("a"), encode_cursor(1, 2)]:
+            with self.assertRaises(ValueError):
+                await connector.get_presentation_versions("1", cursor=cursor)
+
+
+def make_history(versions):
+    """Versions of a presentation moving one of its windows at a time"""
+    windows = [{"uri": f"image{i}.png", "x": i, "y": 0} for i in range(20)]
+    history = {}
+    for archive_id in range(1, versions + 1):
+        windows = list(windows)
+        windows[archive_id % 20] = {**windows[archive_id % 20], "y": archive_id}
+        history[archive_id] = {
+            "id": "1",
+            "name": "scene",
+            "savedAt": str(archive_id),
+            "windows": windows,
+        }
+    return history
+
+
+class ArchiveConnection(FakeConnection):
+    """Archived versions of a single presentation, stored in memory"""
+
+    def __init__(self, documents, archived_at):
+        super().__init__()
+        self.rows = {
+            archive_id: [archive_id, data, None, None, False, archived_at[archive_id]]
+            for archive_id, data in documents.items()
+        }
+
+    def transaction(self):
+        return MigrationConnection().transaction()
+
+    async def fetch(self, query, *args):
+        await super().fetch(query, *args)
+        return [tuple(self.rows[archive_id]) for archive_id in sorted(self.rows)]
+
+    async def fetchrow(self, query, archive_id):
+        data, delta, base_id = self.rows[archive_id][1:4]
+        return data, delta, base_id and self.rows[base_id][1]
+
+    async def executemany(self, query, updates):
+        self.queries.append(query)
+        for archive_id, data, delta, base_id in updates:
+            self.rows[archive_id][1:5] = data, delta, base_id, True
+
+    async def execute(self, query, archive_ids):
+        self.queries.append(query)
+        for archive_id in archive_ids:
+            assert all(row[3] != archive_id for row in self.rows.values())
+        for archive_id in archive_ids:
+            del self.rows[archive_id]
+
+
+class TestArchive(aiounittest.AsyncTestCase):
+    def test_encoded_versions_are_reconstructed(self):
+        history = make_history(25)
+        encoded = archive.encode(history, 10)
+        snapshots = [i for i, (_, delta, _) in encoded.items() if delta is None]
+        assert snapshots == [1, 11, 21]
+        for archive_id, (data, delta, base_id) in encoded.items():
+            assert base_id is None or base_id in snapshots
+            base_data = base_id and encoded[base_id][0]
+            assert archive.reconstruct(data, delta, base_data) == history[archive_id]
+            assert data["savedAt"] == str(archive_id)
+        rows = [(i, *encoded[i]) for i in encoded]
+        assert archive.reconstruct_all(rows) == history
+
+    def test_larger_deltas_are_stored_in_full(self):
+        encoded = archive.encode({1: {"a": "x" * 100}, 2: {"b": 1}}, 10)
+        assert encoded[2] == ({"b": 1}, None, None)
+
+    def test_retention(self):
+        start = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+        versions = [(i, start + datetime.timedelta(hours=6 * i)) for i in range(1, 13)]
+        # versions 1-3 on day one, 4-7 on day two, the last five kept anyway
+        assert archive.select_retained(versions, 5, 24 * 3600) == {
+            3,
+            7,
+            8,
+            9,
+            10,
+            11,
+            12,
+        }
+        assert archive.select_retained(versions, 5, 0) == {8, 9, 10, 11, 12}
+        undated = [(i, None) for i in range(1, 5)] + versions[4:]
+        assert archive.select_retained(undated, 5, 24 * 3600) == {
+            1,
+            2,
+            3,
+            4,
+            7,
+            8,
+            9,
+            10,
+            11,
+            12,
+        }
+        assert len(archive.select_retained(versions, 0, 0)) == 12
+
+    async def test_compaction(self):
+        history = make_history(30)
+        start = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+        archived_at = {
+            i: start + datetime.timedelta(hours=i if i <= 20 else 24) for i in history
+        }
+        connection = ArchiveConnection(history, archived_at)
+        connector = create_connector(connection)
+        with patch.multiple(
+            config,
+            ARCHIVE_KEEP_LAST=10,
+            ARCHIVE_THIN_PERIOD=24 * 3600,
+            ARCHIVE_SNAPSHOT_INTERVAL=4,
+        ):
+            assert await connector.compact_archive("1") == (11, 19)
+            # versions 1-20 archived on day one are thinned down to the last one
+            assert sorted(connection.rows) == [20] + list(range(21, 31))
+            for archive_id in connection.rows:
+                version = await connector.get_presentation_version(archive_id)
+                assert version == history[archive_id]
+            assert [
+                archive_id
+                for archive_id, row in connection.rows.items()
+                if row[2] is None
+            ] == [20, 24, 28]
+            assert connector.pool.in_use == 0
+
+            # compacted versions are left untouched
+            assert await connector.compact_archive("1") == (0, 0)
+
+    async def test_compaction_keeps_undated_versions(self):
+        history = make_history(30)
+        start = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+        # versions 1-20 were archived before archiving times were recorded, 21-25
+        # of a same day are thinned down to the last one
+        archived_at = {i: None if i <= 20 else start for i in history}
+        connection = ArchiveConnection(history, archived_at)
+        connector = create_connector(connection)
+        with patch.multiple(config, ARCHIVE_KEEP_LAST=5, ARCHIVE_THIN_PERIOD=24 * 3600):
+            assert await connector.compact_archive("1") == (26, 4)
+        assert sorted(connection.rows) == list(range(1, 21)) + list(range(25, 31))
+
+
+class TestPresentationCache(aiounittest.AsyncTestCase):
+    def setUp(self):
+        self.cache = PresentationCache(1024, 10)
+        self.cache.set_listening(True)
+        self.loads = []
+
+    def load(self, value):
+        async def load():
+            self.loads.append(value)
+            return value
+
+        return load
+
+    async def test_read_through(self):
+        key = self.cache.presentation_key("1")
+        assert await self.cache.get_or_load(key, self.load({"id": "1"})) == {"id": "1"}
+        assert await self.cache.get_or_load(key, self.load({"id": "2"})) == {"id": "1"}
+        # missing presentations too
+        key = self.cache.presentation_key("3")
+        assert await self.cache.get_or_load(key, self.load(None)) is None
+        assert await self.cache.get_or_load(key, self.load({"id": "3"})) is None
+        assert len(self.loads) == 2
+        assert self.cache.get_stats()["hit_ratio"] == 0.5
+
+    async def test_notifications(self):
+        async def get_all():
+            return [
+                await self.cache.get_or_load(key(), self.load(key()))
+                for key in (
+                    lambda: self.cache.presentation_key("1"),
+                    lambda: self.cache.presentation_key("2"),
+                    lambda: self.cache.listing_key("a", 10, None),
+                    lambda: self.cache.listing_key(None, 10, None),
+                    self.cache.folders_key,
+                )
+            ]
+
+        await get_all()
+        assert len(self.loads) == 5
+        self.cache.handle_change({"presentations": [{"id": "1", "folder": "a"}]})
+        await get_all()
+        assert len(self.loads) == 7
+        # an empty folder is no folder
+        self.cache.handle_change({"presentations": [{"id": "3", "folder": ""}]})
+        self.cache.handle_change({"folders": [{"name": "b", "action": "created"}]})
+        await get_all()
+        assert len(self.loads) == 9
+        self.cache.handle_change({"all": True})
+        await get_all()
+        assert len(self.loads) == 14
+
+    async def test_load_racing_a_change_is_not_cached(self):
+        key = self.cache.presentation_key("1")
+
+        async def load():
+            self.cache.invalidate(["1"])
+            return "stale"
+
+        assert await self.cache.get_or_load(key, load) == "stale"
+        assert await self.cache.get_or_load(key, self.load("fresh")) == "fresh"
+        assert await self.cache.get_or_load(key, self.load("newer")) == "fresh"
+
+    async def test_expiry_while_not_listening(self):
+        key = self.cache.presentation_key("1")
+        await self.cache.get_or_load(key, self.load("a"))
+        later = time.monotonic() + 20
+        with patch.object(time, "monotonic", return_value=later):
+            assert await self.cache.get_or_load(key, self.load("b")) == "a"
+            self.cache.set_listening(False)
+            assert await self.cache.get_or_load(key, self.load("c")) == "c"
+            assert await self.cache.get_or_load(key, self.load("d")) == "c"
+        with patch.object(time, "monotonic", return_value=later + 20):
+            assert await self.cache.get_or_load(key, self.load("e")) == "e"
+
+    async def test_memory_cap(self):
+        for i in range(100):
+            key = self.cache.presentation_key(str(i))
+            await self.cache.get_or_load(key, self.load("x" * 100))
+        stats = self.cache.get_stats()
+        assert stats["size"] <= 1024
+        assert stats["evictions"] > 0
+
+    async def test_entry_sizes(self):
+        document = RawJSON('{"id": "1", "name": "a"}')
+        await self.cache.get_or_load(
+            self.cache.presentation_key("1"), self.load(document)
+        )
+        assert self.cache.get_stats()["size"] == len(document.text)
+        # listings are estimated from their documents
+        await self.cache.get_or_load(
+            self.cache.listing_key(None, 10, None),
+            self.load({"results": [document] * 10, "total": 10, "next_cursor": None}),
+        )
+        size = self.cache.get_stats()["size"] - len(document.text)
+        assert 10 * len(document.text) < size < 20 * len(document.text)
+
+
+class ListenConnection:
+    def __init__(self):
+        self.listeners = {}
+        self.on_termination = None
+        self.closed = False
+
+    def add_termination_listener(self, callback):
+        self.on_termination = callback
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    async def execute(self, query, timeout=None):
+        pass
+
+    def is_closed(self):
+        return self.closed
+
+    def terminate(self):
+        self.closed = True
+        self.on_termination(self)
+
+
+class TestCachedConnector(aiounittest.AsyncTestCase):
+    async def test_reads_are_cached_until_written(self):
+        connection = FakeConnection()
+        connector = create_connector(connection)
+        presentation_id = "1509d5ec-163f-4a79-8942-4a8b74dbd438"
+        for _ in range(3):
+            await connector.get_presentation(presentation_id)
+            await connector.list_folders()
+        assert len(connection.queries) == 2
+
+        await connector.save_presentation_to_storage({"id": presentation_id})
+        await connector.create_folder("folder")
+        await connector.get_presentation(presentation_id)
+        await connector.list_folders()
+        assert len(connection.queries) == 6
+
+    async def test_listen_for_changes(self):
+        connection = ListenConnection()
+        connector = create_connector(FakeConnection())
+
+        async def connect(**kwargs):
+            return connection
+
+        with patch.object(asyncpg, "connect", connect), patch.object(
+            config, "PRESENTATION_CACHE_KEEPALIVE_INTERVAL", 0.01
+        ):
+            listening = asyncio.ensure_future(connector.listen_for_changes())
+            await asyncio.sleep(0.05)
+            assert connector.cache.listening
+
+            listener = connection.listeners[pg_connector.NOTIFICATION_CHANNEL]
+            listener(connection, 1, "channel", json.dumps({"folders": []}))
+            assert connector.cache.invalidations == 2
+
+            # e.g. the database restarted
+            connection.terminate()
+            await asyncio.wait_for(listening, 1)
+        assert not connector.cache.listening
+
+
+class FakeWebSocket:
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def send_str(self, message):
+        await self.unblocked.wait()
+        self.sent.append(json.loads(message))
+
+
+class PausedWebSocket(FakeWebSocket):
+    """Fails like aiohttp 3.7 when a second writer waits for the paused
+    transport to drain
+    """
+
+    def __init__(self):
+        super().__init__(blocked=True)
+        self.draining = False
+
+    async def send_str(self, message):
+        assert not self.draining, "concurrent writers"
+        self.draining = True
+        try:
+            await super().send_str(message)
+        finally:
+            self.draining = False
+
+
+class TestSubscriptions(aiounittest.AsyncTestCase):
+    def tearDown(self):
+        subscriptions.subscribers.clear()
+
+    async def test_responses_wait_for_notifications_on_paused_transport(self):
+        ws = PausedWebSocket()
+        subscriber = subscriptions.Subscriber(ws)
+        subscriber.subscribe(subscriptions.PRESENTATIONS, None)
+        subscriptions.dispatch({"presentations": [{"id": "1", "folder": None}]})
+        await asyncio.sleep(0)
+
+        # e.g. the response to a request, while the notification is draining
+        responding = asyncio.ensure_future(
+            subscriber.send(jsonrpc.prepare_response({"id": "2"}, {}))
+        )
+        await asyncio.sleep(0.01)
+        ws.unblocked.set()
+        await asyncio.wait_for(responding, 1)
+        await asyncio.wait_for(subscriber.sender, 1)
+        assert [message.get("method", "response") for message in ws.sent] == [
+            "PresentationChanged",
+            "response",
+        ]
+
+    async def test_changes_are_pushed_to_matching_subscriptions(self):
+        ws = FakeWebSocket()
+        subscriber = subscriptions.Subscriber(ws)
+        by_id = subscriber.subscribe(subscriptions.PRESENTATIONS, {"1"})
+        everything = subscriber.subscribe(subscriptions.PRESENTATIONS, None)
+        in_folder = subscriber.subscribe(subscriptions.FOLDER, "a")
+        without_folder = subscriber.subscribe(subscriptions.FOLDER, None)
+
+        # presentation 1 moved from folder a to no folder
+        subscriptions.dispatch(
+            {
+                "presentations": [
+                    {"id": "1", "folder": "a", "savedAt": 1, "action": "deleted"},
+                    {"id": "1", "folder": None, "savedAt": 2, "action": "saved"},
+                ]
+            }
+        )
+        subscriptions.dispatch(
+            {"presentations": [{"id": "2", "folder": "", "action": "saved"}]}
+        )
+        subscriptions.dispatch({"folders": [{"name": "a", "action": "deleted"}]})
+        await asyncio.sleep(0)
+
+        pushed = [(m["params"]["subscription"], m["params"]) for m in ws.sent]
+        assert [(sid, p.get("id"), p["action"]) for sid, p in pushed] == [
+            (by_id, "1", "saved"),
+            (everything, "1", "saved"),
+            (in_folder, "1", "deleted"),
+            (without_folder, "1", "saved"),
+            (everything, "2", "saved"),
+            (without_folder, "2", "saved"),
+            (in_folder, None, "deleted"),
+        ]
+        assert ws.sent[-1]["method"] == "FolderChanged"
+        assert "id" not in ws.sent[0]
+
+        subscriptions.dispatch({"all": True})
+        await asyncio.sleep(0)
+        assert ws.sent[-1]["method"] == "SubscriptionsReset"
+
+    async def test_slow_client_overflow(self):
+        ws = FakeWebSocket(blocked=True)
+        subscriber = subscriptions.Subscriber(ws)
+        subscriber.subscribe(subscriptions.PRESENTATIONS, None)
+        with patch.object(config, "SUBSCRIPTION_MAX_PENDING", 5):
+            for i in range(12):
+                subscriptions.dispatch(
+                    {"presentations": [{"id": str(i), "folder": None}]}
+                )
+                await asyncio.sleep(0)
+            # bounded while the client does not read
+            assert len(subscriber.pending) <= 5
+            ws.unblocked.set()
+            await subscriber.sender
+        # changes before the client reloads are dropped
+        methods = [m["method"] for m in ws.sent]
+        assert methods == ["PresentationChanged", "SubscriptionsOverflow"]
+        assert subscriptions.get_subscription_stats()["overflows"] == 1
+
+        subscriptions.dispatch({"presentations": [{"id": "12", "folder": None}]})
+        await subscriber.sender
+        assert ws.sent[-1]["params"]["id"] == "12"
+
+    async def test_unsubscribe(self):
+        subscriber = subscriptions.Subscriber(FakeWebSocket())
+        response = await ws_handlers.subscribe_folder(
+            {"id": "1", "params": {"folder": "a"}}, subscriber
+        )
+        subscription_id = json.loads(response)["result"]["subscription"]
+        assert subscriptions.get_subscription_stats()["subscriptions"] == 1
+
+        data = {"id": "2", "params": {"subscription": subscription_id}}
+        await ws_handlers.unsubscribe(data, subscriber)
+        assert subscriber not in subscriptions.subscribers
+        with self.assertRaises(CodeException):
+            await ws_handlers.unsubscribe(data, subscriber)
+
+    async def test_invalid_ids(self):
+        subscriber = subscriptions.Subscriber(FakeWebSocket())
+        response = await ws_handlers.subscribe_presentations(
+            {"id": "1", "params": {"ids": "1"}}, subscriber
+        )
+        assert json.loads(response)["error"]["code"] == config.MALFORMED_REQUEST
+        assert not subscriber.subscriptions
+
+
+class MigrationConnection:
+    def __init__(self, versions=()):
+        self.versions = set(versions)
+        self.statements = []
+
+    def transaction(self):
+        connection = self
+
+        class Transaction:
+            async def __aenter__(self):
+                connection.statements.append("BEGIN")
+
+            async def __aexit__(self, *args):
+                connection.statements.append("COMMIT")
+
+        return Transaction()
+
+    async def execute(self, statement, *args):
+        self.statements.append(statement)
+        if statement.startswith("INSERT INTO schema_migrations"):
+            self.versions.add(args[0])
+
+    async def fetch(self, query):
+        return [(version,) for version in self.versions]
+
+
+class TestMigrations(aiounittest.AsyncTestCase):
+    test_migrations = [
+        (2, "second", ["CREATE INDEX b"]),
+        (1, "first", ["CREATE TABLE a"]),
+    ]
+
+    async def test_pending_migrations_are_applied_in_order(self):
+        connection = MigrationConnection()
+        assert await migrations.migrate(connection, self.test_migrations) == [1, 2]
+        assert connection.statements.index("CREATE TABLE a") < (
+            connection.statements.index("CREATE INDEX b")
+        )
+        assert connection.statements[0] == "BEGIN"
+        assert "pg_advisory_xact_lock" in connection.statements[1]
+        assert connection.statements[-1] == "COMMIT"
+
+        # nothing left to apply
+        assert await migrations.migrate(connection, self.test_migrations) == []
+
+    async def test_applied_migrations_are_skipped(self):
+        connection = MigrationConnection(versions=[1])
+        assert await migrations.migrate(connection, self.test_migrations) == [2]
+        assert "CREATE TABLE a" not in connection.statements
+
+    def test_versions_are_unique(self):
+        versions = [version for version, _, _ in migrations.MIGRATIONS]
+        assert len(versions) == len(set(versions))
@@ -1,7 +1,7 @@
 from .. import config
 from ..utils import jsonrpc
 from ..utils.exceptions import CodeException
-from . import db_manager
+from . import db_manager, subscriptions
 
 
 async def get_presentation(data):
@@ -30,10 +30,41 @@ async def list_scene_versions(data):
     :rtype: dict
     """
 
-    presentation_versions = await (await db_manager.get_db()).get_presentation_versions(
-        presentation_id=data["params"]["id"]
+    params = data["params"]
+    try:
+        versions_page = await (await db_manager.get_db()).get_presentation_versions(
+            params["id"], params.get("limit"), params.get("cursor")
+        )
+    except (ValueError, TypeError) as e:
+        return jsonrpc.prepare_error(data, config.MALFORMED_REQUEST, str(e))
+    response = {
+        "results": versions_page["results"],
+        "count": len(versions_page["results"]),
+        "next_cursor": versions_page["next_cursor"],
+    }
+    return jsonrpc.prepare_response(data, response)
+
+
+async def get_presentation_version(data):
+    """Handler for GetPresentationVersion JSON-RPC method.
+
+    :param data: JSON-RPC object
+    :type data: dict
+    :return: JSON-RPC object
+    :rtype: dict
+    """
+    try:
+        archive_id = int(data["params"]["archive_id"])
+    except (ValueError, TypeError) as e:
+        return jsonrpc.prepare_error(data, config.MALFORMED_REQUEST, str(e))
+    presentation = await (await db_manager.get_db()).get_presentation_version(
+        archive_id
     )
-    return jsonrpc.prepare_response(data, presentation_versions)
+    if not presentation:
+        raise CodeException(
+            config.PRESENTATION_NOT_FOUND, "Presentation version not found"
+        )
+    return jsonrpc.prepare_response(data, presentation)
 
 
 async def list_presentations(data):
@@ -45,14 +76,18 @@ async def list_presentations(data):
     :rtype: dict
     """
 
+    params = data.get("params", {})
     try:
-        folder = data["params"]["folder"]
-    except KeyError:
-        folder = None
-    presentation_list = await (await db_manager.get_db()).list_presentations(folder)
+        presentation_page = await (await db_manager.get_db()).list_presentations(
+            params.get("folder"), params.get("limit"), params.get("cursor")
+        )
+    except (ValueError, TypeError) as e:
+        return jsonrpc.prepare_error(data, config.MALFORMED_REQUEST, str(e))
     response = {
-        "results": presentation_list,
-        "count": len(presentation_list),
+        "results": presentation_page["results"],
+        "count": len(presentation_page["results"]),
+        "total": presentation_page["total"],
+        "next_cursor": presentation_page["next_cursor"],
     }
     return jsonrpc.prepare_response(data, response)
 
@@ -114,10 +149,11 @@ async def remove_folder(data):
     """
     folder_name = data["params"]["folder_name"]
 
-    presentation_list = await (await db_manager.get_db()).list_presentations(
-        folder_name
+    # uncached, the folder may have been filled by another instance meanwhile
+    presentation_page = await (await db_manager.get_db()).list_presentations(
+        folder_name, limit=1, use_cache=False
     )
-    if presentation_list:
+    if presentation_page["results"]:
         return jsonrpc.prepare_error(
             data, 403, "Cannot remove, folder contains presentations"
         )
@@ -138,3 +174,61 @@ async def list_folders(data):
     """
     folder_list = await (await db_manager.get_db()).list_folders()
     return jsonrpc.prepare_response(data, folder_list)
+
+
+async def subscribe_presentations(data, subscriber):
+    """Handler for SubscribePresentations JSON-RPC method. Changes of the given
+    presentations (of all presentations without "ids") are pushed as
+    PresentationChanged notifications.
+
+    :param data: JSON-RPC object
+    :type data: dict
+    :param subscriber: subscriptions of the client
+    :type subscriber: class: `Subscriber`
+    :return: JSON-RPC object
+    :rtype: dict
+    """
+    ids = data.get("params", {}).get("ids")
+    if ids is not None and (
+        not isinstance(ids, list) or not all(isinstance(i, str) for i in ids)
+    ):
+        return jsonrpc.prepare_error(
+            data, config.MALFORMED_REQUEST, "ids must be a list of presentation ids"
+        )
+    subscription_id = subscriber.subscribe(
+        subscriptions.PRESENTATIONS, None if ids is None else set(ids)
+    )
+    return jsonrpc.prepare_response(data, {"subscription": subscription_id})
+
+
+async def subscribe_folder(data, subscriber):
+    """Handler for SubscribeFolder JSON-RPC method. Changes of presentations in
+    the folder (without "folder", of presentations without folder) are pushed as
+    PresentationChanged notifications, its creation or removal as FolderChanged.
+
+    :param data: JSON-RPC object
+    :type data: dict
+    :param subscriber: subscriptions of the client
+    :type subscriber: class: `Subscriber`
+    :return: JSON-RPC object
+    :rtype: dict
+    """
+    folder = data.get("params", {}).get("folder") or None
+    subscription_id = subscriber.subscribe(subscriptions.FOLDER, folder)
+    return jsonrpc.prepare_response(data, {"subscription": subscription_id})
+
+
+@jsonrpc.validate_jsonrpc(required_param="subscription")
+async def unsubscribe(data, subscriber):
+    """Handler for Unsubscribe JSON-RPC method.
+
+    :param data: JSON-RPC object
+    :type data: dict
+    :param subscriber: subscriptions of the client
+    :type subscriber: class: `Subscriber`
+    :return: JSON-RPC object
+    :rtype: dict
+    """
+    if not subscriber.unsubscribe(data["params"]["subscription"]):
+        raise CodeException(config.SUBSCRIPTION_NOT_FOUND, "Subscription not found")
+    return jsonrpc.prepare_response(data, "OK")
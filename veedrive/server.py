@@ -1,25 +1,29 @@
 import asyncio
-import json
 import logging
 import os.path
-from concurrent.futures import ProcessPoolExecutor
+import socket
+import zlib
+from email.utils import formatdate
 
 import aiohttp
 import asyncpg
 import cv2
-from aiohttp import web
+from aiohttp import hdrs, web
 from aiohttp.web import (HTTPBadRequest, HTTPForbidden,
                          HTTPInternalServerError, HTTPNotFound, HTTPOk)
 
 from . import config
-from .content import content_manager
+from .content import content_manager, fs_manager, pyramid
 from .content import ws_handlers as content_handler
-from .content.utils import get_dir_file_hash_pair
+from .content.utils import (fix_root_slash, get_thumbnail_cache_file,
+                            is_cache_fresh)
 from .presentation import ws_handlers as presentation_handler
-from .utils import jsonrpc
+from .presentation.subscriptions import Subscriber
+from .utils import json_encoders, jsonrpc, metrics
+from .utils.asynchro import SingleFlight, run_async
 from .utils.exceptions import CodeException, WrongObjectType
 
-loop = asyncio.get_event_loop()
+thumbnail_generations = SingleFlight()
 
 
 async def handle_ws(request):
@@ -30,44 +34,53 @@ async def handle_ws(request):
     """
     ws = web.WebSocketResponse()
     await ws.prepare(request)
+    subscriber = Subscriber(ws)
+    try:
+        await _handle_ws_messages(ws, subscriber)
+    finally:
+        subscriber.close()
+        fs_manager.release_client_searches(subscriber)
+    return ws
+
+
+async def _handle_ws_messages(ws, subscriber):
     async for msg in ws:
         if msg.type == aiohttp.WSMsgType.TEXT:
             if msg.data == "close":
                 await ws.close()
             else:
                 response = None
-                data = json.loads(msg.data)
+                data = json_encoders.loads(msg.data)
                 try:
-                    response = await process_request(data)
-                    await ws.send_str(response)
+                    response = await process_request(data, subscriber)
+                    await subscriber.send(response)
                 except KeyError as e:
-                    await ws.send_str(
+                    await subscriber.send(
                         jsonrpc.prepare_error(
                             data, config.MALFORMED_REQUEST, "Malformed"
                         )
                     )
                 except CodeException as e:
-                    await ws.send_str(jsonrpc.prepare_error_code(data, e))
+                    await subscriber.send(jsonrpc.prepare_error_code(data, e))
                 except PermissionError as e:
-                    await ws.send_str(
+                    await subscriber.send(
                         jsonrpc.prepare_error(data, config.PERMISSION_DENIED, str(e))
                     )
                 except FileNotFoundError as e:
-                    await ws.send_str(
+                    await subscriber.send(
                         jsonrpc.prepare_error(data, config.PATH_NOT_FOUND, str(e))
                     )
                 except WrongObjectType as e:
-                    await ws.send_str(
+                    await subscriber.send(
                         jsonrpc.prepare_error(
                             data, config.WRONG_FILE_TYPE_REQUESTED, str(e)
                         )
                     )
         elif msg.type == aiohttp.WSMsgType.ERROR:
             logging.error(f"ws connection closed with exception {ws.exception()}")
-    return ws
 
 
-async def process_request(data):
+async def process_request(data, subscriber=None):
     method = data["method"]
     # Content
     if method == "RequestFile":
@@ -77,9 +90,11 @@ async def process_request(data):
     elif method == "ListDirectory":
         return await content_handler.list_directory(data)
     elif method == "Search":
-        return await content_handler.search(data)
+        return await content_handler.search(data, subscriber)
     elif method == "SearchResult":
         return await content_handler.get_search_result(data)
+    elif method == "CancelSearch":
+        return await content_handler.cancel_search(data, subscriber)
 
     # Scene
     try:
@@ -91,6 +106,8 @@ async def process_request(data):
             return await presentation_handler.save_presentation(data)
         elif method == "PresentationVersions":
             return await presentation_handler.list_scene_versions(data)
+        elif method == "GetPresentationVersion":
+            return await presentation_handler.get_presentation_version(data)
         elif method == "DeletePresentation":
             return await presentation_handler.delete_presentation(data)
         elif method == "ListFolders":
@@ -99,7 +116,20 @@ async def process_request(data):
             return await presentation_handler.create_folder(data)
         elif method == "RemoveFolder":
             return await presentation_handler.remove_folder(data)
-    except (asyncpg.exceptions.PostgresError, ConnectionRefusedError) as e:
+        elif method == "SubscribePresentations":
+            return await presentation_handler.subscribe_presentations(data, subscriber)
+        elif method == "SubscribeFolder":
+            return await presentation_handler.subscribe_folder(data, subscriber)
+        elif method == "Unsubscribe":
+            return await presentation_handler.unsubscribe(data, subscriber)
+    except (
+        asyncpg.exceptions.PostgresError,
+        asyncpg.exceptions.InterfaceError,
+        # the database is unreachable, other OS errors are not database issues
+        ConnectionError,
+        socket.gaierror,
+        asyncio.TimeoutError,
+    ) as e:
         logging.critical(f"{type(e).__name__}: {e}")
         return jsonrpc.prepare_error(data, 999, "DB_ISSUE")
 
@@ -117,62 +147,106 @@ async def handle_thumbnail_request(request):
     """
     path = request.match_info["path"]
     try:
+        page = int(request.query.get("page", 0))
+        thumbnail_format = content_manager.get_thumbnail_format(
+            path, request.query.get("format"), request.headers.get(hdrs.ACCEPT)
+        )
+        headers = {}
+        if thumbnail_format and "format" not in request.query:
+            # format negotiated from the Accept header
+            headers[hdrs.VARY] = hdrs.ACCEPT
         extra_query_parms = "width", "height", "mode"
         if not all(e in request.query.keys() for e in extra_query_parms):
-            thumnail_cache_path = os.path.join(*get_dir_file_hash_pair(path))
-            if os.path.exists(
-                os.path.join(config.THUMBNAIL_CACHE_PATH, thumnail_cache_path)
-            ):
-                return web.HTTPFound(
-                    f"{config.STATIC_CONTENT_URL}/cache/{thumnail_cache_path}"
+            source_file = os.path.join(config.SANDBOX_PATH, fix_root_slash(path))
+            thumnail_cache_path = get_thumbnail_cache_file(path, page, thumbnail_format)
+            thumbnail_file = os.path.join(
+                config.THUMBNAIL_CACHE_PATH, thumnail_cache_path
+            )
+            if not is_cache_fresh(thumbnail_file, source_file):
+                await thumbnail_generations.run(
+                    thumnail_cache_path,
+                    _generate_cached_thumbnail,
+                    path,
+                    page,
+                    thumbnail_format,
                 )
 
-            with ProcessPoolExecutor(1) as process_executor:
-                await loop.run_in_executor(
-                    process_executor,
-                    content_manager.cache_thumbnail,
-                    path,
-                    config.THUMBNAIL_CACHE_PATH,
+            if config.SERVE_CACHED_FILES:
+                response = _serve_cached_file(
+                    request,
+                    thumbnail_file,
+                    source_file,
+                    content_manager.get_thumbnail_content_type(path, thumbnail_format),
                 )
+                response.headers.update(headers)
+                return response
             return web.HTTPFound(
-                f"{config.STATIC_CONTENT_URL}/cache/{thumnail_cache_path}"
+                f"{config.STATIC_CONTENT_URL}/cache/{thumnail_cache_path}",
+                headers=headers,
             )
         else:
             optional_params = [
                 int(request.query["width"]),
                 int(request.query["height"]),
                 request.query["mode"],
+                page,
+                thumbnail_format,
             ]
-            with ProcessPoolExecutor(1) as process_executor:
-                data = await loop.run_in_executor(
-                    process_executor,
-                    content_manager.get_thumbnail,
-                    path,
-                    *optional_params,
-                )
-        return web.Response(body=data[0], content_type=data[1])
+            data = await content_manager.get_cached_thumbnail(path, *optional_params)
+        return web.Response(body=data[0], content_type=data[1], headers=headers)
     except FileNotFoundError as e:
         raise HTTPNotFound()
     except PermissionError as e:
         raise HTTPForbidden()
     except (ValueError, TypeError) as e:
-
-        raise HTTPBadRequest(reason=e)
+        raise HTTPBadRequest(reason=str(e))
     except cv2.error as e:
         logging.error(e)
         raise HTTPInternalServerError(reason="Opencv cannot handle this request")
 
 
+async def _generate_cached_thumbnail(path, page, thumbnail_format):
+    thumbnail_file = os.path.join(
+        config.THUMBNAIL_CACHE_PATH,
+        get_thumbnail_cache_file(path, page, thumbnail_format),
+    )
+    if os.path.exists(thumbnail_file):
+        # outdated, source file has been modified
+        os.remove(thumbnail_file)
+    try:
+        await run_async(
+            content_manager.cache_thumbnail,
+            path,
+            config.THUMBNAIL_CACHE_PATH,
+            page,
+            thumbnail_format,
+        )
+    except FileExistsError:
+        # generated meanwhile by another process (e.g. content optimizer)
+        pass
+
+
 async def handle_scaled_image_request(request):
     path = request.match_info["path"]
     try:
         width = int(request.query["width"])
         height = int(request.query["height"])
-        try:
-            mode = str(request.query["mode"])
-            data = await content_manager.get_scaled_image(path, width, height, mode)
-        except KeyError:
-            data = await content_manager.get_scaled_image(path, width, height)
+        mode = str(request.query.get("mode", config.FIT_TRANSFORM_IMAGE))
+        cache_file = await content_manager.get_scaled_image_cache_file(
+            path, width, height, mode
+        )
+        if cache_file and config.SERVE_CACHED_FILES:
+            return _serve_cached_file(
+                request,
+                os.path.join(config.SCALED_CACHE_PATH, cache_file),
+                os.path.join(config.SANDBOX_PATH, fix_root_slash(path)),
+                content_manager.get_scaled_image_content_type(path),
+            )
+        if cache_file:
+            return web.HTTPFound(
+                f"{config.STATIC_CONTENT_URL}/cache/scaled/{cache_file}"
+            )
+        data = await content_manager.get_scaled_image(path, width, height, mode)
         return web.Response(body=data[0], content_type=data[1])
     except (KeyError, ValueError):
         raise HTTPBadRequest()
@@ -185,6 +259,111 @@ async def handle_scaled_image_request(request):
         raise HTTPInternalServerError()
 
 
+def _serve_cached_file(request, cache_file, source_file, content_type):
+    """Serve a cached file with validators derived from its source file
+
+    :param request: request
+    :type request: class: `aiohttp.web.BaseRequest`
+    :param cache_file: absolute path of the cached file
+    :type cache_file: str
+    :param source_file: absolute path of the file the cached file has been generated from
+    :type source_file: str
+    :param content_type: http content-type of the cached file
+    :type content_type: str
+    :return: cached file or 304 if the client's copy is still valid
+    :rtype: class: `aiohttp.web.StreamResponse`
+    """
+    source_stat = os.stat(source_file)
+    # representations of a source, e.g. video thumbnail formats, differ
+    representation = zlib.crc32(os.path.basename(cache_file).encode())
+    etag = (
+        f'"{source_stat.st_mtime_ns:x}-{source_stat.st_size:x}-{representation:x}"'
+    )
+    headers = {
+        hdrs.ETAG: etag,
+        hdrs.LAST_MODIFIED: formatdate(source_stat.st_mtime, usegmt=True),
+        hdrs.CACHE_CONTROL: f"public, max-age={config.CACHED_FILES_MAX_AGE}",
+    }
+
+    if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+    if if_none_match is not None:
+        client_etags = [e.strip() for e in if_none_match.split(",")]
+        client_etags = [e[2:] if e.startswith("W/") else e for e in client_etags]
+        if etag in client_etags or "*" in client_etags:
+            return web.Response(status=304, headers=headers)
+    elif request.if_modified_since:
+        if request.if_modified_since.timestamp() >= int(source_stat.st_mtime):
+            return web.Response(status=304, headers=headers)
+
+    headers[hdrs.CONTENT_TYPE] = content_type
+    return web.FileResponse(cache_file, headers=headers)
+
+
+async def handle_tiles_descriptor_request(request):
+    """Deep Zoom descriptor endpoint handler. Builds image tiles if needed
+
+    :param request: request
+    :type request: class: `aiohttp.web.BaseRequest`
+    :return: Deep Zoom descriptor (JSON) of the image, including the tiles base URL
+    :rtype: class: `aiohttp.web.Response`
+    """
+    path = request.match_info["path"]
+    try:
+        pyramid_folder = await content_manager.get_image_pyramid(path)
+        descriptor = pyramid.read_descriptor(
+            os.path.join(config.TILES_CACHE_PATH, pyramid_folder)
+        )
+        descriptor["Image"]["Url"] = f"{config.CONTENT_URL}/tiles/{path}/"
+        return web.Response(
+            body=json_encoders.dumps(descriptor), content_type="application/json"
+        )
+    except FileNotFoundError:
+        raise HTTPNotFound()
+    except PermissionError:
+        raise HTTPForbidden()
+    except (ValueError, TypeError, WrongObjectType) as e:
+        raise HTTPBadRequest(reason=str(e))
+
+
+async def handle_tile_request(request):
+    """Image tile endpoint handler. Builds image tiles if needed
+
+    :param request: request
+    :type request: class: `aiohttp.web.BaseRequest`
+    :return: redirection to the tile or the tile itself
+    :rtype: class: `aiohttp.web.StreamResponse`
+    """
+    path = request.match_info["path"]
+    try:
+        pyramid_folder = await content_manager.get_image_pyramid(path)
+    except FileNotFoundError:
+        raise HTTPNotFound()
+    except PermissionError:
+        raise HTTPForbidden()
+    except (ValueError, TypeError, WrongObjectType) as e:
+        raise HTTPBadRequest(reason=str(e))
+
+    tile_file = os.path.join(
+        pyramid_folder,
+        pyramid.get_tile_file(
+            int(request.match_info["level"]),
+            int(request.match_info["column"]),
+            int(request.match_info["row"]),
+        ),
+    )
+    absolute_tile_file = os.path.join(config.TILES_CACHE_PATH, tile_file)
+    if not os.path.exists(absolute_tile_file):
+        raise HTTPNotFound()
+    if config.SERVE_CACHED_FILES:
+        return _serve_cached_file(
+            request,
+            absolute_tile_file,
+            os.path.join(config.SANDBOX_PATH, fix_root_slash(path)),
+            "image/jpeg",
+        )
+    return web.HTTPFound(f"{config.STATIC_CONTENT_URL}/cache/tiles/{tile_file}")
+
+
 async def handle_config_request(request):
     """Configuration enumeration endpoint handler
 
@@ -197,7 +376,22 @@ async def handle_config_request(request):
     configuration = {}
     for key in config.EXPOSED_CONFIG_KEYS:
         configuration[key] = getattr(config, key)
-    return web.Response(body=json.dumps(configuration), content_type="application/json")
+    return web.Response(
+        body=json_encoders.dumps(configuration), content_type="application/json"
+    )
+
+
+async def handle_metrics_request(request):
+    """Metrics endpoint handler
+
+    :param request: request
+    :type request: class: `aiohttp.web.BaseRequest`
+    :return: metrics of registered components
+    :rtype: class: `aiohttp.web.Response`
+    """
+    return web.Response(
+        body=json_encoders.dumps(metrics.collect()), content_type="application/json"
+    )
 
 
 async def authorized(request):
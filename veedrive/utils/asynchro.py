@@ -1,8 +1,146 @@
 import asyncio
+import logging
+import os
+import signal
+import time
 from concurrent.futures import ProcessPoolExecutor
 
+from .. import config
+from . import metrics
+
+worker_pool = None
+worker_pool_size = 0
+
+worker_pool_stats = {
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "in_flight": 0,
+    "total_latency": 0.0,
+    "max_latency": 0.0,
+}
+
+
+def _init_worker():
+    """Import heavy modules once, when a worker process starts"""
+    # shutdown is driven by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import cv2  # noqa: F401
+    import numpy  # noqa: F401
+
+    from ..content import image  # noqa: F401
+
+
+def _get_worker_pid():
+    return os.getpid()
+
+
+def start_worker_pool(size=None):
+    """Create the shared process pool used for CPU-bound work
+
+    :param size: number of worker processes, defaults to config.WORKER_POOL_SIZE
+    :type size: int, optional
+    :return: worker pool
+    :rtype: class: `concurrent.futures.ProcessPoolExecutor`
+    """
+    global worker_pool, worker_pool_size
+    if worker_pool is None:
+        size = size or config.WORKER_POOL_SIZE
+        worker_pool = ProcessPoolExecutor(size, initializer=_init_worker)
+        worker_pool_size = size
+        logging.info(f"Worker pool started with {size} processes")
+    return worker_pool
+
+
+async def warm_up_worker_pool():
+    """Make sure every worker process is forked and initialized"""
+    pool = start_worker_pool()
+    loop = asyncio.get_event_loop()
+    pids = await asyncio.gather(
+        *[loop.run_in_executor(pool, _get_worker_pid) for _ in range(worker_pool_size)]
+    )
+    logging.debug(f"Worker pool warmed up, pids: {sorted(set(pids))}")
+
+
+def shutdown_worker_pool():
+    global worker_pool, worker_pool_size
+    if worker_pool is not None:
+        worker_pool.shutdown(wait=True)
+        worker_pool = None
+        worker_pool_size = 0
+        logging.info("Worker pool shut down")
+
+
+async def on_startup(app):
+    start_worker_pool()
+    await warm_up_worker_pool()
+
+
+async def on_cleanup(app):
+    shutdown_worker_pool()
+
+
+def get_worker_pool_stats():
+    stats = worker_pool_stats.copy()
+    stats["size"] = worker_pool_size
+    stats["queue_depth"] = max(0, stats["in_flight"] - worker_pool_size)
+    finished = stats["completed"] + stats["failed"]
+    stats["avg_latency"] = stats["total_latency"] / finished if finished else 0.0
+    return stats
+
+
+metrics.register("worker_pool", get_worker_pool_stats)
+
 
 async def run_async(func, *args):
-    executor = ProcessPoolExecutor()
+    """Run a function in the shared worker pool
+
+    :param func: picklable function to run
+    :type func: callable
+    :return: result of the function
+    """
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, func, *args)
+    pool = start_worker_pool()
+    worker_pool_stats["submitted"] += 1
+    worker_pool_stats["in_flight"] += 1
+    t_start = time.perf_counter()
+    try:
+        result = await loop.run_in_executor(pool, func, *args)
+        worker_pool_stats["completed"] += 1
+        return result
+    except Exception:
+        worker_pool_stats["failed"] += 1
+        raise
+    finally:
+        latency = time.perf_counter() - t_start
+        worker_pool_stats["in_flight"] -= 1
+        worker_pool_stats["total_latency"] += latency
+        worker_pool_stats["max_latency"] = max(
+            worker_pool_stats["max_latency"], latency
+        )
+
+
+class SingleFlight:
+    """Deduplicate concurrent executions of coroutines sharing the same key.
+
+    The first caller for a key starts the coroutine, later callers wait for
+    its result (or exception) until it completes.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+
+    async def run(self, key, coro_func, *args):
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_func(*args))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        # a cancelled waiter must not cancel the job shared with other waiters
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        self.in_flight.pop(key, None)
+        if not future.cancelled():
+            # mark exception as retrieved in case all waiters went away
+            future.exception()
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total size of its entries
+
+    :param max_size: maximum total size of cached entries, in bytes
+    :type max_size: int
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, max_age=None):
+        """Get an entry, marking it as recently used
+
+        :param key: hashable key
+        :param max_age: age in seconds past which the entry is dropped,
+            defaults to None (no expiry)
+        :type max_age: float, optional
+        :return: cached value, None if missing or expired
+        """
+        try:
+            value, size, stored_at = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if max_age is not None and time.monotonic() - stored_at > max_age:
+            self.pop(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size):
+        """Add an entry, evicting least recently used ones when over budget
+
+        :param key: hashable key
+        :param value: value to cache
+        :param size: size of the value in bytes
+        :type size: int
+        """
+        self.pop(key)
+        if size > self.max_size:
+            return
+        self.entries[key] = (value, size, time.monotonic())
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key):
+        try:
+            value, size, _ = self.entries.pop(key)
+        except KeyError:
+            return None
+        self.size -= size
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
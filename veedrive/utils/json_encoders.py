@@ -1,6 +1,8 @@
 import json
 from uuid import UUID
 
+import orjson
+
 
 def uuid_encoder(obj):
     if isinstance(obj, UUID):
@@ -18,3 +20,49 @@ class VeeDriveJSONEncoder(json.JSONEncoder):
         for encoder in self.encoders:
             result = encoder(obj)
         return result
+
+
+class RawJSON:
+    """JSON text spliced as is by dumps, e.g. documents read as text from the
+    database, which are then never decoded and encoded again
+
+    :param text: valid JSON text
+    :type text: str
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __len__(self):
+        return len(self.text)
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and other.text == self.text
+
+    def __repr__(self):
+        return f"RawJSON({self.text!r})"
+
+
+def _default(obj):
+    if isinstance(obj, RawJSON):
+        return orjson.Fragment(obj.text)
+    for encoder in VeeDriveJSONEncoder.encoders:
+        result = encoder(obj)
+        if result is not obj:
+            return result
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Serialize to JSON text with orjson, RawJSON values are spliced as is
+
+    :param obj: JSON serializable object
+    :return: JSON text
+    :rtype: str
+    """
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+loads = orjson.loads
@@ -1,25 +1,30 @@
-import json
-
-from veedrive.utils.json_encoders import VeeDriveJSONEncoder
+from veedrive.utils.json_encoders import dumps
 
 
 def prepare_response(data, result):
     obj = {"id": data["id"], "result": result}
-    return json.dumps(obj, cls=VeeDriveJSONEncoder)
+    return dumps(obj)
+
+
+def prepare_notification(method, params):
+    """Prepare a notification pushed to a client, without id as no response is
+    expected
+    """
+    return dumps({"method": method, "params": params})
 
 
 def prepare_error(data, error_code, error_description=""):
     obj = {"id": data["id"]}
     error = {"code": int(error_code), "message": error_description}
     obj["error"] = error
-    return json.dumps(obj)
+    return dumps(obj)
 
 
 def prepare_error_code(data, exception):
     obj = {"id": data["id"]}
     error = {"code": int(exception.code), "message": str(exception)}
     obj["error"] = error
-    return json.dumps(obj)
+    return dumps(obj)
 
 
 def validate_jsonrpc(required_param):
@@ -0,0 +1,21 @@
+collectors = {}
+
+
+def register(name, collector):
+    """Register a callable returning a dict of metrics under a given name
+
+    :param name: name of the metrics group, e.g. 'worker_pool'
+    :type name: str
+    :param collector: callable without arguments returning a JSON serializable dict
+    :type collector: callable
+    """
+    collectors[name] = collector
+
+
+def collect():
+    """Collect metrics of all registered groups
+
+    :return: a dict of metrics groups
+    :rtype: dict
+    """
+    return {name: collector() for name, collector in collectors.items()}
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import time
+import unittest
+import uuid
+from unittest.mock import patch
+
+import aiounittest
+
+from .. import asynchro, json_encoders, metrics
+from ..cache import LRUCache
+
+
+class TestWorkerPool(aiounittest.AsyncTestCase):
+    def tearDown(self):
+        asynchro.shutdown_worker_pool()
+
+    async def test_pool_is_reused(self):
+        asynchro.start_worker_pool(2)
+        await asynchro.warm_up_worker_pool()
+        pool = asynchro.worker_pool
+
+        pids = {await asynchro.run_async(os.getpid) for _ in range(10)}
+        assert asynchro.worker_pool is pool
+        assert len(pids) <= 2
+        assert os.getpid() not in pids
+
+    async def test_stats(self):
+        asynchro.start_worker_pool(1)
+        submitted = asynchro.worker_pool_stats["submitted"]
+        failed = asynchro.worker_pool_stats["failed"]
+
+        await asynchro.run_async(abs, -1)
+        with self.assertRaises(TypeError):
+            await asynchro.run_async(abs, "a")
+
+        stats = metrics.collect()["worker_pool"]
+        assert stats["submitted"] == submitted + 2
+        assert stats["failed"] == failed + 1
+        assert stats["in_flight"] == 0
+        assert stats["size"] == 1
+
+
+class TestSingleFlight(aiounittest.AsyncTestCase):
+    async def test_error_fan_out(self):
+        single_flight = asynchro.SingleFlight()
+        calls = []
+
+        async def failing_job(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            raise ValueError(value)
+
+        results = await asyncio.gather(
+            *[single_flight.run("key", failing_job, i) for i in range(10)],
+            return_exceptions=True,
+        )
+        assert calls == [0]
+        assert all(isinstance(r, ValueError) for r in results)
+        assert not single_flight.in_flight
+
+        # once finished, the same key is executed again
+        with self.assertRaises(ValueError):
+            await single_flight.run("key", failing_job, 1)
+        assert calls == [0, 1]
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(10)
+        cache.put("a", b"aaaa", 4)
+        cache.put("b", b"bbbb", 4)
+        assert cache.get("a") == b"aaaa"
+        cache.put("c", b"cccc", 4)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == b"aaaa"
+        assert cache.get("c") == b"cccc"
+        assert cache.size == 8
+        assert cache.get_stats()["evictions"] == 1
+        assert cache.get_stats()["hits"] == 3
+        assert cache.get_stats()["misses"] == 1
+        assert cache.get_stats()["hit_ratio"] == 0.75
+
+    def test_entry_bigger_than_cache(self):
+        cache = LRUCache(10)
+        cache.put("a", b"a" * 11, 11)
+        assert cache.get("a") is None
+        assert cache.size == 0
+
+    def test_max_age(self):
+        cache = LRUCache(10)
+        cache.put("a", b"aaaa", 4)
+        with patch.object(time, "monotonic", return_value=time.monotonic() + 5):
+            assert cache.get("a", max_age=10) == b"aaaa"
+            assert cache.get("a") == b"aaaa"
+            assert cache.get("a", max_age=1) is None
+        assert cache.size == 0
+        assert cache.get_stats()["misses"] == 1
+
+
+class TestJSONEncoding(unittest.TestCase):
+    def test_dumps(self):
+        presentation_id = uuid.uuid4()
+        raw = json_encoders.RawJSON('{"a": [1, 2]}')
+        text = json_encoders.dumps({"id": presentation_id, "results": [raw], 1: None})
+        assert (
+            text == f'{{"id":"{presentation_id}","results":[{{"a": [1, 2]}}],"1":null}}'
+        )
+        assert json_encoders.loads(text)["results"] == [{"a": [1, 2]}]
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            json_encoders.dumps({"a": object()})
+
+
+if __name__ == "__main__":
+    unittest.main()